@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+""" cli.py
+
+Command line interface for running composite algorithms outside of QGIS
+
+Example:
+    python cli.py NDVIComposite composite.gtif images/*/L*stack \\
+        --ncpu 4 --option _mask_band=8 --profile summary.json
+
+    Outputs named "*.vrt" are written as one file per chunk by each worker
+    and may be translated to a single COG afterwards:
+
+    python cli.py NDVIComposite composite.vrt images/*/L*stack \\
+        --ncpu 8 --cog composite.tif
+
+    Composites may instead be run by a compositing daemon, which keeps
+    datasets open and images validated between runs:
+
+    python cli.py serve &
+    python cli.py NDVIComposite composite.gtif images/*/L*stack --daemon
+    python cli.py serve --stop
+
+    Several algorithms may be run over the same images in a single pass,
+    reading each chunk of the images once for all of them. Options apply to
+    every algorithm accepting them:
+
+    python cli.py NDVIComposite ndvi.gtif images/*/L*stack \\
+        --job ZZCompositor=zz.gtif --option _mask_band=8
+
+    Image stacks composited repeatedly may be ingested into a time-major
+    chunked store, which composites then read instead of the images:
+
+    python cli.py ingest stack.zarr images/*/L*stack --option _mask_band=8
+    python cli.py NDVIComposite composite.gtif --store stack.zarr \\
+        --option _mask_band=8
+
+"""
+from __future__ import division, print_function
+
+import argparse
+import logging
+import sys
+
+from compositors import algorithms
+from compositors import daemon
+from compositors import profiling
+from compositors.collection import ImageCollection
+from compositors.index_cache import IndexCache
+from compositors.jobs import JobSet
+from compositors import stack_store
+from compositors.writers import translate_cog
+
+logger = logging.getLogger('image_compositor')
+
+
+def parse_option(algo, option):
+    """ Parse a "name=value" algorithm option using its default's type
+
+    Args:
+      algo (Compositor): compositing algorithm
+      option (str): option formatted as "name=value"
+
+    Returns:
+      tuple: name and parsed value of option
+
+    Raises:
+      ValueError: raised if option is not an input of the algorithm
+
+    """
+    name, _, value = option.partition('=')
+    if name not in algo.input_info:
+        raise ValueError('Unknown option "{n}" for {a} (choose from '
+                         '{o})'.format(n=name, a=algo.__name__,
+                                       o=', '.join(algo.input_info)))
+
+    default = getattr(algo, name)
+    if isinstance(default, bool):
+        value = value.lower() in ('1', 'true', 'yes')
+    elif isinstance(default, (int, float)):
+        value = type(default)(value)
+    elif isinstance(default, list):
+        _type = type(default[0]) if default else str
+        value = [_type(v) for v in value.replace(',', ' ').split()]
+
+    return name, value
+
+
+def parse_job(names, job):
+    """ Parse an "ALGORITHM=OUTPUT" job
+
+    Args:
+      names (dict): compositing algorithms by name
+      job (str): job formatted as "ALGORITHM=OUTPUT"
+
+    Returns:
+      tuple: algorithm and output filename of job
+
+    Raises:
+      ValueError: raised if the algorithm is unknown or no output is given
+
+    """
+    name, _, output = job.partition('=')
+    if name not in names:
+        raise ValueError('Unknown algorithm "{n}" for --job (choose from '
+                         '{a})'.format(n=name, a=', '.join(sorted(names))))
+    if not output:
+        raise ValueError('No output given for --job {j}'.format(j=job))
+    return names[name], output
+
+
+def serve(argv):
+    """ Run, query or stop a compositing daemon """
+    parser = argparse.ArgumentParser(prog='cli.py serve',
+                                     description='Run a compositing daemon')
+    parser.add_argument('address', nargs='?', default=daemon.DEFAULT_ADDRESS,
+                        help='Unix socket path or "localhost:PORT" to '
+                             'listen on (default: %(default)s)')
+    parser.add_argument('--max-open-datasets', type=int, default=256,
+                        help='Maximum number of datasets kept open')
+    parser.add_argument('--status', action='store_true',
+                        help='Show the status of a running daemon')
+    parser.add_argument('--stop', action='store_true',
+                        help='Stop a running daemon')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show debug messages')
+    args = parser.parse_args(argv)
+
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    try:
+        if args.status or args.stop:
+            reply = daemon.submit(args.address, {
+                'command': 'shutdown' if args.stop else 'status'})
+            if args.status:
+                for key in sorted(reply):
+                    print('{k}: {v}'.format(k=key, v=reply[key]))
+            return 0
+        daemon.serve(algorithms, args.address,
+                     max_open_datasets=args.max_open_datasets)
+    except (ValueError, IOError, RuntimeError) as e:
+        logger.error(str(e))
+        return 1
+    return 0
+
+
+def ingest(argv):
+    """ Ingest validated images into a time-major stack store """
+    algo = stack_store.StackReader
+    parser = argparse.ArgumentParser(
+        prog='cli.py ingest',
+        description='Ingest images into a time-major stack store')
+    parser.add_argument('store', help='Directory of store to write')
+    parser.add_argument('images', nargs='+', help='Input images')
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='Read option, which composites must share to '
+                             'read from the store (choose from {o})'.format(
+                                 o=', '.join(algo.input_info)))
+    parser.add_argument('--time-chunk', type=int,
+                        help='Number of images per chunk (default: all)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show debug messages')
+    args = parser.parse_args(argv)
+
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    reader = algo()
+    try:
+        for option in args.option:
+            name, value = parse_option(algo, option)
+            setattr(reader, name, value)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        valid = reader.validate_images(ImageCollection(args.images).unique())
+        logger.info('{n} of {t} images are valid'.format(n=sum(valid),
+                                                         t=len(valid)))
+        if not any(valid):
+            return 1
+        stack_store.ingest(reader, args.store, time_chunk=args.time_chunk)
+    except (ImportError, RuntimeError) as e:
+        logger.error(str(e))
+        return 1
+    logger.info('Wrote {n} images to {s}'.format(n=sum(valid),
+                                                 s=args.store))
+    return 0
+
+
+def main(argv=None):
+    """ Run a composite from the command line """
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == 'serve':
+        return serve(argv[1:])
+    if argv and argv[0] == 'ingest':
+        return ingest(argv[1:])
+
+    names = dict((algo.__name__, algo) for algo in algorithms)
+
+    parser = argparse.ArgumentParser(description='Create image composites')
+    parser.add_argument('algorithm', choices=sorted(names),
+                        help='Compositing algorithm')
+    parser.add_argument('output', help='Output filename')
+    parser.add_argument('images', nargs='*',
+                        help='Input images (default: images of --store)')
+    parser.add_argument('--ncpu', type=int, default=1,
+                        help='Number of CPUs to use')
+    parser.add_argument('--executor', choices=('process', 'thread'),
+                        default='process',
+                        help='Use CPUs as a pool of processes or of threads '
+                             '(a daemon always uses threads)')
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='Algorithm option (see "input_info"), set for '
+                             'every job accepting it')
+    parser.add_argument('--job', action='append', default=[],
+                        metavar='ALGORITHM=OUTPUT',
+                        help='Also run ALGORITHM writing OUTPUT, in the same '
+                             'pass over the images')
+    parser.add_argument('--start', metavar='YYYY-MM-DD',
+                        help='Only use images acquired on or after date')
+    parser.add_argument('--end', metavar='YYYY-MM-DD',
+                        help='Only use images acquired on or before date')
+    parser.add_argument('--index-cache', metavar='DIR',
+                        help='Cache per-image scores of selection composites '
+                             'in directory')
+    parser.add_argument('--store', metavar='DIR',
+                        help='Read images from a stack store written by '
+                             '"cli.py ingest"')
+    parser.add_argument('--driver', default='GTiff', help='GDAL driver')
+    parser.add_argument('--co', action='append', default=None,
+                        metavar='NAME=VALUE', help='GDAL creation option')
+    parser.add_argument('--cog', metavar='FILE',
+                        help='Translate VRT output to a Cloud-Optimized '
+                             'GeoTIFF')
+    parser.add_argument('--profile', metavar='JSON',
+                        help='Write profiling summary to JSON file')
+    parser.add_argument('--trace', metavar='JSON',
+                        help='Write Chrome trace of pipeline stages')
+    parser.add_argument('--daemon', metavar='ADDRESS', nargs='?',
+                        const=daemon.DEFAULT_ADDRESS,
+                        help='Submit to a compositing daemon (see "cli.py '
+                             'serve") listening on ADDRESS (default: '
+                             '%(const)s)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show debug messages')
+    args = parser.parse_args(argv)
+
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    try:
+        jobs = [(names[args.algorithm], args.output)]
+        jobs.extend(parse_job(names, job) for job in args.job)
+    except ValueError as e:
+        parser.error(str(e))
+    compositors = [algo() for algo, _ in jobs]
+    outputs = [output for _, output in jobs]
+    compositor = compositors[0]
+    try:
+        for option in args.option:
+            # An option no job accepts is reported for the first job
+            name = option.partition('=')[0]
+            accepting = [c for c in compositors
+                         if name in c.input_info] or [compositor]
+            for c in accepting:
+                name, value = parse_option(type(c), option)
+                setattr(c, name, value)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.cog and args.job:
+        parser.error('--cog is not available with --job')
+    if args.cog and not args.output.lower().endswith('.vrt'):
+        parser.error('--cog requires a VRT output')
+    if args.index_cache:
+        index_cache = IndexCache(args.index_cache)
+    if args.store:
+        try:
+            store = stack_store.StackStore(args.store)
+        except (ImportError, ValueError, KeyError) as e:
+            parser.error('Cannot open stack store {s}: {e}'.format(
+                s=args.store, e=e))
+    for c in compositors:
+        c.executor = args.executor
+        if args.index_cache:
+            c.index_cache = index_cache
+        if args.store:
+            c.stack_store = store
+    if args.images:
+        images = ImageCollection(args.images).unique()
+    elif args.store:
+        images = compositor.stack_store.collection
+    else:
+        parser.error('No images given')
+    if args.start or args.end:
+        total = len(images)
+        try:
+            images = images.between(args.start, args.end)
+        except ValueError as e:
+            parser.error(str(e))
+        logger.info('{n} of {t} images are within the dates given'.format(
+            n=len(images), t=total))
+    if args.daemon and (args.profile or args.trace):
+        parser.error('--profile and --trace are not available with --daemon')
+    if args.daemon and args.job:
+        parser.error('--job is not available with --daemon, which runs jobs '
+                     'queued together in one pass itself')
+
+    if args.daemon:
+        try:
+            reply = daemon.submit(args.daemon, daemon.job_request(
+                compositor, args.output, images.paths.tolist(),
+                ncpu=args.ncpu,
+                driver=args.driver, creation_options=args.co))
+        except (ValueError, IOError, RuntimeError) as e:
+            logger.error(str(e))
+            return 1
+        logger.info('{n} of {t} images are valid'.format(
+            n=sum(reply['valid']), t=len(reply['valid'])))
+        if args.cog:
+            translate_cog(args.output, args.cog, ncpu=args.ncpu)
+        return 0
+
+    profiler = None
+    if args.profile or args.trace:
+        profiler = profiling.enable(trace=args.trace is not None)
+
+    try:
+        if args.job:
+            runner = JobSet([(c, None) for c in compositors])
+            try:
+                valid = runner.validate_images(images)
+            except ValueError as e:
+                logger.error(str(e))
+                return 1
+            for c, _valid in zip(compositors, valid):
+                logger.info('{n} of {t} images are valid for {a}'.format(
+                    n=sum(_valid), t=len(_valid), a=c))
+        else:
+            runner = compositor
+            valid = compositor.validate_images(images)
+            logger.info('{n} of {t} images are valid'.format(n=sum(valid),
+                                                             t=len(valid)))
+            if not any(valid):
+                return 1
+
+        runner.process_image(outputs if args.job else args.output,
+                             ncpu=args.ncpu, driver=args.driver,
+                             creation_options=args.co)
+        if args.cog:
+            translate_cog(args.output, args.cog, ncpu=args.ncpu)
+    finally:
+        if profiler is not None:
+            profiling.disable()
+            logger.info('Profile:\n' + profiler.format_summary())
+            if args.profile:
+                profiler.write_json(args.profile)
+            if args.trace:
+                profiler.write_trace(args.trace)
+
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        datefmt='%H:%M:%S')
+    sys.exit(main())
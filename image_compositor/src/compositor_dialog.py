@@ -23,23 +23,37 @@
 from __future__ import division, print_function
 
 import collections
+import copy
 from datetime import datetime as dt
 import fnmatch
 from functools import partial
 import logging
+import multiprocessing
 import os
+import tempfile
 
 from PyQt4 import QtCore
 from PyQt4 import QtGui
 
 from osgeo import gdal
 
+try:
+    from qgis.core import QgsMapLayerRegistry
+except ImportError:
+    HAS_QGIS = False
+else:
+    HAS_QGIS = True
+
 from ui_main_compositor import Ui_ImageCompositor as Ui_Dialog
 
 from compositors import algorithms
+from compositors import daemon
+from compositors import profiling
+from compositors import remote
+from compositors.validation import ImageValidator
 from custom_form import CustomForm
-from utils import (gdal_file_validator, find_file, locate_files,
-                   parse_date_from_filename)
+from image_table import ImageTableModel, UNKNOWN
+from utils import gdal_file_validator, find_file, locate_files
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s: %(message)s',
@@ -48,11 +62,56 @@ logging.basicConfig(
 logger = logging.getLogger('image_compositor')
 
 
+class ValidityChecker(QtCore.QThread):
+    """ Checks validity of images in the background
+
+    Verdicts are emitted in batches through the `checked` signal as they
+    become available. Images are opened using a copy of the compositor with
+    its own `DatasetPool`, so datasets are never used by both this thread
+    and the user interface (e.g., when compositing or previewing).
+
+    Args:
+      validator (ImageValidator): validator remembering checked images
+      compositor (Compositor): compositing algorithm, which is copied
+      images (list): filenames of images to check
+      batch_size (int, optional): number of images per emitted batch
+      parent (QObject, optional): parent object
+
+    """
+
+    checked = QtCore.pyqtSignal(list, list)
+
+    def __init__(self, validator, compositor, images, batch_size=100,
+                 parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.validator = validator
+        self.compositor = copy.deepcopy(compositor)
+        self.images = images
+        self.batch_size = batch_size
+
+    def run(self):
+        try:
+            for i in range(0, len(self.images), self.batch_size):
+                batch = self.images[i:i + self.batch_size]
+                self.checked.emit(batch,
+                                  self.validator.check(batch, self.compositor))
+        finally:
+            self.compositor.datasets.clear()
+
+
 class CompositorDialog(QtGui.QDialog, Ui_Dialog):
 
-    # Store
-    added_images = []
-    added_dates = []
+    # Log a profile of each run (e.g., IMAGE_COMPOSITOR_PROFILE=1)
+    profile = bool(os.environ.get('IMAGE_COMPOSITOR_PROFILE'))
+    # Decimation factor of previews
+    preview_scale = 8
+    # Submit composites to a compositing daemon listening on this address
+    # (e.g., IMAGE_COMPOSITOR_DAEMON=/run/user/1000/image_compositor.sock)
+    daemon_address = os.environ.get('IMAGE_COMPOSITOR_DAEMON')
+    # Composite using this many threads, which unlike processes do not fork
+    # QGIS (e.g., IMAGE_COMPOSITOR_NCPU=4; default: number of CPUs)
+    ncpu = int(os.environ.get('IMAGE_COMPOSITOR_NCPU') or
+               multiprocessing.cpu_count())
 
     def __init__(self, iface):
 
@@ -60,6 +119,14 @@ class CompositorDialog(QtGui.QDialog, Ui_Dialog):
         self.iface = iface
         self.setupUi(self)
 
+        # Store
+        self.images = ImageTableModel(self)
+        self.validator = ImageValidator()
+        self._checkers = []
+        # ID of the preview layer and its file
+        self._preview_layer = None
+        self._preview_file = None
+
         self.setup_gui()
 
     def setup_gui(self):
@@ -103,10 +170,9 @@ class CompositorDialog(QtGui.QDialog, Ui_Dialog):
                     self.but_dirimport,
                     [self.edit_dirname, self.edit_imagepattern]))
 
-        # Image table widget - 3 columns so we can have stretch on 0 and
-        #     interactive for 1
-        self.table_images.setColumnCount(3)
-        self.table_images.setHorizontalHeaderLabels(['Name', 'Date', ''])
+        # Image table view - 3 columns so we can have stretch on 0 and
+        #     interactive for 1; the hidden column 2 holds validity
+        self.table_images.setModel(self.images)
         self.table_images.horizontalHeader().setResizeMode(
             0, QtGui.QHeaderView.Stretch)
         self.table_images.horizontalHeader().setResizeMode(
@@ -121,6 +187,13 @@ class CompositorDialog(QtGui.QDialog, Ui_Dialog):
 
         self.but_run.clicked.connect(self.run_composite)
 
+        # Preview, refreshed shortly after algorithm options change
+        self.but_preview.clicked.connect(self.preview_composite)
+        self._preview_timer = QtCore.QTimer(self)
+        self._preview_timer.setSingleShot(True)
+        self._preview_timer.setInterval(500)
+        self._preview_timer.timeout.connect(self.preview_composite)
+
         self.but_save.clicked.connect(self.save_composite)
 
         # Override QDialogButtonBox buttons
@@ -143,6 +216,7 @@ class CompositorDialog(QtGui.QDialog, Ui_Dialog):
 
             # Add algorithm options
             custom_form = CustomForm(defaults)  # , title='Algorithm Options')
+            custom_form.changed.connect(self.options_changed)
 
             self.stackwidget_algo_details.insertWidget(i, custom_form)
 
@@ -174,63 +248,35 @@ class CompositorDialog(QtGui.QDialog, Ui_Dialog):
         if isinstance(images, str):
             images = [images]
 
-        to_add_image = []
-        to_add_date = []
+        if self.images.add_images(images):
+            # Validate images
+            self.check_image_validity()
 
-        for image in images:
-            # Try to get date
-            date = parse_date_from_filename(image)
-
-            # Validate?
-
-            # Make sure isn't already in table
-            if image not in self.added_images:
-                to_add_image.append(image)
-                to_add_date.append(date)
-            else:
-                logger.info('Already added {i}'.format(i=image))
-
-        # Sort before adding
-        to_add_date, to_add_image = zip(*sorted(zip(to_add_date,
-                                                    to_add_image)))
-
-        self.added_images.extend(to_add_image)
-        self.added_dates.extend(to_add_date)
-
-        self.update_table(to_add_image, to_add_date)
-
-    def update_table(self, images, dates):
-        """ Adds new images to table """
-        # Add new rows
-        self.table_images.setRowCount(len(self.added_images))
-        # Figure out where to start with new "images"
-        start = len(self.added_images) - len(images)
-
-        for row, image, date in zip(xrange(start, len(self.added_images)),
-                                    images, dates):
-            _image = QtGui.QTableWidgetItem(os.path.basename(image))
-            _image.setFlags(QtCore.Qt.ItemIsEnabled |
-                            QtCore.Qt.ItemIsSelectable)
-            _image.setTextAlignment(QtCore.Qt.AlignHCenter |
-                                    QtCore.Qt.AlignVCenter)
-
-            _date = QtGui.QTableWidgetItem('None' if date is None else
-                                           date.strftime('%x'))
-            _date.setFlags(QtCore.Qt.ItemIsEnabled |
-                           QtCore.Qt.ItemIsSelectable |
-                           QtCore.Qt.ItemIsEditable)
-            _date.setTextAlignment(QtCore.Qt.AlignHCenter |
-                                   QtCore.Qt.AlignVCenter)
-
-            self.table_images.setItem(row, 0, _image)
-            self.table_images.setItem(row, 1, _date)
-
-        # Validate images
-        self.check_image_validity()
-
-    def check_image_validity(self):
-        """ Validates images in table for use with selected algorithm """
-        pass
+    def check_image_validity(self, recheck=False):
+        """ Validates images in table for use with selected algorithm
+
+        Only images not yet checked are opened. Verdicts are updated in the
+        table as they are checked in the background.
+
+        Args:
+          recheck (bool, optional): update verdicts of all images (e.g.,
+            when the algorithm's requirements change) instead of only
+            those not yet checked
+
+        """
+        if recheck:
+            images = self.images.paths.tolist()
+        else:
+            images = self.images.paths[self.images.valid == UNKNOWN].tolist()
+        if not images:
+            return
+
+        checker = ValidityChecker(self.validator, self.algo, images,
+                                  parent=self)
+        checker.checked.connect(self.images.set_valid)
+        checker.finished.connect(partial(self._checkers.remove, checker))
+        self._checkers.append(checker)
+        checker.start()
 
 # Slots
     @QtCore.pyqtSlot(bool)
@@ -251,8 +297,15 @@ class CompositorDialog(QtGui.QDialog, Ui_Dialog):
 
     @QtCore.pyqtSlot()
     def import_image(self):
-        """ Import a single image specified at a time """
-        filename = os.path.abspath(str(self.edit_imagename.text()))
+        """ Import a single image specified at a time
+
+        Remote images may be given as URLs or GDAL virtual file system paths
+        (e.g., "/vsicurl/https://...").
+
+        """
+        filename = str(self.edit_imagename.text())
+        if not remote.is_remote(filename):
+            filename = os.path.abspath(filename)
 
         self.add_images([filename])
 
@@ -300,18 +353,14 @@ class CompositorDialog(QtGui.QDialog, Ui_Dialog):
     @QtCore.pyqtSlot()
     def remove_images(self):
         """ Remove images highlighted in the table """
-        selected = self.table_images.selectedItems()
-        rows = set()
-        for item in selected:
-            rows.add(item.row())
+        rows = set(index.row() for index in
+                   self.table_images.selectionModel().selectedIndexes())
 
         self.table_images.selectionModel().clearSelection()
 
-        for row in sorted(rows, reverse=True):
-            logger.debug('Removing {f}'.format(f=self.added_images[row]))
-            del self.added_images[row]
-            del self.added_dates[row]
-            self.table_images.removeRow(row)
+        logger.debug('Removing {n} images'.format(n=len(rows)))
+        self.validator.forget(self.images.paths[list(rows)])
+        self.images.remove_rows(rows)
 
     @QtCore.pyqtSlot(int)
     def algo_changed(self, index):
@@ -319,14 +368,109 @@ class CompositorDialog(QtGui.QDialog, Ui_Dialog):
         # Update stack widget
         self.stackwidget_algo_details.setCurrentIndex(index)
         self.algo = algorithms[self.cbox_algo.currentIndex()]()
+        self.check_image_validity(recheck=True)
 
     @QtCore.pyqtSlot()
     def run_composite(self):
         """ Run the compositing algorithm """
         logger.debug('Running the algorithm')
+        output = str(QtGui.QFileDialog.getSaveFileName(
+            self, 'Save composite as', os.getcwd(), 'GeoTIFF (*.tif *.gtif)'))
+        if not output:
+            return
+
+        if self.daemon_address:
+            self.submit_composite(output)
+            return
+
         # Run the compositing code
+        profiler = profiling.enable() if self.profile else None
+        try:
+            self.set_algorithm_options()
+            images = self.images.collection
+            valid = self.algo.validate_images(images,
+                                              validator=self.validator)
+            self.images.set_valid(images.paths, valid)
+            if not any(valid):
+                logger.error('No images are valid for this algorithm')
+                return
+            self.algo.executor = 'thread'
+            self.algo.process_image(output, ncpu=self.ncpu)
+        finally:
+            if profiler is not None:
+                profiling.disable()
+                logger.info('Profile:\n' + profiler.format_summary())
+
+    def submit_composite(self, output):
+        """ Run the compositing algorithm using the compositing daemon
+
+        Args:
+          output (str): output filename
+
+        """
         self.set_algorithm_options()
-        self.algo.process_image()
+        images = self.images.paths.tolist()
+        try:
+            reply = daemon.submit(self.daemon_address, daemon.job_request(
+                self.algo, output, images))
+        except (ValueError, IOError, RuntimeError) as e:
+            logger.error('Compositing daemon at {a} failed: {e}'.format(
+                a=self.daemon_address, e=e))
+            return
+        self.images.set_valid(images, reply['valid'])
+
+    @QtCore.pyqtSlot()
+    def options_changed(self):
+        """ Refresh the preview, if shown, when algorithm options change """
+        if self._preview_layer is not None:
+            self._preview_timer.start()
+
+    @QtCore.pyqtSlot()
+    def preview_composite(self):
+        """ Run the compositing algorithm at reduced resolution and show it
+        as a temporary layer
+        """
+        logger.debug('Previewing the algorithm')
+        self.set_algorithm_options()
+        images = self.images.collection
+        valid = self.algo.validate_images(images, validator=self.validator)
+        self.images.set_valid(images.paths, valid)
+        if not any(valid):
+            logger.error('No images are valid for this algorithm')
+            return
+
+        fd, output = tempfile.mkstemp(prefix='composite_preview_',
+                                      suffix='.tif')
+        os.close(fd)
+        self.algo.executor = 'thread'
+        self.algo.preview(output, scale=self.preview_scale, ncpu=self.ncpu)
+        self.show_preview(output)
+
+    def show_preview(self, output):
+        """ Show a preview as a temporary layer, replacing any previous one
+
+        Args:
+          output (str): filename of preview
+
+        """
+        if not HAS_QGIS:
+            logger.info('Saved preview to {o}'.format(o=output))
+            return
+
+        if self._preview_layer is not None:
+            registry = QgsMapLayerRegistry.instance()
+            if registry.mapLayer(self._preview_layer) is not None:
+                registry.removeMapLayer(self._preview_layer)
+            try:
+                os.remove(self._preview_file)
+            except OSError:
+                logger.debug('Could not remove previous preview {f}'.format(
+                    f=self._preview_file))
+
+        layer = self.iface.addRasterLayer(
+            output, 'Composite preview (1/{s})'.format(s=self.preview_scale))
+        self._preview_layer = layer.id() if layer is not None else None
+        self._preview_file = output
 
     @QtCore.pyqtSlot()
     def save_composite(self):
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*
+import inspect
 import pkgutil
 
 
@@ -27,5 +28,9 @@ for loader, modname, ispkg in pkgutil.iter_modules(__path__):
 algorithms = Compositor.__subclasses__()
 for algo in algorithms:
     algorithms = recursive_find_subclass(algo, found=algorithms)
+# Skip abstract base classes of algorithm families, and the stack reader
+from stack_store import StackReader
+algorithms = [algo for algo in algorithms if not inspect.isabstract(algo) and
+              not issubclass(algo, StackReader)]
 
 __all__ = ['algorithms']
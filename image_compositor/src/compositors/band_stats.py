@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*
+""" band_stats.py
+
+Streaming statistics and histograms of output bands
+
+`BandStatistics` accumulates the minimum, maximum, mean and standard
+deviation, and a histogram, of a band one chunk at a time as it is written,
+so outputs need no second pass (e.g., `gdal.Band.ComputeStatistics`) before
+they are displayed. Means and variances of chunks are combined using the
+pairwise update of Chan et al. so they stay accurate over many chunks.
+
+The range of values is not known until the last chunk is written, so
+values are counted in a fine histogram whose bins double in width, merging
+pairs of bins, whenever a chunk falls outside its range. The fine
+histogram is rebinned to the requested number of buckets at the end.
+
+Statistics accumulated separately (e.g., of chunks written by worker
+processes, see `writers.TileWriter`) are combined using `merge`.
+
+"""
+from __future__ import division
+
+import numpy as np
+
+#: Number of bins of the fine histogram accumulated while writing
+FINE_BINS = 4096
+
+
+class BandStatistics(object):
+    """ Statistics and histogram of one band, accumulated chunk by chunk
+
+    Values equal to the NoDataValue and values that are not finite are
+    ignored.
+
+    Args:
+      ndv (int or float, optional): NoDataValue, or None if every value is
+        valid
+      integer (bool, optional): True if the band holds integers, so bins
+        are no narrower than 1
+      nbins (int, optional): number of bins of the fine histogram
+
+    Attributes:
+      count (int): number of valid values
+      minimum (float): smallest valid value
+      maximum (float): largest valid value
+
+    """
+
+    def __init__(self, ndv=None, integer=False, nbins=FINE_BINS):
+        self.ndv = ndv
+        self.integer = integer
+        self.nbins = nbins
+        self.count = 0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._lo = None
+        self._width = None
+        self._counts = np.zeros(nbins, dtype=np.int64)
+
+    @property
+    def mean(self):
+        """ float: mean of valid values """
+        return self._mean
+
+    @property
+    def std(self):
+        """ float: population standard deviation of valid values """
+        return np.sqrt(self._m2 / self.count) if self.count else 0.0
+
+    def update(self, data):
+        """ Add the values of a chunk
+
+        Args:
+          data (np.ndarray): values of a chunk of the band
+
+        """
+        values = data[np.isfinite(data)] if data.dtype.kind == 'f' \
+            else data.ravel()
+        if self.ndv is not None:
+            values = values[values != self.ndv]
+        if not values.size:
+            return
+        values = values.astype(np.float64)
+
+        mean = values.mean()
+        self._combine(values.size, mean, ((values - mean) ** 2).sum(),
+                      values.min(), values.max())
+        bins = ((values - self._lo) // self._width).astype(np.intp)
+        self._counts += np.bincount(np.minimum(bins, self.nbins - 1),
+                                    minlength=self.nbins)
+
+    def merge(self, other):
+        """ Add the values accumulated by other statistics of the band
+
+        Counts of each bin of the other fine histogram are added to the bin
+        containing its centre, so the histogram is approximate to within
+        the width of a fine bin unless the bins of both line up (e.g., if
+        this has no values yet).
+
+        Args:
+          other (BandStatistics): statistics with the same NoDataValue
+
+        """
+        if not other.count:
+            return
+        self._combine(other.count, other._mean, other._m2,
+                      other.minimum, other.maximum)
+        nonzero = np.flatnonzero(other._counts)
+        centres = other._lo + other._width * (nonzero + 0.5)
+        bins = ((centres - self._lo) // self._width).astype(np.intp)
+        self._counts += np.bincount(
+            bins.clip(0, self.nbins - 1), weights=other._counts[nonzero],
+            minlength=self.nbins).astype(np.int64)
+
+    def _combine(self, n, mean, m2, vmin, vmax):
+        """ Add the count, mean, squared deviations and range of values
+
+        The fine histogram is widened to span the values, but their counts
+        are added by the caller.
+
+        """
+        total = self.count + n
+        delta = mean - self._mean
+        self._mean += delta * n / total
+        self._m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+        self.minimum = min(self.minimum, vmin)
+        self.maximum = max(self.maximum, vmax)
+        self._fit(vmin, vmax)
+
+    def _fit(self, vmin, vmax):
+        """ Widen the fine histogram, if needed, to span `vmin` to `vmax` """
+        if self._lo is None:
+            width = (vmax - vmin) / self.nbins
+            if self.integer:
+                width = max(np.ceil(width), 1.0)
+            self._lo = vmin
+            self._width = width or 1.0
+            return
+
+        lo, width = self._lo, self._width
+        factor = 1
+        while True:
+            # Align the new bins on the old, so each old bin falls within
+            # one new bin
+            new_width = width * factor
+            shift = int(np.ceil(max(lo - vmin, 0) / new_width))
+            new_lo = lo - shift * new_width
+            if vmax < new_lo + new_width * self.nbins and \
+                    lo + width * self.nbins <= new_lo + new_width * self.nbins:
+                break
+            factor *= 2
+        if factor == 1 and shift == 0:
+            return
+
+        counts = np.zeros(self.nbins, dtype=np.int64)
+        np.add.at(counts, shift + np.arange(self.nbins) // factor,
+                  self._counts)
+        self._counts = counts
+        self._lo, self._width = new_lo, new_width
+
+    def histogram(self, nbuckets=256):
+        """ Return a histogram of valid values spanning their range
+
+        Integer bands have buckets centred on whole numbers where their
+        range allows, as GDAL computes them.
+
+        Args:
+          nbuckets (int, optional): largest number of buckets
+
+        Returns:
+          tuple: lower and upper bound of the histogram and the count of
+            each bucket, or None if there are no valid values
+
+        """
+        if not self.count:
+            return None
+        lo, hi = self.minimum, self.maximum
+        if self.integer:
+            nbuckets = int(min(nbuckets, hi - lo + 1))
+            lo, hi = lo - 0.5, hi + 0.5
+        elif hi == lo:
+            nbuckets = 1
+
+        # Assign each fine bin to the bucket containing its centre
+        centres = self._lo + self._width * (np.arange(self.nbins) + 0.5)
+        if self.integer:
+            centres = np.floor(centres)
+        buckets = np.floor((centres - lo) / (hi - lo or 1) * nbuckets)
+        buckets = np.clip(buckets, 0, nbuckets - 1).astype(np.intp)
+        counts = np.bincount(buckets, weights=self._counts,
+                             minlength=nbuckets).astype(np.int64)
+        return lo, hi, counts.tolist()
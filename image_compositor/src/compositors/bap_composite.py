@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*
+""" bap_composite.py
+
+Best-available-pixel (BAP) composite
+
+Each observation is scored by a weighted sum of:
+
+    - day of year: closeness of the acquisition date to a target day of
+      year, as a Gaussian of the number of days between them
+    - distance to cloud: a logistic function of the distance to the nearest
+      pixel that is not clear in the same image (see `kernels.cloud_distance`)
+    - sensor: preference for the image's sensor, decreasing along a list of
+      sensors from most to least preferred
+    - opacity: atmospheric opacity from an optional band, decreasing linearly
+      from 1 below to 0 above a range of values
+
+and the highest scoring clear observation of each pixel is composited. The
+day of year and sensor terms depend only on the image, so they are computed
+once per run by `prepare`. The other terms, and the sum, are computed for
+all observations of a chunk at once.
+
+"""
+from __future__ import division
+
+import logging
+import re
+
+import numpy as np
+from osgeo import gdal
+
+from composite_algorithm import Compositor
+import dates
+import kernels
+import masks
+
+gdal.AllRegister()
+gdal.UseExceptions()
+
+logger = logging.getLogger('image_compositor')
+
+
+def _sensor_key(sensor):
+    """ Return sensor name without zero padding (e.g., "LC08" to "LC8") """
+    return re.sub(r'0(\d)', r'\1', sensor.upper())
+
+
+class BAPComposite(Compositor):
+    """ Best-available-pixel composite """
+
+    _ndv = -9999
+    _target_doy = 213
+    _doy_sigma = 30.0
+    _cloud_distance = 50
+    _sensor_preference = 'LC8 LE7 LT5 S2'
+    _opacity_band = 0
+    _opacity_range = [200, 300]
+    _weight_doy = 0.5
+    _weight_cloud = 0.3
+    _weight_sensor = 0.1
+    _weight_opacity = 0.1
+
+    input_info = (['_ndv', '_target_doy', '_doy_sigma', '_cloud_distance',
+                   '_sensor_preference', '_opacity_band', '_opacity_range',
+                   '_weight_doy', '_weight_cloud', '_weight_sensor',
+                   '_weight_opacity'] +
+                  Compositor.mask_input_info + Compositor.warp_input_info +
+                  Compositor.summary_input_info)
+    input_info_str = (['NoDataValue',
+                       'Target Day of Year',
+                       'Day of Year Spread (days)',
+                       'Cloud Distance Range (pixels)',
+                       'Preferred Sensors (most preferred first)',
+                       'Opacity Band Number (0 for none)',
+                       'Opacity Range (clear to opaque)',
+                       'Day of Year Weight',
+                       'Cloud Distance Weight',
+                       'Sensor Weight',
+                       'Opacity Weight'] +
+                      Compositor.mask_input_info_str +
+                      Compositor.warp_input_info_str +
+                      Compositor.summary_input_info_str)
+    description = 'Best-available-pixel composite'
+
+    def __repr__(self):
+        return "Best-available-pixel composite"
+
+    def required_bands(self):
+        """ Return opacity band number, if used, and any mask band """
+        bands = [self._opacity_band] if self._opacity_band else []
+        return bands + super(BAPComposite, self).required_bands()
+
+    def summary_bands(self):
+        """ Return names of the summary bands, including score summaries """
+        if not self._summary:
+            return []
+        return list(kernels.SUMMARY_BANDS)
+
+    def prepare(self):
+        """ Compute the day of year and sensor terms of each image
+
+        Raises:
+          ValueError: raised if the opacity band is used and the upper
+            bound of the opacity range is not above its lower bound
+
+        """
+        if self._opacity_band:
+            low, high = self._opacity_range
+            if not high > low:
+                raise ValueError('Opacity range must increase, not go from '
+                                 '{l} to {h}'.format(l=low, h=high))
+        super(BAPComposite, self).prepare()
+        self._image_scores = (
+            self._weight_doy * self.doy_scores() +
+            self._weight_sensor * self.sensor_scores())
+
+    def doy_scores(self):
+        """ Return the day of year term of each valid image
+
+        Dates are those of the `collection` of valid images, parsed from
+        filenames unless given. Images without a known date score 0.
+
+        Returns:
+          scores (np.ndarray): scores between 0 and 1
+
+        """
+        _dates = self.collection.dates
+        known = ~dates.isnat(_dates)
+
+        doy = np.zeros(len(self.images))
+        doy[known] = [d.timetuple().tm_yday
+                      for d in _dates[known].astype(object)]
+        days = np.abs(doy - self._target_doy)
+        days = np.minimum(days, 365 - days)
+
+        scores = np.exp(-0.5 * (days / self._doy_sigma) ** 2)
+        scores[~known] = 0
+        return scores
+
+    def sensor_scores(self):
+        """ Return the sensor preference term of each valid image
+
+        Images of sensors not in the list of preferred sensors score 0.
+
+        Returns:
+          scores (np.ndarray): scores between 0 and 1
+
+        """
+        preference = [_sensor_key(s) for s in
+                      self._sensor_preference.replace(',', ' ').split()]
+        sensors = self.collection.sensors
+
+        scores = np.zeros(len(self.images))
+        for i, sensor in enumerate(sensors):
+            if sensor is None:
+                continue
+            for rank, preferred in enumerate(preference):
+                if _sensor_key(sensor).startswith(preferred):
+                    scores[i] = 1 - rank / len(preference)
+                    break
+        return scores
+
+    def cloud_scores(self, cloudy):
+        """ Return the distance to cloud term of each observation
+
+        Args:
+          cloudy (np.ndarray): True where not clear, shaped
+            (nimage, nrow, ncol)
+
+        Returns:
+          scores (np.ndarray): scores between 0 and 1
+
+        """
+        distance = kernels.cloud_distance(cloudy, self._cloud_distance)
+        return 1 / (1 + np.exp(-0.2 * (distance - self._cloud_distance / 2)))
+
+    def opacity_scores(self, opacity):
+        """ Return the opacity term of each observation
+
+        Args:
+          opacity (np.ndarray): opacity band shaped (nimage, nrow, ncol)
+
+        Returns:
+          scores (np.ndarray): scores between 0 and 1
+
+        """
+        low, high = self._opacity_range
+        return np.clip((high - opacity.astype(np.float32)) / (high - low),
+                       0, 1)
+
+    def _read_clear_halo(self, xoff, yoff, xsize, ysize):
+        """ Read clear observations of a chunk and distance to cloud term
+
+        Masks are read with a margin of `_cloud_distance` pixels so clouds
+        just outside the chunk are accounted for.
+
+        """
+        if not any(self.masks):
+            return None, self._weight_cloud
+
+        halo = self._cloud_distance
+        x0, y0 = max(xoff - halo, 0), max(yoff - halo, 0)
+        x1 = min(xoff + xsize + halo, self.ncol)
+        y1 = min(yoff + ysize + halo, self.nrow)
+
+        clear = masks.unpack(self.read_clear_chunk(x0, y0, x1 - x0, y1 - y0),
+                             x1 - x0)
+        cloud = self._weight_cloud * self.cloud_scores(~clear)
+
+        window = (slice(None), slice(yoff - y0, yoff - y0 + ysize),
+                  slice(xoff - x0, xoff - x0 + xsize))
+        return clear[window], cloud[window]
+
+    def process_chunk(self, xoff, yoff, xsize, ysize):
+        """ Process a chunk of an image
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns to process
+          ysize (int): number of rows to process
+
+        Returns:
+          composite (np.ndarray): composited chunk, followed by any summary
+            bands, shaped (out_nband, ysize, xsize)
+
+        """
+        if getattr(self, '_image_scores', None) is None or \
+                len(self._image_scores) != len(self.images):
+            self.prepare()
+
+        clear, cloud = self._read_clear_halo(xoff, yoff, xsize, ysize)
+        cube, _ = self.read_masked_chunk(
+            xoff, yoff, xsize, ysize,
+            clear=None if clear is None else masks.pack(clear))
+
+        score = self._image_scores[:, np.newaxis, np.newaxis] + cloud
+        if self._opacity_band:
+            score = score + self._weight_opacity * self.opacity_scores(
+                cube[:, self._opacity_band - 1])
+
+        invalid = (cube == self._ndv).any(axis=1)
+        if clear is not None:
+            invalid |= ~clear
+        score = np.where(invalid, -np.inf, score)
+
+        best = kernels.select_max(score, -np.inf)
+        rows, cols = np.indices(best.shape)
+        composite = np.rollaxis(cube[np.maximum(best, 0), :, rows, cols], 2)
+        composite = np.ascontiguousarray(composite)
+        composite[:, best < 0] = self._ndv
+
+        return self.append_summary(composite, ~invalid, score)
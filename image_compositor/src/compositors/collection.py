@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*
+""" collection.py
+
+Columnar collection of images and what is known about them
+
+`ImageCollection` keeps one NumPy array per attribute of the images, rather
+than a list of per-image objects or several lists kept in step, so that
+selecting images by date, sorting and removing duplicates are vectorized
+operations that return a new collection. Columns not yet known are filled
+with NaT, NaN, 0 or `UNKNOWN`.
+
+Dates and sensors are parsed from filenames (see `dates.py`) the first time
+they are needed, unless given. Geo-transforms, sizes and band counts are
+filled by `describe`, or by `Compositor.validate_images` for the valid
+images it keeps.
+
+Collections pickle as a handful of arrays plus one string of all paths, so
+sending one to worker processes is cheap.
+
+"""
+import logging
+import os
+
+import numpy as np
+from osgeo import gdal
+
+import dates as _dates
+import remote
+
+gdal.AllRegister()
+gdal.UseExceptions()
+
+logger = logging.getLogger('image_compositor')
+
+#: Validity of an image before it has been checked
+UNKNOWN = -1
+
+# Separates paths when pickled; paths cannot contain NUL
+_SEP = '\0'
+
+
+class ImageCollection(object):
+    """ Array-backed columns describing images
+
+    Args:
+      paths (list): filenames of images
+      dates (array-like, optional): acquisition dates as `datetime64[D]`
+        (default: parsed from filenames when first used)
+      sensors (array-like, optional): sensor of each image, or None if
+        unknown (default: parsed from filenames when first used)
+
+    Attributes:
+      paths (np.ndarray): filenames of images
+      dates (np.ndarray): acquisition dates as `datetime64[D]`, NaT if
+        unknown
+      sensors (np.ndarray): sensor of each image, or None if unknown
+      geo_transforms (np.ndarray): geo-transform of each image shaped
+        (n, 6), NaN if unknown
+      sizes (np.ndarray): number of columns and rows of each image shaped
+        (n, 2), 0 if unknown
+      nbands (np.ndarray): number of bands of each image, 0 if unknown
+      valid (np.ndarray): 1 if the image is valid, 0 if not, or `UNKNOWN`
+
+    """
+
+    def __init__(self, paths=(), dates=None, sensors=None):
+        self.paths = np.empty(len(paths), dtype=object)
+        self.paths[:] = list(paths)
+        n = self.paths.size
+
+        self._dates = None if dates is None else \
+            np.asarray(dates, dtype='datetime64[D]')
+        self._sensors = None if sensors is None else \
+            np.asarray(sensors, dtype=object)
+        self.geo_transforms = np.full((n, 6), np.nan)
+        self.sizes = np.zeros((n, 2), dtype=np.int32)
+        self.nbands = np.zeros(n, dtype=np.int16)
+        self.valid = np.full(n, UNKNOWN, dtype=np.int8)
+
+    @classmethod
+    def from_images(cls, images):
+        """ Return images as a collection, if not already one
+
+        Args:
+          images (list or ImageCollection): filenames of images
+
+        Returns:
+          ImageCollection: collection of images
+
+        """
+        if isinstance(images, cls):
+            return images
+        return cls(images)
+
+    @classmethod
+    def concatenate(cls, collections):
+        """ Return a collection of the images of several collections
+
+        Args:
+          collections (list): collections to concatenate, in order
+
+        Returns:
+          ImageCollection: collection of all images
+
+        """
+        new = cls(np.concatenate([c.paths for c in collections]),
+                  dates=np.concatenate([c.dates for c in collections]),
+                  sensors=np.concatenate([c.sensors for c in collections]))
+        for name in ('geo_transforms', 'sizes', 'nbands', 'valid'):
+            setattr(new, name, np.concatenate([getattr(c, name)
+                                               for c in collections]))
+        return new
+
+    def __len__(self):
+        return self.paths.size
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __contains__(self, image):
+        return bool((self.paths == image).any())
+
+    def __repr__(self):
+        return 'ImageCollection({n} images)'.format(n=len(self))
+
+    def __getitem__(self, key):
+        """ Return a path by position, or a collection of selected images
+
+        Args:
+          key (int, slice or array-like): position of an image, or a slice,
+            boolean mask or positions of images to select
+
+        Returns:
+          str or ImageCollection: path of one image, or collection of the
+            images selected
+
+        """
+        if isinstance(key, (int, np.integer)):
+            return self.paths[key]
+
+        if not isinstance(key, slice):
+            key = np.asarray(key)
+            if key.dtype != bool:
+                key = key.astype(np.intp)
+        new = ImageCollection(self.paths[key],
+                              dates=None if self._dates is None else
+                              self._dates[key],
+                              sensors=None if self._sensors is None else
+                              self._sensors[key])
+        new.geo_transforms = self.geo_transforms[key]
+        new.sizes = self.sizes[key]
+        new.nbands = self.nbands[key]
+        new.valid = self.valid[key]
+        return new
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['paths'] = _SEP.join(self.paths)
+        if self._sensors is not None:
+            state['_sensors'] = _SEP.join(s or '' for s in self._sensors)
+        return state
+
+    def __setstate__(self, state):
+        paths = state.pop('paths')
+        self.__dict__.update(state)
+        self.paths = np.empty(self.valid.size, dtype=object)
+        self.paths[:] = paths.split(_SEP) if self.valid.size else []
+        if self._sensors is not None:
+            sensors = self._sensors.split(_SEP) if self.valid.size else []
+            self._sensors = np.array([s or None for s in sensors],
+                                     dtype=object)
+
+    def _parse(self):
+        """ Parse dates and sensors not given from filenames """
+        dates, sensors = _dates.parse_filenames(self.paths.tolist())
+        if self._dates is None:
+            self._dates = dates
+        if self._sensors is None:
+            self._sensors = sensors
+
+    @property
+    def dates(self):
+        """ np.ndarray: acquisition dates as `datetime64[D]` """
+        if self._dates is None:
+            self._parse()
+        return self._dates
+
+    @dates.setter
+    def dates(self, dates):
+        self._dates = np.asarray(dates, dtype='datetime64[D]')
+
+    @property
+    def sensors(self):
+        """ np.ndarray: sensor of each image, or None if unknown """
+        if self._sensors is None:
+            self._parse()
+        return self._sensors
+
+    @property
+    def names(self):
+        """ np.ndarray: filename of each image without its directory """
+        names = np.empty(len(self), dtype=object)
+        names[:] = [os.path.basename(p) for p in self.paths]
+        return names
+
+    @property
+    def footprints(self):
+        """ np.ndarray: bounds of each image as (min x, min y, max x,
+        max y) shaped (n, 4), NaN if not known
+        """
+        gt = self.geo_transforms
+        x = (gt[:, 0], gt[:, 0] + gt[:, 1] * self.sizes[:, 0])
+        y = (gt[:, 3], gt[:, 3] + gt[:, 5] * self.sizes[:, 1])
+        footprints = np.column_stack((np.minimum(*x), np.minimum(*y),
+                                      np.maximum(*x), np.maximum(*y)))
+        footprints[self.nbands == 0] = np.nan
+        return footprints
+
+    def between(self, start=None, end=None):
+        """ Return images acquired within a date range
+
+        Images without a known date are excluded.
+
+        Args:
+          start (str, date or np.datetime64, optional): first date to
+            include (e.g., '2000-01-01')
+          end (str, date or np.datetime64, optional): last date to include
+
+        Returns:
+          ImageCollection: images acquired from `start` to `end`
+
+        """
+        keep = ~_dates.isnat(self.dates)
+        if start is not None:
+            keep &= self.dates >= np.datetime64(start, 'D')
+        if end is not None:
+            keep &= self.dates <= np.datetime64(end, 'D')
+        return self[keep]
+
+    def argsort(self):
+        """ Return order of images by date, then path, unknown dates last """
+        # NaT sorts first in older NumPy, so sort on an explicit key
+        return np.lexsort((self.paths.astype(str),
+                           self.dates.view(np.int64),
+                           _dates.isnat(self.dates)))
+
+    def sorted(self):
+        """ Return images sorted by date, then path, unknown dates last """
+        return self[self.argsort()]
+
+    def unique(self):
+        """ Return images without duplicate paths, keeping the first """
+        _, first = np.unique(self.paths.astype(str), return_index=True)
+        return self[np.sort(first)]
+
+    def describe(self, datasets=None):
+        """ Read geo-transform, size and band count of images not yet known
+
+        Images that cannot be opened are left unknown.
+
+        Args:
+          datasets (DatasetPool, optional): pool to open images with
+            (default: open and close each image)
+
+        """
+        for i in np.flatnonzero(self.nbands == 0):
+            path = self.paths[i]
+            try:
+                if datasets is not None:
+                    ds = datasets.open(path)
+                else:
+                    ds = gdal.Open(remote.vsi_path(path), gdal.GA_ReadOnly)
+            except RuntimeError:
+                logger.warning('Cannot open image {i}'.format(i=path))
+                continue
+            self.geo_transforms[i] = ds.GetGeoTransform()
+            self.sizes[i] = ds.RasterXSize, ds.RasterYSize
+            self.nbands[i] = ds.RasterCount
+            ds = None
@@ -1,10 +1,26 @@
 # -*- coding: utf-8 -*
 
+from __future__ import division
+
 import abc
 import logging
+import os
 
 import numpy as np
 from osgeo import gdal
+from osgeo import gdal_array
+
+from collection import ImageCollection
+from datasets import DatasetPool, READ_DATASET, read_strategy
+from validation import ImageValidator
+from writers import GDALWriter, MultiWriter, TileWriter
+import index_cache
+import kernels
+import masks
+import parallel
+import profiling
+import threads
+import warping
 
 gdal.AllRegister()
 gdal.UseExceptions()
@@ -24,6 +40,56 @@ class Compositor(object):
       files (list): list of filenames to be used in composite
       input_info (list): list of variables requiring user input
       input_info_str (list): associated labels for required user inputs
+      collection (ImageCollection): images found valid by
+        `validate_images`, with the geo-transform, size and number of bands
+        each is read with
+      images (list): filenames of the images in `collection`
+      offsets (list): column and row offset of each valid image within the
+        composite grid
+      sizes (list): number of columns and rows of each valid image
+      read_strategies (list): how windows of each valid image are read (see
+        `datasets.read_strategy`)
+      chunk_size (tuple): target number of columns and rows to process at
+        once; rounded to a multiple of the base image's block size
+      kernel_backend (str): pixel selection kernel backend, or None to use
+        the fastest available (see `kernels.BACKENDS`)
+      executor (str): how chunks are processed when using more than one
+        CPU, either 'process' for a pool of processes (see `parallel.py`)
+        or 'thread' for a pool of threads (see `threads.py`)
+      chunk_order (str): order chunks are dispatched in when using more
+        than one CPU, either 'cost' for most expensive first or 'rows' for
+        the order of `iter_chunks` (see `scheduling.schedule`)
+      reuse_buffers (bool): read chunks of the image stack into the same
+        scratch buffer each time, rather than a new array (see `_scratch`)
+      masks (list): mask filename and band number for each valid image, or
+        None if the image is not masked
+      mask_input_info (list): user inputs describing masks, which
+        subclasses may add to `input_info`
+      warp_input_info (list): user inputs choosing whether images with a
+        different projection, pixel size or posting than the base image are
+        warped to its grid, and the resampling method (see `warping.py`),
+        which subclasses may add to `input_info`
+      warp_error (float): maximum error, in pixels, of the approximated
+        transformer used when warping
+      summary_input_info (list): user input choosing whether to write
+        summary outputs of the valid observations of each pixel (see
+        `summary_bands`), which subclasses may add to `input_info`
+      sources (list): filename or warped VRT that each valid image is read
+        from
+      max_open_datasets (int): maximum number of datasets kept open at once
+        by each process (see `datasets.DatasetPool`)
+      scale (int): decimation factor of the composite grid (e.g., 8 to
+        composite at 1/8 of the resolution of the base image); reads use
+        overviews of the images where available (see `preview`)
+      index_cache (IndexCache): cache of per-image scores used by selection
+        composites instead of their scoring bands, or None to compute
+        scores from the bands (see `index_cache.py`)
+      chunk_cache (ChunkCache): cache of the reads of the chunk being
+        processed, shared with other compositors run over the same images,
+        or None to read each window when needed (see `jobs.py`)
+      stack_store (StackStore): time-major store of the images to read
+        chunks from, rather than from the images, or None to read the
+        images (see `stack_store.py`)
 
     Required methods:
       validate_images: method to validate suitability of images
@@ -34,6 +100,43 @@ class Compositor(object):
 
     __metaclass__ = abc.ABCMeta
 
+    _ndv = -9999
+
+    _mask_band = 0
+    _mask_sidecar = ''
+    _mask_clear = [0, 1]
+
+    mask_input_info = ['_mask_band', '_mask_sidecar', '_mask_clear']
+    mask_input_info_str = ['Mask Band Number (0 for none)',
+                           'Mask File Pattern, "{stem}" for image name '
+                           '(instead of band)',
+                           'Clear Mask Values']
+
+    _warp = False
+    _resampling = 'near'
+
+    warp_input_info = ['_warp', '_resampling']
+    warp_input_info_str = ['Warp Images To Base Grid',
+                           'Warp Resampling Method']
+    warp_error = warping.ERROR_THRESHOLD
+
+    _summary = False
+
+    summary_input_info = ['_summary']
+    summary_input_info_str = ['Write Summary Outputs']
+
+    chunk_size = (256, 256)
+    kernel_backend = None
+    executor = 'process'
+    chunk_order = 'cost'
+    reuse_buffers = False
+    max_open_datasets = 64
+    index_cache = None
+    chunk_cache = None
+    stack_store = None
+    _stack_index = None
+    scale = 1
+
     def __repr__(self):
         return "A compositing algorithm"
 
@@ -60,7 +163,7 @@ class Compositor(object):
             posting, and the number of bands
 
         """
-        ds = gdal.Open(image, gdal.GA_ReadOnly)
+        ds = self._open(image)
         proj = ds.GetProjection()
 
         gt = ds.GetGeoTransform()
@@ -76,82 +179,855 @@ class Compositor(object):
 
         return (proj, px_size, py_size, ul_x, ul_y, nband)
 
-    def validate_images(self, images):
+    @property
+    def datasets(self):
+        """ DatasetPool: pool of datasets opened by this process """
+        if getattr(self, '_datasets', None) is None:
+            self._datasets = DatasetPool(self.max_open_datasets)
+        return self._datasets
+
+    def _open(self, filename):
+        """ Open a dataset as read-only
+
+        Args:
+          filename (str): filename of dataset
+
+        Returns:
+          ds (gdal.Dataset): opened dataset
+
+        """
+        return self.datasets.open(filename)
+
+    def required_bands(self):
+        """ Return band numbers, starting at 1, read by the algorithm
+
+        Subclasses add the bands their selection depends on.
+
+        Returns:
+          bands (list): band numbers required to be in each image
+
+        """
+        if self._mask_band and not self._mask_sidecar:
+            return [self._mask_band]
+        return []
+
+    def requirements(self):
+        """ Return algorithm settings that affect which images are valid
+
+        Images are re-validated by `ImageValidator` when these change.
+
+        Returns:
+          requirements (tuple): hashable requirements of the algorithm
+
+        """
+        return (tuple(self.required_bands()),
+                self._mask_band, self._mask_sidecar, tuple(self._mask_clear),
+                self._warp, self._resampling, self.warp_error, self._ndv)
+
+    @profiling.profiled('validate_images')
+    def validate_images(self, images, validator=None):
         """ Validates which images in self.files can be used for composites
 
-        The default compositing algorithm implementation will not perform
-        any resampling or reprojections.
+        Unless images are warped to the grid of the base image (see
+        `warp_input_info`), no resampling or reprojection is performed.
 
         Thus, the default validation ensures all images have:
-            - common projection
-            - common pixel size
-            - common pixel postings (e.g., offset by whole number of pixels)
+            - common projection, unless warped
+            - common pixel size, unless warped
+            - common pixel postings (e.g., offset by whole number of
+              pixels), unless warped
             - common number of bands
+            - the bands required by the algorithm
+            - a mask, if a mask band or sidecar file pattern is given
 
         Args:
-          images (list): list of filenames for images to be validated
+          images (list or ImageCollection): filenames of images to be
+            validated, or a collection whose `valid` column is set
+          validator (ImageValidator, optional): validator remembering
+            images already checked, so only new images are opened
 
         Returns:
           valid (list): True or False for each file in self.file if file is
             usable within the algorithm
 
         """
-        valid = []
-        # Get attributes from first image
-        for image in images:
-            try:
-                self.proj, \
-                    self.px_size, self.py_size, \
-                    self.ul_x, self.ul_y, \
-                    self.nband = \
-                    self._get_image_attributes(images)
-            except ValueError:
-                valid.append(False)
+        if validator is None:
+            validator = ImageValidator()
+        collection = ImageCollection.from_images(images)
+        valid = validator.check(collection.paths.tolist(), self)
+        collection.valid[:] = valid
+
+        if validator.reference is not None:
+            self.proj, self.nband = validator.reference[0], \
+                validator.reference[-1]
+
+        _images = collection[np.array(valid, dtype=bool)]
+        self._set_grid(_images, [validator.masks[im] for im in _images],
+                       [validator.sources[im] for im in _images])
+
+        return valid
+
+    def _set_grid(self, images, masks=None, sources=None):
+        """ Store composite grid and the location of images within it
+
+        The composite grid matches the first valid image. Other images are
+        placed within it by their whole pixel offsets.
+
+        Args:
+          images (list or ImageCollection): valid images
+          masks (list, optional): mask of each valid image
+          sources (list, optional): filename or warped VRT to read each
+            valid image from (default: `images`)
+
+        """
+        self.collection = ImageCollection.from_images(images)
+        self.images = self.collection.paths.tolist()
+        self._stack_index = None
+        self.masks = masks or [None] * len(self.images)
+        self.sources = sources or list(self.images)
+        self._warped = self.sources != self.images
+        self.offsets = []
+        self.sizes = []
+        self.read_strategies = []
+        self._reverse = False
+        self._index_files = None
+        if not self.images:
+            return
+
+        ds = self._open(self.sources[0])
+        self.grid_size = (ds.RasterXSize, ds.RasterYSize)
+        self.grid_transform = ds.GetGeoTransform()
+        band = ds.GetRasterBand(1)
+        self.gdal_dtype = band.DataType
+        self.dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+        self.block_size = tuple(band.GetBlockSize())
+        ds = None
+
+        collection = self.collection
+        for i, (image, source) in enumerate(zip(self.images, self.sources)):
+            ds = self._open(source)
+            collection.geo_transforms[i] = ds.GetGeoTransform()
+            collection.sizes[i] = ds.RasterXSize, ds.RasterYSize
+            collection.nbands[i] = ds.RasterCount
+            # Warped VRTs warp all bands of a window at once
+            self.read_strategies.append(
+                READ_DATASET if source != image else
+                read_strategy(ds, image))
+            ds = None
+
+        gt = self.grid_transform
+        offsets = np.round((collection.geo_transforms[:, [0, 3]] -
+                            [gt[0], gt[3]]) / [gt[1], gt[5]]).astype(int)
+        self.offsets = [tuple(o) for o in offsets.tolist()]
+        self.sizes = [tuple(s) for s in collection.sizes.tolist()]
+
+    def __getstate__(self):
+        # Filenames are pickled once, as part of the collection
+        state = self.__dict__.copy()
+        state.pop('_buffer', None)
+        state.pop('_stack_chunks', None)
+        if 'collection' in state:
+            del state['images']
+            if state['sources'] == self.images:
+                state['sources'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'collection' in state:
+            self.images = self.collection.paths.tolist()
+            if self.sources is None:
+                self.sources = list(self.images)
+
+    @property
+    def ncol(self):
+        """ int: number of columns of the composite at `scale` """
+        return max(self.grid_size[0] // self.scale, 1)
+
+    @property
+    def nrow(self):
+        """ int: number of rows of the composite at `scale` """
+        return max(self.grid_size[1] // self.scale, 1)
+
+    @property
+    def geo_transform(self):
+        """ tuple: geo-transform of the composite at `scale` """
+        gt = self.grid_transform
+        return (gt[0], gt[1] * self.scale, gt[2],
+                gt[3], gt[4], gt[5] * self.scale)
+
+    def iter_chunks(self):
+        """ Yield chunks of the composite grid to process
+
+        Chunk sizes are rounded to whole multiples of the base image's block
+        size so each block is decoded once per chunk.
+
+        Yields:
+          chunk (tuple): x offset, y offset, number of columns and rows
+
+        """
+        xsize, ysize = [min(max(1, int(round(target / block))) * block, n)
+                        for target, block, n in zip(self.chunk_size,
+                                                    self.block_size,
+                                                    (self.ncol, self.nrow))]
+
+        for yoff in range(0, self.nrow, ysize):
+            for xoff in range(0, self.ncol, xsize):
+                yield (xoff, yoff,
+                       min(xsize, self.ncol - xoff),
+                       min(ysize, self.nrow - yoff))
+
+    def _image_window(self, index, xoff, yoff, xsize, ysize):
+        """ Return window of a chunk within an image, clipped to the image
+
+        Chunks are located on the composite grid at `scale`, where a pixel
+        is covered by an image only if all of the image pixels it spans are.
+
+        Args:
+          index (int): index of image within `images`
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns in chunk
+          ysize (int): number of rows in chunk
+
+        Returns:
+          window (tuple): x and y offset of window within the image, the
+            number of columns and rows of the chunk it covers (spanning
+            `scale` times as many image pixels) and its x and y offset
+            within the chunk, or None if the image does not overlap the
+            chunk
+
+        """
+        col_off, row_off = self.offsets[index]
+        ncol, nrow = self.sizes[index]
+        scale = self.scale
+
+        # Pixels of the scaled grid covered entirely by the image
+        x0 = max(xoff, -(-col_off // scale))
+        y0 = max(yoff, -(-row_off // scale))
+        x1 = min(xoff + xsize, (col_off + ncol) // scale)
+        y1 = min(yoff + ysize, (row_off + nrow) // scale)
+        if x1 <= x0 or y1 <= y0:
+            return None
+
+        return (x0 * scale - col_off, y0 * scale - row_off,
+                x1 - x0, y1 - y0,
+                x0 - xoff, y0 - yoff)
+
+    def _read_window(self, filename, band, window):
+        """ Read a window of a band, decimated to `scale`
+
+        Args:
+          filename (str): filename of dataset
+          band (int): band number, starting at 1
+          window (tuple): window returned by `_image_window`
+
+        Returns:
+          data (np.ndarray): band values shaped (ny, nx) of the window
+
+        """
+        x0, y0, nx, ny = window[:4]
+        return self._cached_read(
+            (filename, band, x0, y0, nx, ny, self.scale),
+            lambda: self.datasets.band(filename, band).ReadAsArray(
+                x0, y0, nx * self.scale, ny * self.scale,
+                buf_xsize=nx, buf_ysize=ny))
+
+    def _cached_read(self, key, read):
+        """ Return a read from the `chunk_cache`, if any, or read it
+
+        Args:
+          key (tuple): hashable description of the read
+          read (callable): function returning the data
+
+        Returns:
+          data: result of `read`, which must not be modified if cached
+
+        """
+        if self.chunk_cache is None:
+            return read()
+        return self.chunk_cache.get(key, read)
+
+    def _read_stack(self, name, xoff, yoff, xsize, ysize):
+        """ Read a chunk of all images of the `stack_store`, once per chunk
+
+        The last chunk read of each array is kept, so that reading each
+        image of a chunk in turn (e.g., by `read_image_chunk`) reads the
+        store once rather than once per image and band. Reads are shared
+        through the `chunk_cache` too, if any.
+
+        Args:
+          name (str): 'data' for image values or 'clear' for clear
+            observations
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns to read
+          ysize (int): number of rows to read
+
+        Returns:
+          np.ndarray: chunk of the store, which must not be modified
+
+        """
+        key = (self.stack_store.path, name, xoff, yoff, xsize, ysize)
+        chunks = getattr(self, '_stack_chunks', None)
+        if chunks is None:
+            chunks = self._stack_chunks = {}
+        last = chunks.get(name)
+        if last is None or last[0] != key:
+            read = (self.stack_store.read if name == 'data' else
+                    self.stack_store.read_clear)
+            last = chunks[name] = (
+                key, self._cached_read(
+                    key, lambda: read(xoff, yoff, xsize, ysize)))
+        return last[1]
+
+    def _read_order(self, xoff, yoff, xsize, ysize):
+        """ Return indexes of images overlapping a chunk in the order to read
+
+        Images that do not overlap the chunk are never opened. The order
+        alternates direction on each call so that the datasets most
+        recently used by one pass over the images are the first used by the
+        next, rather than the first evicted from the `DatasetPool`.
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns in chunk
+          ysize (int): number of rows in chunk
+
+        Returns:
+          order (list): indexes of images within `images`
+
+        """
+        order = [i for i in range(len(self.images))
+                 if self._image_window(i, xoff, yoff, xsize, ysize)]
+        self._reverse = not self._reverse
+        if self._reverse:
+            order.reverse()
+        return order
+
+    def read_chunk(self, xoff, yoff, xsize, ysize):
+        """ Read a chunk of all valid images
+
+        Areas of the chunk not covered by an image or masked as not clear
+        are filled with the NoDataValue.
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns to read
+          ysize (int): number of rows to read
+
+        Returns:
+          cube (np.ndarray): chunk of image stack shaped
+            (nimage, nband, ysize, xsize)
+
+        """
+        cube, clear = self.read_masked_chunk(xoff, yoff, xsize, ysize)
+        if clear is not None:
+            cloudy = ~masks.unpack(clear, xsize)
+            for i in range(len(self.images)):
+                cube[i][:, cloudy[i]] = self._ndv
+
+        return cube
+
+    def _scratch(self, shape):
+        """ Return an uninitialized array for a chunk of the image stack
+
+        If `reuse_buffers`, the array is a view of one buffer grown as
+        needed and reused by each call, so it must not be used once the next
+        chunk is read.
+
+        Args:
+          shape (tuple): shape of the array
+
+        Returns:
+          np.ndarray: uninitialized array of `dtype`
+
+        """
+        if not self.reuse_buffers:
+            return np.empty(shape, dtype=self.dtype)
+
+        size = int(np.prod(shape))
+        buf = getattr(self, '_buffer', None)
+        if buf is None or buf.size < size or buf.dtype != self.dtype:
+            buf = self._buffer = np.empty(size, dtype=self.dtype)
+        return buf[:size].reshape(shape)
+
+    def read_masked_chunk(self, xoff, yoff, xsize, ysize, clear=None):
+        """ Read a chunk of all valid images and their masks
+
+        Masks are read first and images without any clear pixels within the
+        chunk are not read, leaving them filled with the NoDataValue.
+        Observations masked as not clear are otherwise left as read.
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns to read
+          ysize (int): number of rows to read
+          clear (np.ndarray, optional): bit-packed clear observations of the
+            chunk, if already read (see `read_clear_chunk`)
+
+        Returns:
+          tuple: chunk of image stack shaped (nimage, nband, ysize, xsize)
+            and bit-packed clear observations (see `masks.pack`), or None
+            if no images are masked
+
+        """
+        if clear is None:
+            clear = self.read_clear_chunk(xoff, yoff, xsize, ysize)
+        if self._stack_index is not None:
+            cube = self._read_stack('data', xoff, yoff, xsize, ysize)
+            return cube[self._stack_index], clear
+
+        cube = self._scratch((len(self.images), self.nband, ysize, xsize))
+
+        read = np.zeros(len(self.images), dtype=bool)
+        for i in self._read_order(xoff, yoff, xsize, ysize):
+            if clear is not None and not clear[i].any():
+                profiling.count('reads_skipped')
+                continue
+            self.read_image_chunk(i, xoff, yoff, xsize, ysize, out=cube[i])
+            read[i] = True
+        cube[~read] = self._ndv
+
+        return cube, clear
+
+    def read_clear_chunk(self, xoff, yoff, xsize, ysize):
+        """ Read clear observations of all valid images within a chunk
+
+        Images without a mask are clear wherever they have data. Areas of
+        the chunk not covered by an image are not clear.
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns to read
+          ysize (int): number of rows to read
+
+        Returns:
+          clear (np.ndarray): bit-packed clear observations shaped
+            (nimage, ysize, ceil(xsize / 8)), or None if no images are
+            masked
+
+        """
+        if not any(self.masks):
+            return None
+        if self._stack_index is not None:
+            clear = self._read_stack('clear', xoff, yoff, xsize, ysize)
+            return masks.pack(clear[self._stack_index])
+
+        clear = np.zeros((len(self.images), ysize, xsize), dtype=bool)
+        for i in self._read_order(xoff, yoff, xsize, ysize):
+            window = self._image_window(i, xoff, yoff, xsize, ysize)
+            nx, ny, cx, cy = window[2:]
+            if self.masks[i] is None:
+                clear[i, cy:cy + ny, cx:cx + nx] = True
+                continue
+
+            filename, band = self.masks[i]
+            with profiling.stage('read_mask'):
+                mask = self._read_window(filename, band, window)
+            profiling.count('bytes_read', mask.nbytes)
+            clear[i, cy:cy + ny, cx:cx + nx] = masks.clear_from_mask(
+                mask, self._mask_clear)
+
+        return masks.pack(clear)
+
+    def read_image_chunk(self, index, xoff, yoff, xsize, ysize,
+                         bands=None, out=None):
+        """ Read a chunk of one valid image
+
+        Areas of the chunk not covered by the image are filled with the
+        NoDataValue.
+
+        Args:
+          index (int): index of image within `images`
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns to read
+          ysize (int): number of rows to read
+          bands (list, optional): band indexes to read (default: all)
+          out (np.ndarray, optional): array to read into, shaped
+            (nband, ysize, xsize)
+
+        Returns:
+          chunk (np.ndarray): chunk of image shaped (nband, ysize, xsize)
+
+        """
+        if bands is None:
+            bands = range(self.nband)
+        if out is None:
+            out = np.empty((len(bands), ysize, xsize), dtype=self.dtype)
+        if self._stack_index is not None:
+            cube = self._read_stack('data', xoff, yoff, xsize, ysize)
+            out[:] = cube[self._stack_index[index], list(bands)]
+            return out
+
+        window = self._image_window(index, xoff, yoff, xsize, ysize)
+        if window is None:
+            out.fill(self._ndv)
+            return out
+
+        x0, y0, nx, ny, cx, cy = window
+        if (nx, ny) != (xsize, ysize):
+            out.fill(self._ndv)
+
+        image = self.sources[index]
+        with profiling.stage('read'):
+            if len(bands) > 1 and \
+                    self.read_strategies[index] == READ_DATASET:
+                # Decode each pixel-interleaved block once, or let GDAL
+                # merge the byte ranges of all bands of remote images
+                data = self._cached_read(
+                    (image, tuple(bands), x0, y0, nx, ny, self.scale),
+                    lambda: self.datasets.open(image).ReadRaster(
+                        x0, y0, nx * self.scale, ny * self.scale,
+                        buf_xsize=nx, buf_ysize=ny,
+                        buf_type=self.gdal_dtype,
+                        band_list=[b + 1 for b in bands]))
+                out[:, cy:cy + ny, cx:cx + nx] = np.frombuffer(
+                    data, dtype=self.dtype).reshape(len(bands), ny, nx)
             else:
-                valid.append(True)
-                break
+                for i, b in enumerate(bands):
+                    out[i, cy:cy + ny, cx:cx + nx] = \
+                        self._read_window(image, b + 1, window)
+        profiling.count('bytes_read', len(bands) * nx * ny * out.itemsize)
 
-        for image in images[len(valid):]:
-            _valid = True
+        return out
 
-            _proj, _px, _py, _ul_x, _ul_y, _nband = \
-                self._get_image_attributes(image)
+    def index_bands(self):
+        """ Return the bands and score used to select observations
 
-            if _proj != self.proj:
-                logger.warning('Image {i} has different projection than base \
-                    image'.format(i=image))
-                _valid = False
+        Selection composites override this to use `select_best_chunk`.
 
-            if _px != self.px_size or _py != self.py_size:
-                logger.warning('Image {i} has different pixel size than base \
-                    image'.format(i=image))
-                _valid = False
+        Returns:
+          tuple: band numbers, starting at 1, of the first and second bands
+            of the score and the score name (see `kernels.select_best`), or
+            None if the algorithm does not select by score
 
-            if (self.ul_x - _ul_x) % self.px_size != 0 or \
-                    (self.ul_y - _ul_y) % self.py_size != 0:
-                logger.warning('Image {i} has different posting than base\
-                    image'.format(i=image))
-                _valid = False
+        """
+        return None
 
-            if _nband != self.nband:
-                logger.warning('Image {i} has different number of bands than \
-                    base image'.format(i=image))
-                _valid = False
+    def prepare(self):
+        """ Prepare state shared by all chunks of a run
 
-            valid.append(_valid)
+        Called once before processing, so that anything computed here is
+        sent to workers rather than computed again by each. Subclasses
+        extending this should call the base implementation.
 
-        return valid
+        """
+        self.prepare_index()
+        self.prepare_store()
+
+    def prepare_index(self):
+        """ Build cached scores of the valid images, if using a cache
+
+        Called before processing so that scores are cached once rather than
+        by each worker. Cached scores are on the grid of each image, so they
+        are not used when images are warped.
+
+        """
+        index_bands = self.index_bands()
+        if self.index_cache is None or index_bands is None or self._warped:
+            return
+        if self._index_files is None:
+            b1, b2, score = index_bands
+            self._index_files = self.index_cache.get(self.images, b1, b2,
+                                                     score, self._ndv)
+
+    def prepare_store(self):
+        """ Locate the valid images within the `stack_store`, if any
+
+        Images are read from the store only if all valid images are in it
+        and it was ingested onto the same grid and with the same options
+        (see `StackStore.locate`), and are read from their files otherwise.
+
+        """
+        self._stack_index = None
+        self._stack_chunks = None
+        if self.stack_store is None:
+            return
+        try:
+            self._stack_index = self.stack_store.locate(self)
+        except ValueError as e:
+            logger.warning('Reading images rather than {s}: {e}'.format(
+                s=self.stack_store, e=e))
+        else:
+            logger.debug('Reading {n} images from {s}'.format(
+                n=len(self.images), s=self.stack_store))
 
-    def process_image(self, ncpu=1):
+    def read_index_chunk(self, xoff, yoff, xsize, ysize, clear=None):
+        """ Read a chunk of the cached scores of all valid images
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns to read
+          ysize (int): number of rows to read
+          clear (np.ndarray, optional): bit-packed clear observations (see
+            `read_clear_chunk`); images without any clear pixels within the
+            chunk are not read
+
+        Returns:
+          scores (np.ndarray): scores shaped (nimage, ysize, xsize), equal
+            to `index_cache.NODATA` where not valid
+
+        """
+        self.prepare_index()
+        scores = np.empty((len(self.images), ysize, xsize), dtype=np.int16)
+        scores.fill(index_cache.NODATA)
+
+        for i in self._read_order(xoff, yoff, xsize, ysize):
+            if clear is not None and not clear[i].any():
+                profiling.count('reads_skipped')
+                continue
+            window = self._image_window(i, xoff, yoff, xsize, ysize)
+            nx, ny, cx, cy = window[2:]
+            with profiling.stage('read_index'):
+                scores[i, cy:cy + ny, cx:cx + nx] = self._read_window(
+                    self._index_files[i], 1, window)
+            profiling.count('bytes_read', nx * ny * scores.itemsize)
+
+        return scores
+
+    def select_best_chunk(self, xoff, yoff, xsize, ysize):
+        """ Composite the best scoring observation of each pixel in a chunk
+
+        Scores use the bands given by `index_bands`. If an `index_cache` is
+        used, observations are chosen from the cached scores and only the
+        images chosen for at least one pixel are read. Summary bands, if
+        written, are computed from the same scores (see `append_summary`).
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns to process
+          ysize (int): number of rows to process
+
+        Returns:
+          composite (np.ndarray): composited chunk shaped
+            (out_nband, ysize, xsize)
+
+        """
+        b1, b2, score = self.index_bands()
+
+        if self.index_cache is None or self._warped:
+            cube, clear = self.read_masked_chunk(xoff, yoff, xsize, ysize)
+            if not self._summary:
+                return kernels.select_best(cube, b1 - 1, b2 - 1, self._ndv,
+                                           score=score,
+                                           backend=self.kernel_backend,
+                                           clear=clear)
+            # Keep the scores to summarize
+            scores = kernels.band_score(cube[:, b1 - 1], cube[:, b2 - 1],
+                                        self._ndv, score=score)
+            valid = ~np.isnan(scores)
+            if clear is not None:
+                valid &= masks.unpack(clear, xsize)
+            best = kernels.select_max(np.where(valid, scores, -np.inf),
+                                      -np.inf)
+            composite = kernels.gather(best, lambda i: cube[i], self.nband,
+                                       self._ndv, self.dtype)
+            return self.append_summary(composite, valid, scores)
+
+        clear = self.read_clear_chunk(xoff, yoff, xsize, ysize)
+        scores = self.read_index_chunk(xoff, yoff, xsize, ysize, clear=clear)
+        best = kernels.select_max(scores, index_cache.NODATA, clear=clear)
+
+        composite = kernels.gather(
+            best,
+            lambda i: self.read_image_chunk(i, xoff, yoff, xsize, ysize),
+            self.nband, self._ndv, self.dtype)
+        if not self._summary:
+            return composite
+
+        valid = scores != index_cache.NODATA
+        if clear is not None:
+            valid &= masks.unpack(clear, xsize)
+        return self.append_summary(
+            composite, valid,
+            scores / np.float32(index_cache.SCALES[score]))
+
+    def summary_bands(self):
+        """ Return names of the summary bands written, if any
+
+        Summary outputs count the valid observations of each pixel and, for
+        algorithms selecting observations by a score, the minimum, maximum
+        and mean score of the valid observations (see `kernels.summarize`).
+
+        Returns:
+          bands (list): names of summary bands, or an empty list if summary
+            outputs are not written
+
+        """
+        if not self._summary:
+            return []
+        if self.index_bands() is None:
+            return list(kernels.SUMMARY_BANDS[:1])
+        return list(kernels.SUMMARY_BANDS)
+
+    @property
+    def out_nband(self):
+        """ int: number of bands of composited chunks, including summary
+        bands
+        """
+        return self.nband + len(self.summary_bands())
+
+    @property
+    def out_dtype(self):
+        """ np.dtype: data type of composited chunks, which holds summary
+        bands as float32
+        """
+        if self._summary:
+            return np.result_type(self.dtype, np.float32)
+        return np.dtype(self.dtype)
+
+    def append_summary(self, composite, valid, scores=None):
+        """ Append summary bands to a composited chunk, if written
+
+        Args:
+          composite (np.ndarray): composited chunk shaped
+            (nband, ysize, xsize)
+          valid (np.ndarray): True where an observation is valid, shaped
+            (nimage, ysize, xsize), or the number of valid observations
+            shaped (1, ysize, xsize)
+          scores (np.ndarray, optional): scores of observations shaped
+            (nimage, ysize, xsize), if the algorithm selects by score
+
+        Returns:
+          composite (np.ndarray): composited chunk and summary bands shaped
+            (out_nband, ysize, xsize)
+
+        """
+        if not self._summary:
+            return composite
+        nscore = len(self.summary_bands()) - 1
+        summary = kernels.summarize(valid, scores if nscore else None)
+        return np.concatenate([composite.astype(self.out_dtype),
+                               summary.astype(self.out_dtype, copy=False)])
+
+    def summary_filenames(self, output):
+        """ Return filenames of the summary outputs of an output
+
+        Args:
+          output (str): output filename
+
+        Returns:
+          tuple: filename of the count of valid observations and of the
+            score summary (e.g., "composite_count.tif" and
+            "composite_score.tif" for "composite.tif")
+
+        """
+        root, ext = os.path.splitext(output)
+        return root + '_count' + ext, root + '_score' + ext
+
+    def create_writer(self, output, driver='GTiff', creation_options=None):
+        """ Return a writer for the composite of the validated images
+
+        A VRT output (e.g., "composite.vrt") mosaics one file per chunk,
+        which workers write in parallel (see `writers.TileWriter`).
+
+        Args:
+          output (str): output filename
+          driver (str, optional): GDAL driver for output, or of each tile
+            for VRT output
+          creation_options (list, optional): GDAL creation options for output
+
+        Summary outputs, if written, use the same kind of writer and are
+        named by `summary_filenames`: the count of valid observations as
+        UInt16 and the score summary bands as Float32.
+
+        Returns:
+          writer (GDALWriter, TileWriter or MultiWriter): output writer, or
+            writer of the output and its summary outputs
+
+        Raises:
+          ValueError: raised if no images have been validated
+
+        """
+        if not getattr(self, 'images', None):
+            raise ValueError('No valid images to composite')
+
+        writer = TileWriter if output.lower().endswith('.vrt') else GDALWriter
+
+        def _writer(filename, nband, gdal_dtype, ndv):
+            return writer(filename, self.ncol, self.nrow, nband,
+                          gdal_dtype, self.proj, self.geo_transform, ndv,
+                          driver=driver, creation_options=creation_options)
+
+        summary = self.summary_bands()
+        if not summary:
+            return _writer(output, self.nband, self.gdal_dtype, self._ndv)
+
+        count, score = self.summary_filenames(output)
+        writers = [_writer(output, self.nband, self.gdal_dtype, self._ndv),
+                   _writer(count, 1, gdal.GDT_UInt16, None)]
+        if len(summary) > 1:
+            writers.append(_writer(score, len(summary) - 1, gdal.GDT_Float32,
+                                   float('nan')))
+        return MultiWriter(writers)
+
+    def process_image(self, output, ncpu=1,
+                      driver='GTiff', creation_options=None):
         """ Run compositing algorithm on entire image
 
+        Images must first be validated using `validate_images`.
+
         Args:
+          output (str): output filename
           ncpu (int, optional): number of CPUs to use - determines how to
-            process into chunks
+            process into chunks, using processes or threads depending on
+            `executor`
+          driver (str, optional): GDAL driver for output
+          creation_options (list, optional): GDAL creation options for output
 
         """
         logger.debug('Running algorithm')
-        return
+        self.prepare()
+        writer = self.create_writer(output, driver=driver,
+                                    creation_options=creation_options)
+        try:
+            if ncpu > 1 and self.executor == 'thread':
+                threads.process_chunks(self, writer, ncpu)
+            elif ncpu > 1:
+                parallel.process_chunks(self, writer, ncpu)
+            else:
+                for xoff, yoff, xsize, ysize in self.iter_chunks():
+                    with profiling.stage('process_chunk'):
+                        composite = self.process_chunk(xoff, yoff,
+                                                       xsize, ysize)
+                    profiling.count('chunks')
+                    writer.write(xoff, yoff, composite)
+        finally:
+            writer.close()
+            self.datasets.close()
+
+    def preview(self, output, scale=8, ncpu=1,
+                driver='GTiff', creation_options=None):
+        """ Run compositing algorithm at a reduced resolution
+
+        Images are read from their overviews where available, or decimated
+        using nearest neighbor resampling otherwise, and composited using
+        the same algorithm as `process_image`.
+
+        Args:
+          output (str): output filename
+          scale (int, optional): decimation factor of the composite grid
+          ncpu (int, optional): number of CPUs to use
+          driver (str, optional): GDAL driver for output
+          creation_options (list, optional): GDAL creation options for output
+
+        """
+        _scale = self.scale
+        self.scale = scale
+        try:
+            with profiling.stage('preview'):
+                self.process_image(output, ncpu=ncpu, driver=driver,
+                                   creation_options=creation_options)
+        finally:
+            self.scale = _scale
 
     @abc.abstractmethod
     def process_chunk(self, xoff, yoff, xsize, ysize):
@@ -163,5 +1039,9 @@ class Compositor(object):
           xsize (int): number of columns to process
           ysize (int): number of rows to process
 
+        Returns:
+          composite (np.ndarray): composited chunk, followed by any summary
+            bands (see `append_summary`), shaped (out_nband, ysize, xsize)
+
         """
         return
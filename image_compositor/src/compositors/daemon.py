@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*
+""" daemon.py
+
+Long-running compositing service accepting jobs over a local socket
+
+Each run of the command line interface or of the QGIS dialog otherwise
+imports NumPy and GDAL, opens every image and validates it again. The
+daemon instead stays running and keeps, across jobs:
+
+    - a `DatasetPool` that is not closed between jobs, so images are opened
+      once and the blocks GDAL cached from them are reused
+    - an `ImageValidator` per image stack, so image attributes, masks and
+      warped VRTs are found once
+    - an `IndexCache` per cache directory
+
+Jobs using several CPUs are composited by a pool of threads (see
+`threads.py`) rather than of processes: forking worker processes from the
+daemon, which runs a thread per connection, would copy locks held by other
+threads and the datasets kept open by the pool into the workers.
+Each thread reads using its own copy of the compositor and so its own
+datasets; the kept pool serves validation and jobs using one CPU.
+
+Jobs are queued and run one at a time. Queued jobs compositing the same
+images with the same settings are run together in a single pass (see
+`jobs.JobSet`), so each chunk of the images is read once for all of them.
+
+Requests and replies are single lines of JSON sent over a Unix domain
+socket (by default "image_compositor.sock" in the user's runtime directory,
+or "/tmp/image_compositor-UID.sock") or a TCP socket on the local host
+(e.g., "localhost:8765"). A job request is created by `job_request` and
+sent using `submit`, which waits for the job to finish. The requests
+`{"command": "status"}` and `{"command": "shutdown"}` report on and stop
+the daemon; jobs still queued or running when it stops are abandoned.
+
+Jobs write outputs wherever they ask to, as the user running the daemon.
+Unix domain sockets are created readable and writable by that user only,
+and `submit` refuses to send requests to sockets of other users, but any
+local user can connect to a TCP socket, so TCP sockets should only be used
+on hosts whose users are all trusted.
+
+Files changed since the daemon last saw them are opened and validated
+again. Filenames are resolved by the daemon, so local filenames in
+requests should be absolute.
+
+"""
+from collections import deque
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+from datasets import DatasetPool
+from index_cache import IndexCache
+from jobs import JobSet
+from validation import ImageValidator
+import remote
+
+logger = logging.getLogger('image_compositor')
+
+HAS_UNIX_SOCKETS = hasattr(socket, 'AF_UNIX')
+
+
+def _default_socket():
+    """ Return a Unix domain socket path private to the current user
+
+    The runtime directory of the user (`XDG_RUNTIME_DIR`) is used if set,
+    and otherwise the temporary directory, with the user ID in the name of
+    the socket so that users do not share, or squat, one another's.
+
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'image_compositor.sock')
+    return os.path.join(tempfile.gettempdir(),
+                        'image_compositor-{u}.sock'.format(u=os.getuid()))
+
+
+#: Address used if none is given
+if HAS_UNIX_SOCKETS:
+    DEFAULT_ADDRESS = _default_socket()
+else:
+    DEFAULT_ADDRESS = 'localhost:8765'
+
+#: Hosts the daemon may listen on
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+
+def parse_address(address):
+    """ Return the socket family and address of a daemon
+
+    Args:
+      address (str): path of a Unix domain socket, or "host:port" of a TCP
+        socket on the local host
+
+    Returns:
+      tuple: socket family and the address to bind or connect to
+
+    Raises:
+      ValueError: raised if a TCP address is not on the local host, or if
+        Unix domain sockets are not available
+
+    """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        if host.strip('[]') not in LOCAL_HOSTS:
+            raise ValueError('The daemon only listens on the local host, not '
+                             '"{h}"'.format(h=host))
+        host = host.strip('[]')
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        return family, (host, int(port))
+
+    if not HAS_UNIX_SOCKETS:
+        raise ValueError('Unix domain sockets are not available; use '
+                         '"localhost:PORT" instead')
+    return socket.AF_UNIX, address
+
+
+def job_request(compositor, output, images, ncpu=1,
+                driver='GTiff', creation_options=None):
+    """ Return a request to composite images using a daemon
+
+    Algorithm options are taken from the compositor's `input_info` and
+    local filenames are made absolute.
+
+    Args:
+      compositor (Compositor): algorithm with its options set
+      output (str): output filename
+      images (list): filenames of images
+      ncpu (int, optional): number of CPUs to use
+      driver (str, optional): GDAL driver for output
+      creation_options (list, optional): GDAL creation options for output
+
+    Returns:
+      dict: job request (see `submit`)
+
+    """
+    def _path(filename):
+        if remote.is_remote(filename):
+            return filename
+        return os.path.abspath(filename)
+
+    index_cache = compositor.index_cache
+    return {
+        'algorithm': type(compositor).__name__,
+        'options': dict((name, getattr(compositor, name))
+                        for name in compositor.input_info),
+        'output': _path(output),
+        'images': [_path(image) for image in images],
+        'ncpu': ncpu,
+        'driver': driver,
+        'creation_options': creation_options,
+        'index_cache': index_cache.directory if index_cache else None
+    }
+
+
+def _check_owner(path):
+    """ Raise IOError unless a Unix domain socket belongs to this user
+
+    Requests name images and outputs, so they must not be sent to a socket
+    another user created in its place.
+
+    """
+    try:
+        owner = os.stat(path).st_uid
+    except OSError:
+        return
+    if owner != os.getuid():
+        raise IOError('Socket {p} belongs to another user'.format(p=path))
+
+
+def submit(address, request):
+    """ Send a request to a daemon and wait for its reply
+
+    Args:
+      address (str): address of the daemon (see `parse_address`)
+      request (dict): job request (see `job_request`) or command
+
+    Returns:
+      dict: reply of the daemon; job replies include whether each image
+        was valid as "valid"
+
+    Raises:
+      IOError: raised if the daemon cannot be reached or does not reply
+      RuntimeError: raised if the daemon could not run the job
+
+    """
+    family, _address = parse_address(address)
+    if family == socket.AF_UNIX:
+        _check_owner(_address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(_address)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        line = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+
+    if not line:
+        raise IOError('No reply from compositing daemon at {a}'.format(
+            a=address))
+    reply = json.loads(line.decode('utf-8'))
+    if reply.get('status') != 'ok':
+        raise RuntimeError(reply.get('message', 'Compositing daemon failed'))
+    return reply
+
+
+class _Job(object):
+    """ A queued job request and, once run, its reply """
+
+    def __init__(self, request):
+        self.request = request
+        self.reply = None
+        self._done = threading.Event()
+
+    @property
+    def key(self):
+        """ tuple: settings that jobs must share to run in one pass """
+        request = self.request
+        return (tuple(request.get('images') or ()), request.get('ncpu', 1),
+                request.get('driver', 'GTiff'),
+                tuple(request.get('creation_options') or ()))
+
+    def finish(self, reply):
+        self.reply = reply
+        self._done.set()
+
+    def fail(self, message):
+        self.finish({'status': 'error', 'message': message})
+
+    def wait(self):
+        self._done.wait()
+        return self.reply
+
+
+class CompositingDaemon(object):
+    """ Queue of compositing jobs run using state kept between jobs
+
+    Jobs are run by a background thread; use `serve` to accept jobs over a
+    socket.
+
+    Args:
+      algorithms (list): compositing algorithms that jobs may use
+      max_open_datasets (int, optional): maximum number of datasets kept
+        open (see `datasets.DatasetPool`)
+
+    """
+
+    def __init__(self, algorithms, max_open_datasets=256):
+        self.algorithms = dict((algo.__name__, algo) for algo in algorithms)
+        self.datasets = DatasetPool(max_open_datasets, keep_open=True)
+        self.completed = 0
+        self._validators = {}
+        self._index_caches = {}
+        self._mtimes = {}
+        self._queue = deque()
+        self._running = 0
+        self._condition = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, request):
+        """ Queue a job request
+
+        Args:
+          request (dict): job request (see `job_request`)
+
+        Returns:
+          _Job: queued job, whose `wait` method returns its reply
+
+        """
+        job = _Job(request)
+        with self._condition:
+            self._queue.append(job)
+            self._condition.notify()
+        return job
+
+    def status(self):
+        """ Return a summary of the daemon's state """
+        with self._condition:
+            return {
+                'status': 'ok',
+                'queued': len(self._queue),
+                'running': self._running,
+                'completed': self.completed,
+                'open_datasets': len(self.datasets),
+                'image_stacks': len(self._validators)
+            }
+
+    def _run(self):
+        """ Run queued jobs, together with others sharing their settings """
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                job = self._queue.popleft()
+                batch = [job] + [j for j in self._queue if j.key == job.key]
+                for _job in batch[1:]:
+                    self._queue.remove(_job)
+                self._running = len(batch)
+
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                logger.exception('Compositing daemon failed to run jobs')
+                for _job in batch:
+                    if _job.reply is None:
+                        _job.fail(str(e))
+
+            with self._condition:
+                self._running = 0
+                self.completed += len(batch)
+
+    def _compositor(self, request):
+        """ Return the compositor of a job request with its options set """
+        algo = self.algorithms.get(request.get('algorithm'))
+        if algo is None:
+            raise ValueError('Unknown algorithm "{a}" (choose from '
+                             '{c})'.format(a=request.get('algorithm'),
+                                           c=', '.join(sorted(
+                                               self.algorithms))))
+
+        compositor = algo()
+        for name, value in (request.get('options') or {}).items():
+            if name not in algo.input_info:
+                raise ValueError('Unknown option "{n}" for {a}'.format(
+                    n=name, a=algo.__name__))
+            setattr(compositor, name, value)
+        # Never fork the daemon (see module docstring)
+        compositor.executor = 'thread'
+
+        directory = request.get('index_cache')
+        if directory:
+            if directory not in self._index_caches:
+                self._index_caches[directory] = IndexCache(directory)
+            compositor.index_cache = self._index_caches[directory]
+        compositor._datasets = self.datasets
+        return compositor
+
+    def _changed(self, images):
+        """ Return local images modified since last seen """
+        changed = []
+        for image in images:
+            if remote.is_remote(image):
+                continue
+            try:
+                mtime = os.path.getmtime(image)
+            except OSError:
+                mtime = None
+            if image in self._mtimes and self._mtimes[image] != mtime:
+                changed.append(image)
+            self._mtimes[image] = mtime
+        return changed
+
+    def _validator(self, images):
+        """ Return the validator of an image stack, forgetting changes
+
+        The reference grid of a validator is its first image, so stacks
+        are told apart by their first image.
+
+        """
+        changed = self._changed(images)
+        if changed:
+            logger.debug('Revalidating {n} changed images'.format(
+                n=len(changed)))
+            for validator in self._validators.values():
+                validator.forget(changed)
+            self.datasets.discard(changed)
+
+        if images[0] not in self._validators:
+            self._validators[images[0]] = ImageValidator()
+        return self._validators[images[0]]
+
+    def _run_batch(self, batch):
+        """ Run jobs sharing images and settings, in one pass if possible """
+        ready = []
+        for job in batch:
+            try:
+                ready.append((job, self._compositor(job.request)))
+            except ValueError as e:
+                job.fail(str(e))
+        if not ready:
+            return
+
+        images = ready[0][0].request.get('images')
+        if not images:
+            for job, _ in ready:
+                job.fail('No images given')
+            return
+        validator = self._validator(images)
+
+        # Jobs without valid images fail alone rather than with the batch
+        runnable = []
+        for job, compositor in ready:
+            valid = compositor.validate_images(images, validator=validator)
+            if any(valid):
+                runnable.append((job, compositor, valid))
+            else:
+                job.fail('No images are valid for {a}'.format(
+                    a=job.request['algorithm']))
+
+        if len(runnable) > 1:
+            jobs = JobSet([(compositor, None)
+                           for _, compositor, _ in runnable])
+            try:
+                # Validated images are remembered by the validator
+                valid = jobs.validate_images(images, validator=validator)
+            except ValueError as e:
+                logger.info('Running jobs separately: {e}'.format(e=e))
+            else:
+                logger.info('Running {n} jobs in one pass'.format(
+                    n=len(runnable)))
+                self._execute(jobs, [job for job, _, _ in runnable], valid)
+                return
+
+        for job, compositor, valid in runnable:
+            self._execute(compositor, [job], [valid])
+
+    def _execute(self, runner, jobs, valid):
+        """ Run a compositor or `JobSet` and reply to its jobs """
+        request = jobs[0].request
+        outputs = [job.request['output'] for job in jobs]
+        try:
+            runner.process_image(
+                outputs if isinstance(runner, JobSet) else outputs[0],
+                ncpu=request.get('ncpu', 1),
+                driver=request.get('driver', 'GTiff'),
+                creation_options=request.get('creation_options'))
+        except Exception as e:
+            logger.exception('Failed to composite {o}'.format(
+                o=', '.join(outputs)))
+            for job in jobs:
+                job.fail(str(e))
+            return
+
+        for job, _valid in zip(jobs, valid):
+            logger.info('Wrote {o}'.format(o=job.request['output']))
+            job.finish({'status': 'ok', 'output': job.request['output'],
+                        'valid': _valid, 'jobs_merged': len(jobs)})
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """ Reads one request and writes its reply """
+
+    def handle(self):
+        daemon = self.server.compositing_daemon
+        command = None
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            command = request.get('command')
+            if command == 'status':
+                reply = daemon.status()
+            elif command == 'shutdown':
+                reply = {'status': 'ok'}
+            else:
+                reply = daemon.submit(request).wait()
+        except Exception as e:
+            reply = {'status': 'error', 'message': str(e)}
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+        if command == 'shutdown':
+            self.wfile.flush()
+            self.server.shutdown()
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _TCP6Server(_TCPServer):
+    address_family = socket.AF_INET6
+
+
+if HAS_UNIX_SOCKETS:
+    class _UnixServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def _remove_stale_socket(path):
+    """ Remove a Unix domain socket left by a daemon no longer running """
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        os.remove(path)
+    else:
+        raise ValueError('A compositing daemon is already listening on '
+                         '{p}'.format(p=path))
+    finally:
+        sock.close()
+
+
+def serve(algorithms, address=DEFAULT_ADDRESS, max_open_datasets=256):
+    """ Run a compositing daemon until it is sent a shutdown command
+
+    Args:
+      algorithms (list): compositing algorithms that jobs may use
+      address (str, optional): address to listen on (see `parse_address`)
+      max_open_datasets (int, optional): maximum number of datasets kept
+        open (see `datasets.DatasetPool`)
+
+    Raises:
+      ValueError: raised if the address is not local or is in use by
+        another daemon
+
+    """
+    family, _address = parse_address(address)
+    if family == socket.AF_UNIX:
+        _remove_stale_socket(_address)
+        # Only the user running the daemon may connect
+        umask = os.umask(0o177)
+        try:
+            server = _UnixServer(_address, _Handler)
+        finally:
+            os.umask(umask)
+    elif family == socket.AF_INET6:
+        server = _TCP6Server(_address, _Handler)
+    else:
+        server = _TCPServer(_address, _Handler)
+    server.compositing_daemon = CompositingDaemon(
+        algorithms, max_open_datasets=max_open_datasets)
+
+    logger.info('Compositing daemon listening on {a}'.format(a=address))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.compositing_daemon.datasets.clear()
+        if family == socket.AF_UNIX and os.path.exists(_address):
+            os.remove(_address)
+    logger.info('Compositing daemon stopped')
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*
+""" dask_backend.py
+
+Optional Dask backend for lazy, distributed compositing
+
+The validated image stack and its composite are exposed as lazy Dask arrays
+whose blocks match the chunks yielded by `Compositor.iter_chunks`, which
+are aligned to the GDAL block size of the base image. Each block of the
+composite is one call to `process_chunk(xoff, yoff, xsize, ysize)`, so the
+unit of work is unchanged and any Dask scheduler - threads, processes or a
+`distributed.Client` spread across several machines - can execute it.
+
+Workers of a distributed cluster must be able to open the images using the
+same filenames (e.g., a shared filesystem or `/vsicurl/` URLs).
+
+GDAL datasets must not be used by more than one thread at once, so each
+worker thread processes chunks using its own copy of the compositor (see
+`threads.py`), made the first time it processes a chunk of a run.
+
+Dask is imported when first used, rather than when the plugin loads.
+
+"""
+import logging
+import threading
+import uuid
+
+import profiling
+from threads import _thread_copy
+
+logger = logging.getLogger('image_compositor')
+
+# Copy of the compositor of the current run used by each worker thread
+_local = threading.local()
+
+
+def _import_dask():
+    """ Return the `dask` and `dask.array` modules
+
+    Raises:
+      ImportError: raised if Dask is not installed
+
+    """
+    try:
+        import dask
+        import dask.array as da
+    except ImportError:
+        raise ImportError('The Dask backend requires "dask[array]"')
+    return dask, da
+
+
+def _worker_compositor(compositor, run):
+    """ Return this thread's copy of the compositor of a run
+
+    Args:
+      compositor (Compositor): algorithm with validated images
+      run (str): token identifying the run, so a copy is made once per
+        thread and run however many times the compositor is unpickled
+
+    Returns:
+      Compositor: copy with its own datasets
+
+    """
+    if getattr(_local, 'run', None) != run:
+        _local.compositor = _thread_copy(compositor)
+        _local.run = run
+    return _local.compositor
+
+
+def _chunk_grid(compositor):
+    """ Return chunk windows of a compositor grouped into rows of chunks """
+    rows = []
+    for window in compositor.iter_chunks():
+        if not rows or rows[-1][0][1] != window[1]:
+            rows.append([])
+        rows[-1].append(window)
+    return rows
+
+
+def _read_chunk(compositor, run, window):
+    # Copied out of the scratch buffer, which the thread's next read reuses
+    return _worker_compositor(compositor, run).read_chunk(*window).copy()
+
+
+def _process_chunk(compositor, run, window):
+    with profiling.stage('process_chunk'):
+        return _worker_compositor(compositor, run).process_chunk(*window)
+
+
+def _write_chunk(compositor, run, writer, window):
+    return writer.write(window[0], window[1],
+                        _process_chunk(compositor, run, window))
+
+
+def stack_array(compositor):
+    """ Return the validated image stack as a lazy Dask array
+
+    Args:
+      compositor (Compositor): algorithm with validated images
+
+    Returns:
+      stack (dask.array.Array): image stack shaped
+        (nimage, nband, nrow, ncol)
+
+    """
+    dask, da = _import_dask()
+    _compositor = dask.delayed(compositor)
+    run = uuid.uuid4().hex
+    shape = (len(compositor.images), compositor.nband)
+
+    return da.block([
+        [da.from_delayed(dask.delayed(_read_chunk)(_compositor, run, window),
+                         shape=shape + (window[3], window[2]),
+                         dtype=compositor.dtype)
+         for window in row]
+        for row in _chunk_grid(compositor)])
+
+
+def composite_array(compositor):
+    """ Return the composite of a compositing algorithm as a lazy Dask array
+
+    Args:
+      compositor (Compositor): algorithm with validated images
+
+    Returns:
+      composite (dask.array.Array): composite, and any summary bands,
+        shaped (out_nband, nrow, ncol)
+
+    """
+    dask, da = _import_dask()
+    compositor.prepare()
+    _compositor = dask.delayed(compositor)
+    run = uuid.uuid4().hex
+
+    return da.block([
+        [da.from_delayed(dask.delayed(_process_chunk)(_compositor, run,
+                                                      window),
+                         shape=(compositor.out_nband,
+                                window[3], window[2]),
+                         dtype=compositor.out_dtype)
+         for window in row]
+        for row in _chunk_grid(compositor)])
+
+
+def process_image(compositor, output, scheduler='threads', batch_size=None,
+                  driver='GTiff', creation_options=None):
+    """ Run compositing algorithm on entire image using a Dask scheduler
+
+    Chunks are computed in batches and gathered back to this process, which
+    writes them to the output. Writers allowing parallel writes (e.g.,
+    `writers.TileWriter`) are instead used by the workers, which only send
+    back the filenames and statistics of the tiles they wrote.
+
+    Args:
+      compositor (Compositor): algorithm with validated images
+      output (str): output filename
+      scheduler (str or callable, optional): Dask scheduler name (e.g.,
+        'threads', 'processes' or 'synchronous') or the `get` method of a
+        `distributed.Client`
+      batch_size (int, optional): number of chunks computed at once
+        (default: 4 times the number of chunks in one row of chunks)
+      driver (str, optional): GDAL driver for output
+      creation_options (list, optional): GDAL creation options for output
+
+    """
+    dask, _ = _import_dask()
+    grid = _chunk_grid(compositor)
+    windows = [window for row in grid for window in row]
+    batch_size = batch_size or 4 * len(grid[0])
+
+    compositor.prepare()
+    _compositor = dask.delayed(compositor)
+    run = uuid.uuid4().hex
+    writer = compositor.create_writer(output, driver=driver,
+                                      creation_options=creation_options)
+    try:
+        if writer.parallel:
+            _writer = dask.delayed(writer)
+            tiles = dask.compute(
+                *[dask.delayed(_write_chunk)(_compositor, run, _writer,
+                                            window)
+                  for window in windows],
+                scheduler=scheduler)
+            for tile in tiles:
+                writer.add_tile(tile)
+            return
+
+        for i in range(0, len(windows), batch_size):
+            batch = windows[i:i + batch_size]
+            results = dask.compute(
+                *[dask.delayed(_process_chunk)(_compositor, run, window)
+                  for window in batch],
+                scheduler=scheduler)
+            for (xoff, yoff, _, _), result in zip(batch, results):
+                writer.write(xoff, yoff, result)
+    finally:
+        writer.close()
+        compositor.datasets.close()
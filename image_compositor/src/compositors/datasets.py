@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*
+""" datasets.py
+
+Pool of open GDAL datasets shared by the reads of a compositing run
+
+Opening a GeoTIFF parses its header and IFDs, which is expensive to repeat
+for every image of every chunk, but keeping every image of a long stack
+open exhausts file descriptors. `DatasetPool` keeps at most `maxsize`
+datasets, and their band objects, open and closes the least recently used
+dataset when full.
+
+Remote images (see `remote.py`) hold no file descriptors, so they are kept
+open for the whole run instead: their headers and IFDs are fetched only once
+per process. Closing the pool at the end of a run also forgets the blocks
+GDAL cached from remote images.
+
+How windows of an image are best read depends on its layout (see
+`read_strategy`): pixel-interleaved blocks hold every band, so all bands of
+a window are read at once and each block is decoded once, while
+band-sequential images are read band by band.
+
+Pools are per process: pickling a pool keeps only its settings, and worker
+processes are given a new pool even when forked (see `parallel.py`), so
+each process reopens datasets as needed. A long-running process (see
+`daemon.py`) may keep its pool open across runs, so datasets and the
+blocks GDAL cached from them are reused by later runs.
+
+"""
+from collections import OrderedDict
+import logging
+import threading
+
+from osgeo import gdal
+
+import profiling
+import remote
+
+gdal.AllRegister()
+gdal.UseExceptions()
+
+logger = logging.getLogger('image_compositor')
+
+#: Read all bands of a window at once
+READ_DATASET = 'dataset'
+#: Read each band of a window separately
+READ_BAND = 'band'
+
+
+def image_layout(ds):
+    """ Return the interleave, block size and compression of a dataset
+
+    Args:
+      ds (gdal.Dataset): opened dataset
+
+    Returns:
+      tuple: interleave ('PIXEL', 'LINE' or 'BAND'), block size as
+        (xsize, ysize) and compression (e.g., 'DEFLATE', or None)
+
+    """
+    structure = ds.GetMetadata('IMAGE_STRUCTURE') or {}
+    return (structure.get('INTERLEAVE', 'BAND').upper(),
+            tuple(ds.GetRasterBand(1).GetBlockSize()),
+            structure.get('COMPRESSION'))
+
+
+def read_strategy(ds, filename=''):
+    """ Return how to read windows of a dataset so each block is decoded once
+
+    Blocks of pixel-interleaved images hold all bands, so reading band by
+    band would decode each block once per band. Remote images are also read
+    all bands at once so the byte ranges of their blocks can be merged into
+    fewer requests (see `remote.py`).
+
+    Args:
+      ds (gdal.Dataset): opened dataset
+      filename (str, optional): filename of dataset
+
+    Returns:
+      str: `READ_DATASET` or `READ_BAND`
+
+    """
+    interleave, block_size, compression = image_layout(ds)
+    if ds.RasterCount > 1 and (interleave == 'PIXEL' or
+                               remote.is_remote(filename)):
+        strategy = READ_DATASET
+    else:
+        strategy = READ_BAND
+    logger.debug('Reading {f} by {s} ({i} interleaved, {bx}x{by} blocks, '
+                 '{c} compression)'.format(f=filename, s=strategy,
+                                           i=interleave.lower(),
+                                           bx=block_size[0], by=block_size[1],
+                                           c=compression or 'no'))
+    return strategy
+
+
+class DatasetPool(object):
+    """ LRU pool of datasets opened as read-only
+
+    Args:
+      maxsize (int, optional): maximum number of open datasets
+      keep_open (bool, optional): keep datasets open when the pool is
+        closed at the end of a run; use `clear` to close them
+
+    """
+
+    def __init__(self, maxsize=64, keep_open=False):
+        self.maxsize = maxsize
+        self.keep_open = keep_open
+        self._datasets = OrderedDict()
+        self._remote = {}
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self._datasets) + len(self._remote)
+
+    def open(self, filename):
+        """ Return an open dataset, opening it if not already open
+
+        Args:
+          filename (str): filename of dataset
+
+        Returns:
+          ds (gdal.Dataset): opened dataset
+
+        """
+        return self._get(filename)[0]
+
+    def band(self, filename, band):
+        """ Return a band of an open dataset
+
+        Args:
+          filename (str): filename of dataset
+          band (int): band number, starting at 1
+
+        Returns:
+          band (gdal.Band): raster band
+
+        """
+        with self._lock:
+            ds, bands = self._get(filename)
+            if band not in bands:
+                bands[band] = ds.GetRasterBand(band)
+            return bands[band]
+
+    def _get(self, filename):
+        """ Return dataset and band cache, marking it most recently used """
+        with self._lock:
+            entry = self._remote.get(filename)
+            if entry is not None:
+                profiling.count('cache_hits')
+                return entry
+            if remote.is_remote(filename):
+                profiling.count('cache_misses')
+                entry = self._open_remote(filename)
+                self._remote[filename] = entry
+                return entry
+
+            entry = self._datasets.pop(filename, None)
+            if entry is not None:
+                profiling.count('cache_hits')
+            else:
+                profiling.count('cache_misses')
+                while len(self._datasets) >= self.maxsize:
+                    self._datasets.popitem(last=False)
+                with profiling.stage('open'):
+                    entry = (gdal.Open(filename, gdal.GA_ReadOnly), {})
+            self._datasets[filename] = entry
+            return entry
+
+    def _open_remote(self, filename):
+        """ Open a remote dataset, returning it with an empty band cache """
+        remote.configure()
+        with profiling.stage('open'):
+            ds = gdal.Open(remote.vsi_path(filename), gdal.GA_ReadOnly)
+        profiling.count('remote_opens')
+        if not remote.is_cog(ds):
+            logger.warning('Remote image {f} is not a Cloud-Optimized GeoTIFF '
+                           'and may be slow to read'.format(f=filename))
+        return ds, {}
+
+    def discard(self, filenames):
+        """ Close datasets, if open (e.g., once their files changed)
+
+        Args:
+          filenames (list): filenames of datasets
+
+        """
+        with self._lock:
+            for filename in filenames:
+                self._datasets.pop(filename, None)
+                self._remote.pop(filename, None)
+
+    def close(self):
+        """ Close all open datasets at the end of a run, unless kept open """
+        if not self.keep_open:
+            self.clear()
+
+    def clear(self):
+        """ Close all open datasets """
+        with self._lock:
+            self._datasets.clear()
+            if self._remote:
+                self._remote.clear()
+                remote.clear_cache()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*
+""" dates.py
+
+Registry of filename parsers for acquisition dates and sensors
+
+Parsers are regular expressions with a named "date" group, and optionally a
+named "sensor" group, tried in order of registration. Parsers for Landsat
+scene IDs, Landsat Collection 1 and 2 product IDs and Sentinel-2 products
+and tiles are registered by default; others may be added using
+`register_parser`.
+
+Filenames are parsed in bulk into `datetime64[D]` arrays and results are
+remembered by the `SceneCatalog`, so importing the same scenes again does
+not parse them again.
+
+"""
+from collections import OrderedDict
+from datetime import datetime as dt
+import logging
+import os
+import re
+import threading
+
+import numpy as np
+
+logger = logging.getLogger('image_compositor')
+
+NaT = np.datetime64('NaT', 'D')
+
+
+def isnat(dates):
+    """ Return True where `datetime64[D]` dates are NaT """
+    return np.asarray(dates, dtype='datetime64[D]').view(np.int64) == \
+        np.iinfo(np.int64).min
+
+
+class FilenameParser(object):
+    """ Parses date and sensor from a filename using a regular expression
+
+    Args:
+      name (str): name of parser
+      pattern (str): regular expression with a "date" named group, and
+        optionally a "sensor" named group, searched for within the filename
+      date_format (str): `strptime` format of the "date" group
+      sensor (str, optional): sensor name used if the pattern has no
+        "sensor" group
+
+    """
+
+    def __init__(self, name, pattern, date_format, sensor=None):
+        self.name = name
+        self.regex = re.compile(pattern)
+        if 'date' not in self.regex.groupindex:
+            raise ValueError('Filename parser pattern requires a "date" named '
+                             'group')
+        self.date_format = date_format
+        self.sensor = sensor
+
+    def __repr__(self):
+        return 'FilenameParser({n})'.format(n=self.name)
+
+    def parse(self, filename):
+        """ Return date and sensor parsed from a filename
+
+        Args:
+          filename (str): basename of file
+
+        Returns:
+          tuple: date (np.datetime64) and sensor (str) or None if the
+            filename does not match
+
+        """
+        match = self.regex.search(filename)
+        if not match:
+            return None
+
+        date = _parse_date(match.group('date'), self.date_format)
+        if date is None:
+            return None
+
+        groups = match.groupdict()
+        return date, groups.get('sensor') or self.sensor
+
+
+def _parse_date(date_str, date_format):
+    """ Parse a date string, avoiding `strptime` for common formats """
+    try:
+        if date_format == '%Y%j':
+            year, doy = int(date_str[:4]), int(date_str[4:])
+            date = (np.datetime64(date_str[:4], 'Y').astype('datetime64[D]') +
+                    np.timedelta64(doy - 1, 'D'))
+            if not 1 <= doy or date.astype(object).year != year:
+                return None
+            return date
+        elif date_format == '%Y%m%d':
+            return np.datetime64('-'.join((date_str[:4], date_str[4:6],
+                                           date_str[6:8])), 'D')
+        else:
+            return np.datetime64(dt.strptime(date_str, date_format).date(),
+                                 'D')
+    except ValueError:
+        return None
+
+
+class SceneCatalog(object):
+    """ Memoizes dates and sensors parsed from filenames
+
+    Results are keyed by file basename and are cleared whenever the parser
+    registry changes.
+
+    """
+
+    def __init__(self):
+        self._scenes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._scenes)
+
+    def __contains__(self, filename):
+        return os.path.basename(filename) in self._scenes
+
+    def get(self, filename):
+        """ Return date and sensor of a file, parsing it if not known """
+        name = os.path.basename(filename)
+        try:
+            return self._scenes[name]
+        except KeyError:
+            pass
+
+        result = (NaT, None)
+        for parser in list(_parsers.values()):
+            parsed = parser.parse(name)
+            if parsed is not None:
+                result = parsed
+                break
+
+        with self._lock:
+            self._scenes[name] = result
+        return result
+
+    def clear(self):
+        """ Forget all parsed filenames """
+        with self._lock:
+            self._scenes.clear()
+
+
+_parsers = OrderedDict()
+catalog = SceneCatalog()
+
+
+def register_parser(name, pattern, date_format, sensor=None, first=False):
+    """ Add a filename parser to the registry
+
+    Args:
+      name (str): name of parser, replacing any parser of the same name
+      pattern (str): regular expression with a "date" named group, and
+        optionally a "sensor" named group
+      date_format (str): `strptime` format of the "date" group
+      sensor (str, optional): sensor name used if the pattern has no
+        "sensor" group
+      first (bool, optional): try this parser before all others
+
+    Returns:
+      parser (FilenameParser): the registered parser
+
+    """
+    parser = FilenameParser(name, pattern, date_format, sensor=sensor)
+    _parsers.pop(name, None)
+    if first:
+        items = list(_parsers.items())
+        _parsers.clear()
+        _parsers[name] = parser
+        _parsers.update(items)
+    else:
+        _parsers[name] = parser
+    catalog.clear()
+    return parser
+
+
+def unregister_parser(name):
+    """ Remove a filename parser from the registry """
+    del _parsers[name]
+    catalog.clear()
+
+
+def parsers():
+    """ Return registered filename parsers in the order they are tried """
+    return list(_parsers.values())
+
+
+def parse_filenames(filenames):
+    """ Parse dates and sensors from many filenames
+
+    Args:
+      filenames (list): filenames to parse
+
+    Returns:
+      tuple: dates as a `datetime64[D]` array, with NaT where a date could
+        not be parsed, and sensors as an array of str or None
+
+    """
+    results = [catalog.get(f) for f in filenames]
+
+    dates = np.array([r[0] for r in results], dtype='datetime64[D]')
+    sensors = np.array([r[1] for r in results], dtype=object)
+
+    missing = isnat(dates)
+    if missing.any():
+        logger.warning('Could not parse date for {n} of {t} files (e.g., '
+                       '{f})'.format(n=missing.sum(), t=len(filenames),
+                                     f=os.path.basename(
+                                         filenames[np.argmax(missing)])))
+
+    return dates, sensors
+
+
+def parse_date(filename):
+    """ Return date of a file as a datetime, or None if not parsed """
+    date = catalog.get(filename)[0]
+    if isnat(date):
+        return None
+    return dt.combine(date.astype(object), dt.min.time())
+
+
+# Landsat scene ID (e.g., LE70220492000037EDC00)
+register_parser('landsat_scene_id',
+                r'(?P<sensor>L[CETOM]\d)\d{6}(?P<date>\d{7})[A-Z]{3}\d{2}',
+                '%Y%j')
+# Landsat Collection 1 and 2 product ID
+# (e.g., LC08_L1TP_022049_20200101_20200113_01_T1)
+register_parser('landsat_product_id',
+                r'(?P<sensor>L[CETOM]\d{2})_L\d[A-Z]{2}_\d{6}_'
+                r'(?P<date>\d{8})_\d{8}_0[12]_(?:T1|T2|RT)',
+                '%Y%m%d')
+# Sentinel-2 product (e.g., S2A_MSIL2A_20170105T013442_N0204_R031_T53NMJ_...)
+register_parser('sentinel2_product',
+                r'(?P<sensor>S2[AB])_MSIL(?:1C|2A)_(?P<date>\d{8})T\d{6}',
+                '%Y%m%d')
+# Sentinel-2 tile granule (e.g., T53NMJ_20170105T013442_B04.jp2)
+register_parser('sentinel2_tile',
+                r'T\d{2}[A-Z]{3}_(?P<date>\d{8})T\d{6}',
+                '%Y%m%d', sensor='S2')
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*
+""" index_cache.py
+
+Cache of per-image spectral index rasters used to select observations
+
+Selection composites (e.g., maximum NDVI) score each observation using two
+bands. When the same images are composited again, the scores are the same,
+so `IndexCache` stores each image's score as a single band GeoTIFF scaled
+to int16 and keyed by the image, its size and modification time, the
+scoring bands and the NoDataValue. Compositing from the cache reads one
+band of each image to choose observations, then reads all bands of only
+the images chosen for at least one pixel of a chunk.
+
+Scores are rounded to `SCALES[score]` steps, so observations whose scores
+differ by less than a step are treated as ties and resolved in favor of the
+first image. Ratio scores above 32.767 are clipped.
+
+"""
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+from osgeo import gdal
+
+import kernels
+import profiling
+import remote
+
+gdal.AllRegister()
+gdal.UseExceptions()
+
+logger = logging.getLogger('image_compositor')
+
+#: Value of scores that are invalid (e.g., NoDataValue in a scoring band)
+NODATA = np.iinfo(np.int16).min
+#: Multiplier applied to scores before rounding to int16
+SCALES = {
+    'nd': 10000,
+    'ratio': 1000
+}
+#: Version of cached files, changed if their contents change
+VERSION = 1
+
+_CREATION_OPTIONS = ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=2']
+
+
+def _replace(src, dst):
+    """ Rename a file, replacing `dst` if it exists, on all platforms
+
+    `os.rename` fails on Windows if `dst` exists (e.g., if another process
+    cached the same scores first), and Python 2 has no `os.replace`.
+
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+class IndexCache(object):
+    """ Directory of precomputed per-image scores
+
+    Args:
+      directory (str): directory to store cached scores in, created if
+        necessary
+      block_rows (int, optional): number of rows computed at once when
+        building cached scores
+
+    """
+
+    def __init__(self, directory, block_rows=256):
+        self.directory = directory
+        self.block_rows = block_rows
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'IndexCache({d})'.format(d=self.directory)
+
+    def __getstate__(self):
+        return {'directory': self.directory, 'block_rows': self.block_rows}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def path(self, image, b1, b2, score, ndv):
+        """ Return filename of the cached scores of an image
+
+        Args:
+          image (str): filename of image
+          b1 (int): band number of the first band in the score
+          b2 (int): band number of the second band in the score
+          score (str): 'nd' or 'ratio' (see `kernels.select_best`)
+          ndv (int or float): NoDataValue of the image
+
+        Returns:
+          str: filename of cached scores, which may not exist yet
+
+        """
+        key = [image, b1, b2, score, ndv, SCALES[score], VERSION]
+        if not remote.is_remote(image):
+            stat = os.stat(image)
+            key = [os.path.abspath(image), stat.st_size, stat.st_mtime] + \
+                key[1:]
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:12]
+
+        name = os.path.splitext(os.path.basename(image))[0]
+        return os.path.join(self.directory, '{n}_{s}_{b1}_{b2}_{d}.tif'.format(
+            n=name, s=score, b1=b1, b2=b2, d=digest))
+
+    def get(self, images, b1, b2, score, ndv):
+        """ Return cached scores of images, building those not yet cached
+
+        Args:
+          images (list): filenames of images
+          b1 (int): band number of the first band in the score
+          b2 (int): band number of the second band in the score
+          score (str): 'nd' or 'ratio' (see `kernels.select_best`)
+          ndv (int or float): NoDataValue of the images
+
+        Returns:
+          list: filenames of cached scores of each image
+
+        """
+        with self._lock:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+        paths = []
+        for image in images:
+            path = self.path(image, b1, b2, score, ndv)
+            if os.path.exists(path):
+                profiling.count('index_cache_hits')
+            else:
+                profiling.count('index_cache_misses')
+                self.build(image, path, b1, b2, score, ndv)
+            paths.append(path)
+        return paths
+
+    @profiling.profiled('build_index')
+    def build(self, image, path, b1, b2, score, ndv):
+        """ Compute and store the scores of an image
+
+        Scores are written to a temporary file that is renamed once
+        complete, so a partially written file is never used.
+
+        Args:
+          image (str): filename of image
+          path (str): filename of cached scores
+          b1 (int): band number of the first band in the score
+          b2 (int): band number of the second band in the score
+          score (str): 'nd' or 'ratio' (see `kernels.select_best`)
+          ndv (int or float): NoDataValue of the image
+
+        """
+        logger.debug('Caching {s} of bands {b1} and {b2} of {i}'.format(
+            s=score, b1=b1, b2=b2, i=image))
+        src = gdal.Open(remote.vsi_path(image), gdal.GA_ReadOnly)
+        ncol, nrow = src.RasterXSize, src.RasterYSize
+        band1, band2 = src.GetRasterBand(b1), src.GetRasterBand(b2)
+
+        tmp = '{p}.{pid}.tmp'.format(p=path, pid=os.getpid())
+        dst = gdal.GetDriverByName('GTiff').Create(
+            tmp, ncol, nrow, 1, gdal.GDT_Int16, _CREATION_OPTIONS)
+        dst.SetProjection(src.GetProjection())
+        dst.SetGeoTransform(src.GetGeoTransform())
+        out = dst.GetRasterBand(1)
+        out.SetNoDataValue(NODATA)
+
+        for yoff in range(0, nrow, self.block_rows):
+            ysize = min(self.block_rows, nrow - yoff)
+            _score = kernels.band_score(
+                band1.ReadAsArray(0, yoff, ncol, ysize),
+                band2.ReadAsArray(0, yoff, ncol, ysize),
+                ndv, score=score)
+            scaled = np.full(_score.shape, NODATA, dtype=np.int16)
+            valid = ~np.isnan(_score)
+            scaled[valid] = np.clip(np.round(_score[valid] * SCALES[score]),
+                                    NODATA + 1, np.iinfo(np.int16).max)
+            out.WriteArray(scaled, 0, yoff)
+
+        out = None
+        dst = None
+        src = None
+        _replace(tmp, path)
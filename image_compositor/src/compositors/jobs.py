@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*
+""" jobs.py
+
+Several compositing jobs run over one image stack in a single pass
+
+Running several algorithms, or one algorithm with several sets of
+parameters, over the same images would otherwise read every chunk of the
+stack once per job. `JobSet` instead processes each chunk for all jobs at
+once. The jobs share a `ChunkCache`, so a window of a band or mask read by
+one job is reused by the others, and a `DatasetPool`, so each image is
+opened once. Each job still writes its own output.
+
+Jobs must composite onto the same grid, so they must find the same base
+image valid and use the same chunk size and scale.
+
+Example:
+    >>> jobs = JobSet([(NDVIComposite, {}),
+    ...                (ZZCompositor, {'_ndv': 0})])
+    >>> jobs.validate_images(images)
+    >>> jobs.process_image(['ndvi.gtif', 'zz.gtif'], ncpu=4)
+
+"""
+import logging
+
+import numpy as np
+
+from validation import ImageValidator
+from writers import MultiWriter
+import parallel
+import profiling
+import threads
+
+logger = logging.getLogger('image_compositor')
+
+
+class ChunkCache(object):
+    """ Reads of the chunk being processed, shared by several compositors
+
+    Entries are kept until `clear` is called, which `JobSet` does before
+    and after each chunk. Arrays returned must not be modified.
+
+    """
+
+    def __init__(self):
+        self._reads = {}
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def get(self, key, read):
+        """ Return a cached read, reading it first if necessary
+
+        Args:
+          key (tuple): hashable description of the read
+          read (callable): function returning the data if not cached
+
+        Returns:
+          data: result of `read` for this key
+
+        """
+        try:
+            data = self._reads[key]
+        except KeyError:
+            data = self._reads[key] = read()
+        else:
+            profiling.count('reads_shared')
+        return data
+
+    def clear(self):
+        """ Forget all cached reads """
+        self._reads.clear()
+
+
+class JobSet(object):
+    """ Compositing jobs sharing one image stack
+
+    Args:
+      jobs (list): algorithm and parameters of each job, where the
+        algorithm is a `Compositor` subclass or instance and parameters is
+        a dict of attributes to set (e.g., `{'_ndv': 0}`)
+
+    Raises:
+      ValueError: raised if no jobs are given
+
+    """
+
+    def __init__(self, jobs):
+        if not jobs:
+            raise ValueError('No compositing jobs given')
+
+        self.cache = ChunkCache()
+        self.compositors = []
+        for algo, parameters in jobs:
+            compositor = algo() if isinstance(algo, type) else algo
+            for name, value in (parameters or {}).items():
+                setattr(compositor, name, value)
+            compositor.chunk_cache = self.cache
+            self.compositors.append(compositor)
+
+        # Process chunks as the first job would
+        self.executor = self.compositors[0].executor
+        self.chunk_order = self.compositors[0].chunk_order
+
+        # Share one pool of datasets
+        datasets = self.compositors[0].datasets
+        for compositor in self.compositors[1:]:
+            compositor._datasets = datasets
+
+    def __repr__(self):
+        return 'JobSet({c})'.format(c=', '.join(repr(c) for c in
+                                                self.compositors))
+
+    @property
+    def datasets(self):
+        """ DatasetPool: pool of datasets shared by all jobs """
+        return self.compositors[0].datasets
+
+    @property
+    def out_nband(self):
+        """ int: number of bands of all outputs together """
+        return sum(c.out_nband for c in self.compositors)
+
+    @property
+    def out_dtype(self):
+        """ np.dtype: data type holding the outputs of all jobs """
+        return np.result_type(*[c.out_dtype for c in self.compositors])
+
+    def validate_images(self, images, validator=None):
+        """ Validate images for each job
+
+        Args:
+          images (list): list of filenames for images to be validated
+          validator (ImageValidator, optional): validator remembering
+            images already checked, shared by the jobs so each image is
+            opened once
+
+        Returns:
+          valid (list): for each job, True or False for each image
+
+        Raises:
+          ValueError: raised if any job has no valid images, or if the
+            jobs do not composite onto the same grid
+
+        """
+        if validator is None:
+            validator = ImageValidator()
+        valid = [c.validate_images(images, validator=validator)
+                 for c in self.compositors]
+        self._check_grid()
+        return valid
+
+    def _check_grid(self):
+        """ Raise ValueError unless all jobs share a composite grid """
+        for compositor in self.compositors:
+            if not compositor.images:
+                raise ValueError('No images are valid for {c}'.format(
+                    c=compositor))
+
+        def grid(c):
+            return (c.grid_size, c.grid_transform, c.scale,
+                    tuple(c.chunk_size), c.block_size)
+
+        first = grid(self.compositors[0])
+        for compositor in self.compositors[1:]:
+            if grid(compositor) != first:
+                raise ValueError(
+                    'Jobs must composite onto the same grid, but {a} and {b} '
+                    'differ in base image, scale or chunk size'.format(
+                        a=self.compositors[0], b=compositor))
+
+    def iter_chunks(self):
+        """ Yield chunks of the composite grid shared by all jobs """
+        return self.compositors[0].iter_chunks()
+
+    def prepare(self):
+        """ Prepare state shared by all chunks of a run for each job """
+        for compositor in self.compositors:
+            compositor.prepare()
+
+    def process_chunk(self, xoff, yoff, xsize, ysize):
+        """ Process a chunk for all jobs
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns to process
+          ysize (int): number of rows to process
+
+        Returns:
+          composite (np.ndarray): composited chunks of all jobs stacked
+            along the band axis, shaped (out_nband, ysize, xsize)
+
+        """
+        self.cache.clear()
+        try:
+            return np.concatenate(
+                [c.process_chunk(xoff, yoff, xsize, ysize)
+                 for c in self.compositors]).astype(self.out_dtype,
+                                                    copy=False)
+        finally:
+            self.cache.clear()
+
+    def create_writer(self, outputs, driver='GTiff', creation_options=None):
+        """ Return a writer splitting chunks into the output of each job
+
+        Args:
+          outputs (list): output filename of each job
+          driver (str, optional): GDAL driver for outputs
+          creation_options (list, optional): GDAL creation options for
+            outputs
+
+        Returns:
+          writer (MultiWriter): writer of all outputs
+
+        Raises:
+          ValueError: raised if the number of outputs does not match the
+            number of jobs
+
+        """
+        if len(outputs) != len(self.compositors):
+            raise ValueError('Expected {n} outputs, one for each job, but '
+                             'got {m}'.format(n=len(self.compositors),
+                                              m=len(outputs)))
+        writers = []
+        try:
+            for compositor, output in zip(self.compositors, outputs):
+                writers.append(compositor.create_writer(
+                    output, driver=driver,
+                    creation_options=creation_options))
+        except Exception:
+            for writer in writers:
+                writer.close()
+            raise
+        return MultiWriter(writers)
+
+    def process_image(self, outputs, ncpu=1,
+                      driver='GTiff', creation_options=None):
+        """ Run all jobs on entire image, reading each chunk once
+
+        Images must first be validated using `validate_images`.
+
+        Args:
+          outputs (list): output filename of each job
+          ncpu (int, optional): number of CPUs to use, as processes or
+            threads depending on `executor`
+          driver (str, optional): GDAL driver for outputs
+          creation_options (list, optional): GDAL creation options for
+            outputs
+
+        """
+        logger.debug('Running {n} jobs'.format(n=len(self.compositors)))
+        self.prepare()
+        writer = self.create_writer(outputs, driver=driver,
+                                    creation_options=creation_options)
+        try:
+            if ncpu > 1 and self.executor == 'thread':
+                threads.process_chunks(self, writer, ncpu)
+            elif ncpu > 1:
+                parallel.process_chunks(self, writer, ncpu)
+            else:
+                for xoff, yoff, xsize, ysize in self.iter_chunks():
+                    with profiling.stage('process_chunk'):
+                        composite = self.process_chunk(xoff, yoff,
+                                                       xsize, ysize)
+                    profiling.count('chunks')
+                    writer.write(xoff, yoff, composite)
+        finally:
+            writer.close()
+            self.datasets.close()
@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*
+""" kernels.py
+
+Pixel selection and summary kernels used by the compositing algorithms
+
+Selection kernels operate on a chunk of the image stack shaped
+(nimage, nband, nrow, ncol), score each observation using two of its bands,
+ignore observations containing the NoDataValue and return all bands of the
+best scoring observation for each pixel.
+
+Two backends are provided:
+    - "numpy": vectorized implementation, always available
+    - "numba": fused loop compiled with Numba which computes the score,
+      masks NoDataValue, tracks the best index and gathers output in one
+      pass over each pixel without full-size temporary arrays
+
+The "numba" backend is used by default when Numba can be imported.
+
+Scores may also be precomputed for each image (see `index_cache.py`), in
+which case `select_max` chooses the best observation from a stack of
+scores and `gather` collects the bands of the chosen observations.
+
+`summarize` counts the valid observations of each pixel and the minimum,
+maximum and mean of their scores, from the arrays already computed for
+selection.
+
+`cloud_distance` computes the distance of each observation to the nearest
+cloud for multi-criteria scores (see `bap_composite.py`).
+
+Quantile kernels summarize the valid observations of each pixel and band,
+either exactly using `np.partition` or approximately using a streaming
+histogram sketch (`QuantileSketch`) whose memory does not depend on the
+number of images.
+
+"""
+import logging
+
+import numpy as np
+
+import profiling
+
+logger = logging.getLogger('image_compositor')
+
+try:
+    import numba
+except ImportError:
+    HAS_NUMBA = False
+else:
+    HAS_NUMBA = True
+
+try:
+    from scipy import ndimage
+except ImportError:
+    HAS_SCIPY = False
+else:
+    HAS_SCIPY = True
+
+#: Scores available for selection - normalized difference or ratio of bands
+SCORES = {
+    'nd': 0,
+    'ratio': 1
+}
+
+BACKENDS = ['numpy', 'numba'] if HAS_NUMBA else ['numpy']
+DEFAULT_BACKEND = BACKENDS[-1]
+
+
+def get_backend(backend=None):
+    """ Return name of kernel backend to use
+
+    Args:
+      backend (str, optional): requested backend, or None for the default
+
+    Returns:
+      backend (str): name of the backend
+
+    Raises:
+      ValueError: raised if backend is unknown or unavailable
+
+    """
+    if backend is None:
+        return DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError('Kernel backend "{b}" is not available (choose from '
+                         '{a})'.format(b=backend, a=', '.join(BACKENDS)))
+    return backend
+
+
+@profiling.profiled('kernel')
+def select_best(cube, b1, b2, ndv, score='nd', backend=None, clear=None):
+    """ Select the observation maximizing a two band score for each pixel
+
+    Observations are invalid if either scoring band is equal to the
+    NoDataValue, if the score's denominator is zero or the score is NaN
+    (e.g., a band is NaN) or if they are not clear according to the
+    optional bit-packed mask. Ties are resolved
+    in favor of the first observation, as with `np.argmax`.
+
+    Args:
+      cube (np.ndarray): stack chunk shaped (nimage, nband, nrow, ncol)
+      b1 (int): index of the first band in the score (e.g., red for NDVI)
+      b2 (int): index of the second band in the score (e.g., NIR for NDVI)
+      ndv (int or float): NoDataValue
+      score (str, optional): 'nd' for normalized difference,
+        (b2 - b1) / (b2 + b1), or 'ratio' for b2 / b1
+      backend (str, optional): kernel backend, or None for the default
+      clear (np.ndarray, optional): bit-packed clear observations shaped
+        (nimage, nrow, ceil(ncol / 8)) (see `masks.pack`)
+
+    Returns:
+      composite (np.ndarray): best observation for each pixel shaped
+        (nband, nrow, ncol), filled with `ndv` if no observation is valid
+
+    """
+    if score not in SCORES:
+        raise ValueError('Unknown score "{s}"'.format(s=score))
+    backend = get_backend(backend)
+
+    if backend == 'numba':
+        composite = np.empty(cube.shape[1:], dtype=cube.dtype)
+        _select_best_numba(cube, b1, b2, ndv, SCORES[score],
+                           _NO_CLEAR if clear is None else clear,
+                           clear is not None, composite)
+        return composite
+    else:
+        return _select_best_numpy(cube, b1, b2, ndv, score, clear)
+
+
+def _select_best_numpy(cube, b1, b2, ndv, score, clear=None):
+    """ Vectorized NumPy implementation of `select_best` """
+    x1 = cube[:, b1].astype(np.float64)
+    x2 = cube[:, b2].astype(np.float64)
+
+    if score == 'nd':
+        num, denom = x2 - x1, x2 + x1
+    else:
+        num, denom = x2, x1
+
+    invalid = (cube[:, b1] == ndv) | (cube[:, b2] == ndv) | (denom == 0)
+    if clear is not None:
+        invalid |= ~np.unpackbits(clear, axis=-1)[..., :cube.shape[-1]]\
+            .astype(bool)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        _score = num / denom
+    # np.argmax would select NaN scores
+    invalid |= np.isnan(_score)
+    _score[invalid] = -np.inf
+
+    best = np.argmax(_score, axis=0)
+
+    rows, cols = np.indices(best.shape)
+    composite = np.rollaxis(cube[best, :, rows, cols], 2)
+    composite = np.ascontiguousarray(composite)
+    composite[:, invalid.all(axis=0)] = ndv
+
+    return composite
+
+
+# Placeholder for `clear` when no mask is used
+_NO_CLEAR = np.zeros((0, 0, 0), dtype=np.uint8)
+
+if HAS_NUMBA:
+    @numba.jit(nopython=True, nogil=True)
+    def _select_best_numba(cube, b1, b2, ndv, score, clear, use_clear,
+                           composite):
+        """ Fused Numba implementation of `select_best`
+
+        Loops row by row so each image row is visited contiguously, keeping
+        only a row of best scores and indices as scratch space.
+
+        """
+        nimage, nband, nrow, ncol = cube.shape
+
+        best = np.empty(ncol, dtype=np.intp)
+        best_score = np.empty(ncol, dtype=np.float64)
+
+        for i in range(nrow):
+            best[:] = -1
+            for t in range(nimage):
+                for j in range(ncol):
+                    if use_clear and not \
+                            (clear[t, i, j >> 3] >> (7 - (j & 7))) & 1:
+                        continue
+                    v1 = cube[t, b1, i, j]
+                    v2 = cube[t, b2, i, j]
+                    if v1 == ndv or v2 == ndv:
+                        continue
+
+                    x1 = np.float64(v1)
+                    x2 = np.float64(v2)
+                    if score == 0:
+                        num, denom = x2 - x1, x2 + x1
+                    else:
+                        num, denom = x2, x1
+                    if denom == 0:
+                        continue
+
+                    s = num / denom
+                    if np.isnan(s):
+                        continue
+                    if best[j] < 0 or s > best_score[j]:
+                        best[j] = t
+                        best_score[j] = s
+
+            for j in range(ncol):
+                t = best[j]
+                if t < 0:
+                    for b in range(nband):
+                        composite[b, i, j] = ndv
+                else:
+                    for b in range(nband):
+                        composite[b, i, j] = cube[t, b, i, j]
+
+
+def band_score(x1, x2, ndv, score='nd'):
+    """ Return the score of observations from two bands
+
+    Args:
+      x1 (np.ndarray): first band in the score (e.g., red for NDVI)
+      x2 (np.ndarray): second band in the score (e.g., NIR for NDVI)
+      ndv (int or float): NoDataValue
+      score (str, optional): 'nd' or 'ratio' (see `select_best`)
+
+    Returns:
+      score (np.ndarray): score as float64, NaN where either band is equal
+        to the NoDataValue or the score's denominator is zero
+
+    """
+    if score not in SCORES:
+        raise ValueError('Unknown score "{s}"'.format(s=score))
+    _x1 = x1.astype(np.float64)
+    _x2 = x2.astype(np.float64)
+
+    if score == 'nd':
+        num, denom = _x2 - _x1, _x2 + _x1
+    else:
+        num, denom = _x2, _x1
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        _score = num / denom
+    _score[(x1 == ndv) | (x2 == ndv) | (denom == 0)] = np.nan
+
+    return _score
+
+
+@profiling.profiled('kernel')
+def select_max(scores, nodata, clear=None):
+    """ Return the index of the highest scoring observation of each pixel
+
+    Ties are resolved in favor of the first observation, as with
+    `np.argmax`.
+
+    Args:
+      scores (np.ndarray): precomputed scores shaped (nimage, nrow, ncol)
+      nodata (int or float): value of invalid scores, which must be less
+        than any valid score
+      clear (np.ndarray, optional): bit-packed clear observations shaped
+        (nimage, nrow, ceil(ncol / 8)) (see `masks.pack`)
+
+    Returns:
+      best (np.ndarray): index of best observation shaped (nrow, ncol), or
+        -1 where no observation is valid
+
+    """
+    invalid = scores == nodata
+    if clear is not None:
+        invalid |= ~np.unpackbits(clear, axis=-1)[..., :scores.shape[-1]]\
+            .astype(bool)
+        scores = np.where(invalid, nodata, scores)
+
+    best = np.argmax(scores, axis=0)
+    best[invalid.all(axis=0)] = -1
+
+    return best
+
+
+def gather(best, read, nband, ndv, dtype):
+    """ Gather all bands of the best observation of each pixel
+
+    Only observations chosen for at least one pixel are read.
+
+    Args:
+      best (np.ndarray): index of best observation shaped (nrow, ncol), or
+        -1 where no observation is valid (see `select_max`)
+      read (callable): function returning all bands of an observation, shaped
+        (nband, nrow, ncol), given its index
+      nband (int): number of bands
+      ndv (int or float): NoDataValue
+      dtype (np.dtype): data type of composite
+
+    Returns:
+      composite (np.ndarray): best observation for each pixel shaped
+        (nband, nrow, ncol), filled with `ndv` if no observation is valid
+
+    """
+    composite = np.empty((nband, ) + best.shape, dtype=dtype)
+    composite.fill(ndv)
+    for i in np.unique(best[best >= 0]):
+        chosen = best == i
+        composite[:, chosen] = read(i)[:, chosen]
+
+    return composite
+
+
+#: Names of the bands returned by `summarize`
+SUMMARY_BANDS = ('count', 'score_min', 'score_max', 'score_mean')
+
+
+@profiling.profiled('summarize')
+def summarize(valid, scores=None):
+    """ Count valid observations and summarize their scores for each pixel
+
+    Args:
+      valid (np.ndarray): True where an observation is valid, shaped
+        (nimage, nrow, ncol), or the number of valid observations shaped
+        (1, nrow, ncol) if scores are not given
+      scores (np.ndarray, optional): scores of observations shaped
+        (nimage, nrow, ncol); values of invalid observations are ignored
+
+    Returns:
+      summary (np.ndarray): count of valid observations and, if scores are
+        given, their minimum, maximum and mean score as float32 shaped
+        (1 or 4, nrow, ncol) (see `SUMMARY_BANDS`); scores are NaN where no
+        observation is valid
+
+    """
+    count = valid.sum(axis=0)
+    if scores is None:
+        return count[np.newaxis].astype(np.float32)
+
+    summary = np.empty((4, ) + count.shape, dtype=np.float32)
+    summary[0] = count
+    _scores = scores.astype(np.float32)
+    summary[1] = np.where(valid, _scores, np.inf).min(axis=0)
+    summary[2] = np.where(valid, _scores, -np.inf).max(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        summary[3] = np.where(valid, _scores, 0).sum(axis=0) / count
+    summary[1:, count == 0] = np.nan
+
+    return summary
+
+
+@profiling.profiled('kernel')
+def cloud_distance(cloudy, max_distance):
+    """ Return the distance of each pixel to the nearest cloudy pixel
+
+    Distances are computed within each image, for all images of the stack
+    at once, and capped at `max_distance`. Euclidean distances are used if
+    SciPy is installed; otherwise distances are approximated by the number
+    of steps between edge-adjacent pixels.
+
+    Args:
+      cloudy (np.ndarray): True where cloudy, shaped (nimage, nrow, ncol)
+      max_distance (int): maximum distance, in pixels
+
+    Returns:
+      distance (np.ndarray): distance shaped (nimage, nrow, ncol) as float32
+
+    """
+    if not cloudy.any():
+        return np.full(cloudy.shape, max_distance, dtype=np.float32)
+
+    if HAS_SCIPY:
+        # Images spaced further apart than `max_distance` keep the nearest
+        # cloudy pixel within the same image
+        distance = ndimage.distance_transform_edt(
+            ~cloudy, sampling=(max_distance + 1, 1, 1))
+        return np.minimum(distance, max_distance).astype(np.float32)
+
+    distance = np.full(cloudy.shape, max_distance, dtype=np.float32)
+    near = cloudy.copy()
+    distance[near] = 0
+    for d in range(1, max_distance):
+        grown = near.copy()
+        grown[:, 1:] |= near[:, :-1]
+        grown[:, :-1] |= near[:, 1:]
+        grown[:, :, 1:] |= near[:, :, :-1]
+        grown[:, :, :-1] |= near[:, :, 1:]
+        distance[grown & ~near] = d
+        near = grown
+    return distance
+
+
+def _sentinel(dtype):
+    """ Return largest value of `dtype`, used to sort NoDataValue last """
+    if np.issubdtype(dtype, np.integer):
+        return np.iinfo(dtype).max
+    return np.inf
+
+
+def _interpolate(lower, upper, frac, dtype):
+    """ Linearly interpolate between ranks and cast back to `dtype` """
+    value = lower + (upper.astype(np.float64) - lower) * frac
+    if np.issubdtype(dtype, np.integer):
+        value = np.round(value)
+    return value.astype(dtype)
+
+
+@profiling.profiled('kernel')
+def quantile(cube, q, ndv):
+    """ Exact, NoDataValue aware quantile of each pixel and band over time
+
+    Pixels are grouped by their number of valid observations, which
+    determines the ranks of the quantile. Observations of each group are
+    copied, in their native data type, with those equal to the NoDataValue
+    moved to the end, and partitioned only around the two ranks the group
+    needs. Quantiles are linearly interpolated between ranks as in
+    `np.percentile`.
+
+    Args:
+      cube (np.ndarray): stack chunk shaped (nimage, nband, nrow, ncol)
+      q (float): quantile to compute, between 0 and 100
+      ndv (int or float): NoDataValue
+
+    Returns:
+      composite (np.ndarray): quantile for each band and pixel shaped
+        (nband, nrow, ncol), filled with `ndv` if no observation is valid
+
+    """
+    nimage = cube.shape[0]
+    data = cube.reshape(nimage, -1)
+    invalid = data == ndv
+    n = nimage - invalid.sum(axis=0)
+
+    composite = np.full(n.shape, ndv, dtype=cube.dtype)
+    for count in np.unique(n):
+        if count == 0:
+            continue
+        pixels = np.flatnonzero(n == count)
+        group = data[:, pixels]
+        if count < nimage:
+            group[invalid[:, pixels]] = _sentinel(cube.dtype)
+
+        pos = (count - 1) * (q / 100.0)
+        lo, hi = int(np.floor(pos)), int(np.ceil(pos))
+        group.partition(sorted(set((lo, hi))), axis=0)
+        composite[pixels] = _interpolate(group[lo], group[hi], pos - lo,
+                                         cube.dtype)
+
+    return composite.reshape(cube.shape[1:])
+
+
+class QuantileSketch(object):
+    """ Streaming, approximate quantiles of each pixel from fixed bins
+
+    Observations are added one date at a time into a per-pixel histogram
+    with `nbins` equal width bins between `vmin` and `vmax`. Values outside
+    of this range are counted in the first or last bin. Quantiles are
+    interpolated within the bin containing the requested rank, so results
+    fall within one bin width of the observation at that rank.
+
+    Args:
+      shape (tuple): number of rows and columns of each observation
+      vmin (int or float): minimum of histogram range
+      vmax (int or float): maximum of histogram range
+      nbins (int, optional): number of histogram bins
+      ndv (int or float, optional): NoDataValue to ignore
+
+    """
+
+    def __init__(self, shape, vmin, vmax, nbins=256, ndv=None):
+        self.shape = tuple(shape)
+        self.vmin, self.vmax = float(vmin), float(vmax)
+        self.nbins = nbins
+        self.ndv = ndv
+
+        self._npix = int(np.prod(self.shape))
+        self._width = (self.vmax - self.vmin) / nbins
+        self._offset = np.arange(self._npix, dtype=np.intp) * nbins
+        self.counts = np.zeros(self._npix * nbins, dtype=np.uint32)
+
+    def update(self, data):
+        """ Add an observation of each pixel to the sketch
+
+        Args:
+          data (np.ndarray): observation shaped like `shape`
+
+        """
+        data = data.ravel()
+        _bin = ((data - self.vmin) / self._width).astype(np.intp)
+        _bin = self._offset + _bin.clip(0, self.nbins - 1)
+        if self.ndv is not None:
+            _bin = _bin[data != self.ndv]
+        # Each pixel has its own range of bins, so indexes are unique
+        self.counts[_bin] += 1
+
+    def quantile(self, q, dtype=np.float64, fill=None):
+        """ Return approximate quantile of each pixel
+
+        Args:
+          q (float): quantile to compute, between 0 and 100
+          dtype (np.dtype, optional): output data type
+          fill (int or float, optional): value for pixels without any
+            observations (default: NoDataValue)
+
+        Returns:
+          quantile (np.ndarray): approximate quantile shaped like `shape`
+
+        """
+        counts = self.counts.reshape(self._npix, self.nbins)
+        cum = counts.cumsum(axis=1)
+        n = cum[:, -1]
+
+        rank = (n - 1).clip(min=0) * (q / 100.0) + 0.5
+        _bin = (cum < rank[:, np.newaxis]).sum(axis=1).clip(
+            max=self.nbins - 1)
+
+        idx = np.arange(self._npix)
+        below = cum[idx, _bin] - counts[idx, _bin]
+        in_bin = counts[idx, _bin].clip(min=1)
+        frac = ((rank - below) / in_bin).clip(0, 1)
+
+        value = self.vmin + (_bin + frac) * self._width
+        if np.issubdtype(dtype, np.integer):
+            value = np.round(value)
+        value = value.astype(dtype)
+        value[n == 0] = self.ndv if fill is None else fill
+
+        return value.reshape(self.shape)
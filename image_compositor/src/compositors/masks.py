@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*
+""" masks.py
+
+Cloud, shadow and other per-date observation masks
+
+Each image may be associated with a mask - either a band of the image
+itself or a sidecar file next to it (e.g., Fmask output). Masks are read
+before the image bands for each chunk so dates without any clear pixels in
+the chunk are never read. Clear observations are passed to the kernels as
+bit-packed boolean arrays shaped (nimage, nrow, ceil(ncol / 8)).
+
+"""
+import fnmatch
+import logging
+import os
+import re
+
+import numpy as np
+
+import remote
+
+logger = logging.getLogger('image_compositor')
+
+
+def sidecar_pattern(image, sidecar):
+    """ Return the filename pattern of an image's mask file
+
+    Args:
+      image (str): filename of image
+      sidecar (str): filename pattern of mask files, where "{stem}" stands
+        for the image's filename without its extension
+
+    Returns:
+      str: `fnmatch` pattern matching the image's mask file
+
+    """
+    stem = os.path.splitext(os.path.basename(image))[0]
+    # Match the stem literally, even if it contains pattern characters
+    return sidecar.replace('{stem}', re.sub(r'([*?[])', r'[\1]', stem))
+
+
+def find_mask(image, band=0, sidecar='', listings=None):
+    """ Return the mask associated with an image
+
+    Mask files of several images may share a directory if `sidecar`
+    contains "{stem}" (e.g., "{stem}_Fmask.tif"), which is replaced by the
+    image's filename without its extension. Otherwise the image's directory
+    may hold only one file matching `sidecar`.
+
+    Args:
+      image (str): filename of image
+      band (int, optional): band number of mask within the image, or 0
+      sidecar (str, optional): filename pattern of a mask file within the
+        same directory as the image, used instead of `band` if given (see
+        `sidecar_pattern`)
+      listings (dict, optional): files of each directory already listed,
+        which is updated so each directory is listed once when finding the
+        masks of several images
+
+    Returns:
+      mask (tuple): filename and band number of mask, or None if the image
+        is not masked
+
+    Raises:
+      ValueError: raised if not exactly one sidecar file matches `sidecar`
+
+    """
+    if sidecar and remote.is_remote(image):
+        # Remote directories are not listed (see `remote.CONFIG`)
+        logger.warning('Cannot find mask files matching {p} for remote image '
+                       '{i}'.format(p=sidecar, i=image))
+        raise ValueError('Could not find unique mask file for image')
+    elif sidecar:
+        dirname = os.path.dirname(os.path.abspath(image))
+        if listings is None:
+            listings = {}
+        if dirname not in listings:
+            listings[dirname] = os.listdir(dirname)
+        pattern = sidecar_pattern(image, sidecar)
+        found = [f for f in fnmatch.filter(listings[dirname], pattern)
+                 if os.path.join(dirname, f) != os.path.abspath(image)]
+        if len(found) != 1:
+            logger.warning('Found {n} mask files matching {p} for image '
+                           '{i}'.format(n=len(found), p=pattern, i=image))
+            raise ValueError('Could not find unique mask file for image')
+        return (os.path.join(dirname, found[0]), 1)
+    elif band:
+        return (image, band)
+
+    return None
+
+
+def clear_from_mask(mask, clear_values):
+    """ Return boolean array of clear pixels from a mask band
+
+    Args:
+      mask (np.ndarray): mask band values
+      clear_values (list): mask values denoting clear observations
+
+    Returns:
+      clear (np.ndarray): True where the observation is clear
+
+    """
+    clear = np.zeros(mask.shape, dtype=bool)
+    for value in clear_values:
+        clear |= mask == value
+    return clear
+
+
+def not_clear_value(clear_values):
+    """ Return a mask value that does not denote clear observations
+
+    The value fits in any mask data type, including Byte.
+
+    Args:
+      clear_values (list): mask values denoting clear observations
+
+    Returns:
+      int: largest Byte value not in `clear_values`
+
+    Raises:
+      ValueError: raised if every Byte value is clear
+
+    """
+    values = set(range(256)) - set(clear_values)
+    if not values:
+        raise ValueError('Every mask value from 0 to 255 is clear')
+    return max(values)
+
+
+def pack(clear):
+    """ Bit-pack clear observations along the last (column) axis """
+    return np.packbits(clear, axis=-1)
+
+
+def unpack(packed, ncol):
+    """ Unpack bit-packed clear observations with `ncol` columns """
+    return np.unpackbits(packed, axis=-1)[..., :ncol].astype(bool)
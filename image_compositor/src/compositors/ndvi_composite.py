@@ -19,15 +19,28 @@ class NDVIComposite(Compositor):
     _nir = 4
     _ndv = -9999
 
-    input_info = ['_red', '_nir', '_ndv']
-    input_info_str = ['Red Band Number',
-                      'NIR Band Number',
-                      'NoDataValue']
+    input_info = (['_red', '_nir', '_ndv'] + Compositor.mask_input_info +
+                  Compositor.warp_input_info +
+                  Compositor.summary_input_info)
+    input_info_str = (['Red Band Number',
+                       'NIR Band Number',
+                       'NoDataValue'] + Compositor.mask_input_info_str +
+                      Compositor.warp_input_info_str +
+                      Compositor.summary_input_info_str)
     description = 'Maximum NDVI composite'
 
     def __repr__(self):
         return "Maximum NDVI composite"
 
+    def required_bands(self):
+        """ Return red and NIR band numbers, and any mask band """
+        return ([self._red, self._nir] +
+                super(NDVIComposite, self).required_bands())
+
+    def index_bands(self):
+        """ Return red and NIR bands and score used to select observations """
+        return self._red, self._nir, 'nd'
+
     def process_chunk(self, xoff, yoff, xsize, ysize):
         """ Process a chunk of an image
 
@@ -37,5 +50,9 @@ class NDVIComposite(Compositor):
           xsize (int): number of columns to process
           ysize (int): number of rows to process
 
+        Returns:
+          composite (np.ndarray): composited chunk, followed by any summary
+            bands, shaped (out_nband, ysize, xsize)
+
         """
-        return
+        return self.select_best_chunk(xoff, yoff, xsize, ysize)
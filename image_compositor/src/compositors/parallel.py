@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*
+""" parallel.py
+
+Multiprocess execution of compositing algorithms
+
+Workers read their own chunks of the image stack and composite them into a
+ring of shared memory tile buffers. Only a (slot, window) descriptor is sent
+back to the parent process, which writes the tile straight out of the
+shared buffer, so composited tiles are never pickled or copied between
+processes. Chunks are dispatched most expensive first and written as they
+complete (see `scheduling.py`).
+
+Writers that allow it (e.g., `writers.TileWriter`) are instead used by the
+workers themselves, so writing scales with the number of workers; only the
+filename and statistics of each tile written are sent back.
+
+Each worker opens its own datasets. Under the "fork" start method workers
+inherit the compositor, rather than unpickling it, along with any datasets
+the parent process left open in its `DatasetPool` (e.g., while validating
+images); sharing those handles, and their file offsets, with the parent
+would corrupt reads, so each worker is given a new, empty pool.
+
+"""
+import ctypes
+import logging
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+from datasets import DatasetPool
+import profiling
+import scheduling
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger('image_compositor')
+
+# Per-worker state set by `_init_worker`
+_compositor = None
+_buffers = None
+_writer = None
+
+
+class SharedTileBuffers(object):
+    """ Ring of shared memory buffers, each large enough for one chunk
+
+    Args:
+      nslot (int): number of buffers in the ring
+      shape (tuple): largest chunk shape (nband, ysize, xsize)
+      dtype (np.dtype): data type of chunks
+
+    """
+
+    def __init__(self, nslot, shape, dtype):
+        self.nslot = nslot
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._size = int(np.prod(self.shape))
+        self._raw = [RawArray(ctypes.c_byte, self._size * self.dtype.itemsize)
+                     for _ in range(nslot)]
+
+    def view(self, slot, xsize, ysize):
+        """ Return a chunk shaped view into a slot's buffer
+
+        Args:
+          slot (int): buffer index
+          xsize (int): number of columns in chunk
+          ysize (int): number of rows in chunk
+
+        Returns:
+          chunk (np.ndarray): view shaped (nband, ysize, xsize)
+
+        """
+        count = self.shape[0] * ysize * xsize
+        return np.frombuffer(self._raw[slot], dtype=self.dtype,
+                             count=count).reshape(self.shape[0], ysize, xsize)
+
+
+def _reset_datasets(compositor):
+    """ Give a compositor, or the compositors of a `JobSet`, a new pool
+
+    Compositors of a `JobSet` share one pool, so they share the new pool.
+
+    Args:
+      compositor (Compositor or JobSet): compositor of a worker
+
+    """
+    compositors = getattr(compositor, 'compositors', [compositor])
+    datasets = DatasetPool(compositors[0].datasets.maxsize)
+    for c in compositors:
+        c._datasets = datasets
+
+
+def _init_worker(compositor, buffers, profile, trace, writer=None):
+    """ Store compositor and shared buffers, or writer, within each worker """
+    global _compositor, _buffers, _writer
+    _reset_datasets(compositor)
+    _compositor = compositor
+    _buffers = buffers
+    _writer = writer
+    if profile:
+        profiling.enable(trace=trace)
+    else:
+        profiling.disable()
+
+
+def _composite_chunk(slot, window):
+    """ Composite a chunk into a shared buffer slot
+
+    Args:
+      slot (int): buffer index to composite into
+      window (tuple): x offset, y offset, number of columns and rows
+
+    Returns:
+      descriptor (tuple): the slot and window, and profiling records (see
+        `Profiler.pop_records`) or None if profiling is disabled
+
+    """
+    xoff, yoff, xsize, ysize = window
+    with profiling.stage('process_chunk'):
+        _buffers.view(slot, xsize, ysize)[:] = \
+            _compositor.process_chunk(xoff, yoff, xsize, ysize)
+    profiling.count('chunks')
+
+    profiler = profiling.get()
+    return slot, window, profiler and profiler.pop_records()
+
+
+def _write_chunk(window):
+    """ Composite a chunk and write it using the worker's writer
+
+    Args:
+      window (tuple): x offset, y offset, number of columns and rows
+
+    Returns:
+      tuple: tile written by the writer (see `TileWriter.write`), and
+        profiling records (see `Profiler.pop_records`) or None if profiling
+        is disabled
+
+    """
+    xoff, yoff, xsize, ysize = window
+    with profiling.stage('process_chunk'):
+        composite = _compositor.process_chunk(xoff, yoff, xsize, ysize)
+    profiling.count('chunks')
+    tile = _writer.write(xoff, yoff, composite)
+
+    profiler = profiling.get()
+    return tile, profiler and profiler.pop_records()
+
+
+def _write_chunks(compositor, writer, ncpu):
+    """ Composite and write all chunks of an image in worker processes """
+    windows = scheduling.schedule(compositor)
+    logger.debug('Compositing and writing {n} chunks with {ncpu} '
+                 'processes'.format(n=len(windows), ncpu=ncpu))
+
+    profiler = profiling.get()
+    trace = profiler is not None and profiler.trace
+    pool = multiprocessing.Pool(ncpu, initializer=_init_worker,
+                                initargs=(compositor, None,
+                                          profiler is not None, trace,
+                                          writer))
+    try:
+        for tile, records in pool.imap_unordered(_write_chunk, windows):
+            writer.add_tile(tile)
+            if records is not None:
+                profiler.merge(records)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def process_chunks(compositor, writer, ncpu, nslot=None):
+    """ Composite all chunks of an image using a pool of processes
+
+    Chunks are dispatched in the order given by `scheduling.schedule` to
+    free slots of the ring of shared buffers, and written as they complete.
+    A slot is reused only after its tile has been written.
+
+    Writers allowing parallel writes (e.g., `writers.TileWriter`) are used
+    by the workers instead, without shared buffers.
+
+    Args:
+      compositor (Compositor): algorithm with validated images
+      writer (GDALWriter or TileWriter): output writer
+      ncpu (int): number of worker processes
+      nslot (int, optional): number of shared buffers (default: 2 * ncpu)
+
+    """
+    if writer.parallel:
+        return _write_chunks(compositor, writer, ncpu)
+
+    nslot = nslot or 2 * ncpu
+    windows = scheduling.schedule(compositor)
+    shape = (compositor.out_nband,
+             max(w[3] for w in windows),
+             max(w[2] for w in windows))
+    buffers = SharedTileBuffers(nslot, shape, compositor.out_dtype)
+    logger.debug('Compositing {n} chunks with {ncpu} processes and {s} shared '
+                 'buffers'.format(n=len(windows), ncpu=ncpu, s=nslot))
+
+    profiler = profiling.get()
+    trace = profiler is not None and profiler.trace
+    pool = multiprocessing.Pool(ncpu, initializer=_init_worker,
+                                initargs=(compositor, buffers,
+                                          profiler is not None, trace))
+    done = queue.Queue()
+    pending = {}
+
+    def dispatch(slot, window):
+        pending[slot] = pool.apply_async(_composite_chunk, (slot, window),
+                                         callback=done.put)
+
+    try:
+        windows = iter(windows)
+        for slot, window in zip(range(nslot), windows):
+            dispatch(slot, window)
+
+        while pending:
+            slot, (xoff, yoff, xsize, ysize), records = \
+                scheduling.wait_next(done, pending)
+            del pending[slot]
+            writer.write(xoff, yoff, buffers.view(slot, xsize, ysize))
+            if records is not None:
+                profiler.merge(records)
+
+            window = next(windows, None)
+            if window is not None:
+                dispatch(slot, window)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*
+""" profiling.py
+
+Lightweight instrumentation of the compositing pipeline
+
+Stages (e.g., opening datasets, reading chunks, running kernels and writing
+output) are timed with `stage` or `profiled`, and quantities such as bytes
+read or cache hits are tallied with `count`. Nothing is recorded, and the
+instrumentation only costs a global lookup, unless a `Profiler` has been
+activated with `enable`.
+
+Stage times are inclusive, e.g., "process_chunk" includes the "read" and
+"kernel" stages it runs.
+
+Example:
+    profiler = profiling.enable(trace=True)
+    compositor.process_image('composite.gtif')
+    profiling.disable()
+    profiler.write_json('summary.json')
+    profiler.write_trace('trace.json')  # open in chrome://tracing
+
+"""
+from collections import defaultdict
+from functools import wraps
+import json
+import os
+import threading
+import time
+
+_active = None
+
+
+class _NullStage(object):
+    """ Stage context manager used while profiling is disabled """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    """ Stage context manager recording into a `Profiler` """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.record(self.name, self.start, time.time())
+        return False
+
+
+class Profiler(object):
+    """ Records per-stage wall time, counters and optional trace events
+
+    Args:
+      trace (bool, optional): keep individual stage events for a Chrome
+        trace file in addition to totals
+
+    """
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.start = time.time()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.events = []
+        self._lock = threading.Lock()
+
+    def record(self, name, start, end):
+        """ Record one call of a stage """
+        with self._lock:
+            self.seconds[name] += end - start
+            self.calls[name] += 1
+            if self.trace:
+                self.events.append({
+                    'name': name, 'ph': 'X',
+                    'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                    'pid': os.getpid(), 'tid': threading.current_thread().ident
+                })
+
+    def count(self, name, value=1):
+        """ Add to a counter """
+        with self._lock:
+            self.counters[name] += value
+
+    def pop_records(self):
+        """ Return and reset everything recorded so far
+
+        Used to send records from worker processes back to the parent,
+        which combines them using `merge`.
+
+        """
+        with self._lock:
+            records = (dict(self.seconds), dict(self.calls),
+                       dict(self.counters), self.events)
+            self.seconds.clear()
+            self.calls.clear()
+            self.counters.clear()
+            self.events = []
+        return records
+
+    def merge(self, records):
+        """ Combine records from `pop_records` of another profiler """
+        seconds, calls, counters, events = records
+        with self._lock:
+            for name in seconds:
+                self.seconds[name] += seconds[name]
+                self.calls[name] += calls[name]
+            for name in counters:
+                self.counters[name] += counters[name]
+            if self.trace:
+                self.events.extend(events)
+
+    def summary(self):
+        """ Return summary of stages and counters as a dict """
+        return {
+            'wall_seconds': time.time() - self.start,
+            'stages': dict((name, {'calls': self.calls[name],
+                                   'seconds': self.seconds[name]})
+                           for name in self.seconds),
+            'counters': dict(self.counters)
+        }
+
+    def format_summary(self):
+        """ Return summary formatted as a human readable table """
+        summary = self.summary()
+        lines = ['Wall time: {t:.3f}s'.format(t=summary['wall_seconds'])]
+        for name, stage in sorted(summary['stages'].items(),
+                                  key=lambda item: -item[1]['seconds']):
+            lines.append('{n:>16}: {s:10.3f}s {c:8d} calls'.format(
+                n=name, s=stage['seconds'], c=stage['calls']))
+        for name, value in sorted(summary['counters'].items()):
+            lines.append('{n:>16}: {v}'.format(n=name, v=value))
+        return '\n'.join(lines)
+
+    def write_json(self, filename):
+        """ Write summary as JSON """
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+    def write_trace(self, filename):
+        """ Write stage events in the Chrome trace event format """
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events}, f)
+
+
+def enable(trace=False):
+    """ Activate and return a new `Profiler` """
+    global _active
+    _active = Profiler(trace=trace)
+    return _active
+
+
+def disable():
+    """ Deactivate profiling, returning the previously active `Profiler` """
+    global _active
+    profiler, _active = _active, None
+    return profiler
+
+
+def get():
+    """ Return the active `Profiler`, or None if profiling is disabled """
+    return _active
+
+
+def stage(name):
+    """ Return context manager timing a stage of the pipeline """
+    if _active is None:
+        return _NULL_STAGE
+    return _Stage(_active, name)
+
+
+def count(name, value=1):
+    """ Add to a counter if profiling is enabled """
+    if _active is not None:
+        _active.count(name, value)
+
+
+def profiled(name):
+    """ Decorator timing each call of a function as a stage """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            with _Stage(_active, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*
+import logging
+
+import numpy as np
+from osgeo import gdal
+
+from composite_algorithm import Compositor
+import kernels
+import masks
+
+gdal.AllRegister()
+gdal.UseExceptions()
+
+logger = logging.getLogger('image_compositor')
+
+
+class QuantileCompositor(Compositor):
+    """ Base class for per-band temporal quantile composites
+
+    Each band of the composite is the quantile of the valid observations of
+    that band. Stacks with more than `_sketch_nimage` images are summarized
+    with an approximate, streaming histogram sketch that reads one image and
+    band at a time instead of the entire chunk of the stack.
+
+    Subclasses define the quantile to compute in `_quantile`. Summary
+    outputs count the clear observations whose first band is valid, on both
+    paths. Bands of an observation are assumed to be valid together, so
+    where other bands hold the NoDataValue on their own, their quantile is
+    of fewer observations than counted.
+
+    """
+
+    _quantile = 50.0
+    _ndv = -9999
+    _sketch_nimage = 250
+    _sketch_range = [0, 10000]
+    _sketch_bins = 256
+
+    input_info = (['_ndv', '_sketch_nimage', '_sketch_range', '_sketch_bins'] +
+                  Compositor.mask_input_info + Compositor.warp_input_info +
+                  Compositor.summary_input_info)
+    input_info_str = (['NoDataValue',
+                       'Approximate above # of images',
+                       'Approximate value range',
+                       'Approximation # of bins'] +
+                      Compositor.mask_input_info_str +
+                      Compositor.warp_input_info_str +
+                      Compositor.summary_input_info_str)
+
+    def process_chunk(self, xoff, yoff, xsize, ysize):
+        """ Process a chunk of an image
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns to process
+          ysize (int): number of rows to process
+
+        Returns:
+          composite (np.ndarray): composited chunk, followed by any summary
+            bands, shaped (out_nband, ysize, xsize)
+
+        """
+        if len(self.images) > self._sketch_nimage:
+            return self._process_chunk_sketch(xoff, yoff, xsize, ysize)
+
+        cube = self.read_chunk(xoff, yoff, xsize, ysize)
+
+        # Counted using the first band only, as by the sketch
+        return self.append_summary(
+            kernels.quantile(cube, self._quantile, self._ndv),
+            cube[:, 0] != self._ndv)
+
+    def _process_chunk_sketch(self, xoff, yoff, xsize, ysize):
+        """ Approximate quantiles streaming one image band at a time """
+        composite = np.empty((self.nband, ysize, xsize), dtype=self.dtype)
+        buf = np.empty((1, ysize, xsize), dtype=self.dtype)
+
+        clear = self.read_clear_chunk(xoff, yoff, xsize, ysize)
+        if clear is not None:
+            cloudy = ~masks.unpack(clear, xsize)
+        count = np.zeros((1, ysize, xsize), dtype=np.uint32)
+
+        for b in range(self.nband):
+            sketch = kernels.QuantileSketch((ysize, xsize),
+                                            self._sketch_range[0],
+                                            self._sketch_range[1],
+                                            nbins=self._sketch_bins,
+                                            ndv=self._ndv)
+            for i in self._read_order(xoff, yoff, xsize, ysize):
+                if clear is not None and not clear[i].any():
+                    continue
+                self.read_image_chunk(i, xoff, yoff, xsize, ysize,
+                                      bands=[b], out=buf)
+                if clear is not None:
+                    buf[0, cloudy[i]] = self._ndv
+                sketch.update(buf[0])
+                if b == 0:
+                    count[0] += buf[0] != self._ndv
+            composite[b] = sketch.quantile(self._quantile, dtype=self.dtype)
+
+        return self.append_summary(composite, count)
+
+
+class MedianComposite(QuantileCompositor):
+    """ Median composite """
+
+    description = 'Median composite'
+
+    def __repr__(self):
+        return "Median composite"
+
+
+class PercentileComposite(QuantileCompositor):
+    """ Percentile composite (e.g., 25th or 75th percentile) """
+
+    _quantile = 25.0
+
+    input_info = ['_quantile'] + QuantileCompositor.input_info
+    input_info_str = ['Percentile'] + QuantileCompositor.input_info_str
+    description = 'Percentile composite'
+
+    def __repr__(self):
+        return "Percentile composite"
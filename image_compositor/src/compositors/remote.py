@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*
+""" remote.py
+
+Support for images read over the network, such as Cloud-Optimized GeoTIFFs
+(COGs) served over HTTP range requests
+
+Remote images are given either as GDAL virtual file system paths (e.g.,
+"/vsicurl/https://...", "/vsis3/bucket/key.tif") or as URLs, which are read
+through "/vsicurl/". Every request to a remote image costs a round trip, so
+the first time a remote image is opened the GDAL configuration options in
+`CONFIG` are applied, unless already set by the user (e.g., in the
+environment), to:
+
+    - avoid listing the remote directory when opening an image
+    - fetch the header and IFDs of an image in one request when opened
+    - merge requests for consecutive byte ranges into one
+    - cache the blocks read from remote images
+
+"""
+from collections import OrderedDict
+import logging
+import threading
+
+from osgeo import gdal
+
+gdal.AllRegister()
+gdal.UseExceptions()
+
+logger = logging.getLogger('image_compositor')
+
+#: GDAL virtual file systems reading from the network
+VSI_PREFIXES = ('/vsicurl/', '/vsicurl_streaming/', '/vsis3/', '/vsigs/',
+                '/vsiaz/', '/vsiadls/', '/vsioss/', '/vsiswift/',
+                '/vsiwebhdfs/')
+#: URL schemes read through "/vsicurl/"
+URL_SCHEMES = ('http://', 'https://', 'ftp://')
+
+#: GDAL configuration options applied when reading remote images
+CONFIG = OrderedDict([
+    ('GDAL_DISABLE_READDIR_ON_OPEN', 'EMPTY_DIR'),
+    ('GDAL_INGESTED_BYTES_AT_OPEN', str(64 * 1024)),
+    ('GDAL_HTTP_MERGE_CONSECUTIVE_RANGES', 'YES'),
+    ('GDAL_HTTP_MULTIRANGE', 'YES'),
+    ('VSI_CACHE', 'TRUE'),
+    ('CPL_VSIL_CURL_CACHE_SIZE', str(256 * 1024 * 1024)),
+])
+
+_configured = False
+_lock = threading.Lock()
+
+
+def is_remote(filename):
+    """ Return True if an image is read over the network
+
+    Args:
+      filename (str): filename, GDAL virtual file system path or URL
+
+    Returns:
+      bool: True if image is remote
+
+    """
+    return filename.startswith(VSI_PREFIXES) or \
+        filename.lower().startswith(URL_SCHEMES)
+
+
+def vsi_path(filename):
+    """ Return the path used to open an image with GDAL
+
+    URLs are read through "/vsicurl/" and other filenames are unchanged.
+
+    Args:
+      filename (str): filename, GDAL virtual file system path or URL
+
+    Returns:
+      str: path to open with GDAL
+
+    """
+    if filename.lower().startswith(URL_SCHEMES):
+        return '/vsicurl/' + filename
+    return filename
+
+
+def configure(options=None):
+    """ Apply GDAL configuration options for remote images, once per process
+
+    Options already set (e.g., as environment variables) are not changed.
+
+    Args:
+      options (dict, optional): options to apply (default: `CONFIG`)
+
+    Returns:
+      dict: options applied by this call
+
+    """
+    global _configured
+    with _lock:
+        if _configured and options is None:
+            return {}
+
+        applied = OrderedDict()
+        for key, value in (CONFIG if options is None else options).items():
+            if gdal.GetConfigOption(key) is None:
+                gdal.SetConfigOption(key, value)
+                applied[key] = value
+        if options is None:
+            _configured = True
+
+    if applied:
+        logger.debug('Set GDAL options for remote images: {o}'.format(
+            o=', '.join('{k}={v}'.format(k=k, v=v)
+                        for k, v in applied.items())))
+    return applied
+
+
+def is_cog(ds):
+    """ Return True if a dataset is laid out as a Cloud-Optimized GeoTIFF
+
+    Args:
+      ds (gdal.Dataset): opened dataset
+
+    Returns:
+      bool: True if dataset is a COG, or a tiled GeoTIFF if the GDAL version
+        does not report the layout
+
+    """
+    if ds.GetDriver().ShortName != 'GTiff':
+        return False
+    layout = ds.GetMetadataItem('LAYOUT', 'IMAGE_STRUCTURE')
+    if layout is not None:
+        return layout == 'COG'
+    xblock, yblock = ds.GetRasterBand(1).GetBlockSize()
+    return xblock != ds.RasterXSize and yblock != 1
+
+
+def clear_cache():
+    """ Forget cached headers and blocks of remote images """
+    if hasattr(gdal, 'VSICurlClearCache'):
+        gdal.VSICurlClearCache()
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*
+""" scheduling.py
+
+Cost-aware ordering of chunks processed in parallel
+
+Chunks are far from uniform: chunks over the edges of scenes have few
+observations to read and composite, while interior chunks of a long stack
+have hundreds. Dispatched row by row, the last expensive chunks leave
+workers idle at the end of a run. `schedule` instead estimates the cost of
+each chunk from the footprints of the images overlapping it and dispatches
+the most expensive chunks first. Chunks of similar cost are ordered along a
+Hilbert curve, so consecutive chunks read neighbouring blocks of the same
+images, which are more likely to still be open and cached.
+
+Workers take another chunk as soon as they finish one and chunks are
+written as they complete (see `wait_next`), so a slow chunk never holds up
+the others.
+
+"""
+import logging
+
+import numpy as np
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger('image_compositor')
+
+#: Number of levels chunk costs are rounded to before ordering, so chunks of
+#: similar cost keep their order along the Hilbert curve
+COST_LEVELS = 16
+
+
+def hilbert_index(x, y, n):
+    """ Return the distance of cells along a Hilbert curve
+
+    Args:
+      x (np.ndarray): column of each cell
+      y (np.ndarray): row of each cell
+      n (int): number of cells along each side of the curve's square, a
+        power of 2 larger than any `x` or `y`
+
+    Returns:
+      np.ndarray: distance of each cell along the curve
+
+    """
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    d = np.zeros(x.shape, dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve continues through it
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s //= 2
+    return d
+
+
+def chunk_costs(compositor, windows):
+    """ Estimate the cost of processing chunks of a compositor
+
+    The cost of a chunk is the number of observations within it, that is
+    the area of the chunk covered by each image summed over the images.
+
+    Args:
+      compositor (Compositor or JobSet): algorithm with validated images
+      windows (list): x offset, y offset, number of columns and rows of each
+        chunk
+
+    Returns:
+      np.ndarray: estimated cost of each chunk
+
+    """
+    xoff, yoff, xsize, ysize = np.array(windows, dtype=np.int64).T[:, :, None]
+    costs = np.zeros(len(windows))
+    # A JobSet processes each chunk with each of its compositors
+    for c in getattr(compositor, 'compositors', [compositor]):
+        if not c.images:
+            continue
+        col_off, row_off = np.array(c.offsets, dtype=np.int64).T
+        ncol, nrow = np.array(c.sizes, dtype=np.int64).T
+        # Pixels of the scaled grid covered by each image (see
+        # `Compositor._image_window`)
+        x0 = np.maximum(xoff, -(-col_off // c.scale))
+        y0 = np.maximum(yoff, -(-row_off // c.scale))
+        x1 = np.minimum(xoff + xsize, (col_off + ncol) // c.scale)
+        y1 = np.minimum(yoff + ysize, (row_off + nrow) // c.scale)
+        costs += (np.maximum(x1 - x0, 0) * np.maximum(y1 - y0, 0)).sum(axis=1)
+    return costs
+
+
+def schedule(compositor):
+    """ Return chunks of a compositor in the order to dispatch them
+
+    Chunks are ordered by decreasing estimated cost (see `chunk_costs`),
+    rounded to `COST_LEVELS` levels, then along a Hilbert curve over the
+    grid of chunks. Compositors with a `chunk_order` of "rows" keep the
+    order of `iter_chunks`.
+
+    Args:
+      compositor (Compositor or JobSet): algorithm with validated images
+
+    Returns:
+      list: x offset, y offset, number of columns and rows of each chunk
+
+    """
+    windows = list(compositor.iter_chunks())
+    if getattr(compositor, 'chunk_order', 'cost') == 'rows' or \
+            len(windows) < 2:
+        return windows
+
+    costs = chunk_costs(compositor, windows)
+    levels = np.ceil(costs / max(costs.max(), 1) * COST_LEVELS)
+
+    xsize, ysize = windows[0][2:]
+    cols = np.array([w[0] // xsize for w in windows])
+    rows = np.array([w[1] // ysize for w in windows])
+    n = 1
+    while n <= max(cols.max(), rows.max()):
+        n *= 2
+    order = np.lexsort((hilbert_index(cols, rows, n), -levels))
+
+    logger.debug('Scheduled {n} chunks costing from {lo:.0f} to {hi:.0f} '
+                 'observations'.format(n=len(windows), lo=costs.min(),
+                                       hi=costs.max()))
+    return [windows[i] for i in order]
+
+
+def wait_next(done, pending, timeout=0.1):
+    """ Return the result of the next task to complete
+
+    Tasks are dispatched using `apply_async` with a callback putting their
+    result on a queue, which is not called if a task fails, so pending
+    tasks are checked for failures while waiting.
+
+    Args:
+      done (queue.Queue): results of completed tasks
+      pending (dict): `AsyncResult` of each task not yet completed
+      timeout (float, optional): seconds between checks for failures
+
+    Returns:
+      result of the next task to complete
+
+    Raises:
+      Exception: the exception raised by a failed task
+
+    """
+    while True:
+        try:
+            return done.get(timeout=timeout)
+        except queue.Empty:
+            for result in pending.values():
+                if result.ready() and not result.successful():
+                    result.get()
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*
+""" stack_store.py
+
+Time-major chunked store of a validated image stack
+
+Images stored one scene per file are chunked spatially, so reading a chunk
+of the stack reads from as many files as there are images. `ingest` instead
+copies a validated stack, on its composite grid, into a Zarr store chunked
+as (time, band, y, x) with every date of a chunk of the grid in the same
+chunk. Compositors given the store as their `stack_store` then read each
+chunk of the stack with one contiguous read (see `Compositor.prepare_store`).
+
+The store holds the arrays:
+
+    - data: observations as read by `Compositor.read_masked_chunk`, shaped
+      (nimage, nband, nrow, ncol), and the NoDataValue where an image does
+      not cover the grid
+    - clear: clear observations shaped (nimage, nrow, ncol), if any images
+      are masked
+    - dates: acquisition date of each image as `datetime64[D]`
+
+and, as attributes, the paths of the images, the grid and the options they
+were read with. Compositors read from a store only if their grid and these
+options match, and read the images otherwise.
+
+Example:
+    >>> reader = StackReader()
+    >>> reader._mask_band = 8
+    >>> reader.validate_images(images)
+    >>> ingest(reader, 'stack.zarr')
+    >>> compositor = NDVIComposite()
+    >>> compositor._mask_band = 8
+    >>> compositor.stack_store = StackStore('stack.zarr')
+    >>> compositor.validate_images(images)
+    >>> compositor.process_image('composite.gtif')
+
+"""
+import json
+import logging
+
+import numpy as np
+
+from collection import ImageCollection
+from composite_algorithm import Compositor
+import masks
+import profiling
+
+logger = logging.getLogger('image_compositor')
+
+try:
+    import zarr
+except ImportError:
+    HAS_ZARR = False
+else:
+    HAS_ZARR = True
+
+#: Compositor options that must match those a store was ingested with
+STORE_OPTIONS = ['_ndv', '_mask_band', '_mask_sidecar', '_mask_clear',
+                 '_warp', '_resampling']
+
+
+def _check_zarr():
+    """ Raise ImportError if Zarr is not installed """
+    if not HAS_ZARR:
+        raise ImportError('Image stack stores require "zarr"')
+
+
+class StackReader(Compositor):
+    """ Reads, rather than composites, an image stack for `ingest`
+
+    Only the NoDataValue and the mask and warp options apply.
+
+    """
+
+    input_info = (['_ndv'] + Compositor.mask_input_info +
+                  Compositor.warp_input_info)
+    input_info_str = (['NoDataValue'] + Compositor.mask_input_info_str +
+                      Compositor.warp_input_info_str)
+    description = 'Image stack reader'
+
+    def __repr__(self):
+        return "Image stack reader"
+
+    def process_chunk(self, xoff, yoff, xsize, ysize):
+        raise NotImplementedError('StackReader only reads images; use '
+                                  '"ingest" to store them')
+
+
+def ingest(compositor, path, time_chunk=None):
+    """ Write the validated images of a compositor to a stack store
+
+    Chunks of the store match the chunks of the compositor (see
+    `Compositor.iter_chunks`).
+
+    Args:
+      compositor (Compositor): compositor with validated images, usually
+        a `StackReader`
+      path (str): directory of the store, replaced if it exists
+      time_chunk (int, optional): number of images per chunk (default: all)
+
+    Returns:
+      StackStore: the store written
+
+    """
+    _check_zarr()
+    nimage = len(compositor.images)
+    windows = list(compositor.iter_chunks())
+    xsize, ysize = windows[0][2:]
+    time_chunk = time_chunk or nimage
+    masked = any(compositor.masks)
+    logger.debug('Ingesting {n} images into {p} in {c} chunks'.format(
+        n=nimage, p=path, c=len(windows)))
+
+    group = zarr.open_group(path, mode='w')
+    data = group.create_dataset(
+        'data', shape=(nimage, compositor.nband,
+                       compositor.nrow, compositor.ncol),
+        chunks=(time_chunk, compositor.nband, ysize, xsize),
+        dtype=compositor.dtype, fill_value=compositor._ndv)
+    if masked:
+        clear = group.create_dataset(
+            'clear', shape=(nimage, compositor.nrow, compositor.ncol),
+            chunks=(time_chunk, ysize, xsize), dtype=bool, fill_value=False)
+    group.create_dataset('dates', data=compositor.collection.dates)
+
+    for xoff, yoff, xsize, ysize in windows:
+        cube, packed = compositor.read_masked_chunk(xoff, yoff, xsize, ysize)
+        window = (slice(yoff, yoff + ysize), slice(xoff, xoff + xsize))
+        with profiling.stage('write'):
+            data[(slice(None), slice(None)) + window] = cube
+            if masked:
+                clear[(slice(None), ) + window] = masks.unpack(packed, xsize)
+        profiling.count('chunks')
+
+    group.attrs.update({
+        'paths': compositor.images,
+        'grid_size': list(compositor.grid_size),
+        'grid_transform': list(compositor.grid_transform),
+        'projection': compositor.proj,
+        'options': dict((name, getattr(compositor, name))
+                        for name in STORE_OPTIONS)
+    })
+    compositor.datasets.close()
+    return StackStore(path)
+
+
+class StackStore(object):
+    """ Image stack ingested into a time-major chunked store
+
+    Args:
+      path (str): directory of a store written by `ingest`
+
+    Attributes:
+      path (str): directory of the store
+      paths (list): filenames of the images, in the order stored
+      grid_size (tuple): number of columns and rows of the grid
+      grid_transform (tuple): geo-transform of the grid
+      options (dict): compositor options the images were read with (see
+        `STORE_OPTIONS`)
+
+    """
+
+    def __init__(self, path):
+        _check_zarr()
+        self.path = path
+        self._group = zarr.open_group(path, mode='r')
+        attrs = self._group.attrs
+        self.paths = list(attrs['paths'])
+        self.grid_size = tuple(attrs['grid_size'])
+        self.grid_transform = tuple(attrs['grid_transform'])
+        self.options = attrs['options']
+        self._positions = dict((p, i) for i, p in enumerate(self.paths))
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __repr__(self):
+        return 'StackStore({p})'.format(p=self.path)
+
+    @property
+    def data(self):
+        """ zarr.Array: observations shaped (nimage, nband, nrow, ncol) """
+        return self._group['data']
+
+    @property
+    def masked(self):
+        """ bool: True if clear observations are stored """
+        return 'clear' in self._group
+
+    @property
+    def dates(self):
+        """ np.ndarray: acquisition date of each image as `datetime64[D]` """
+        return self._group['dates'][:]
+
+    @property
+    def collection(self):
+        """ ImageCollection: images of the store with their dates """
+        return ImageCollection(self.paths, dates=self.dates)
+
+    def locate(self, compositor):
+        """ Return the position in the store of each valid image
+
+        Args:
+          compositor (Compositor): compositor with validated images
+
+        Returns:
+          np.ndarray: index of each of `compositor.images` in the store
+
+        Raises:
+          ValueError: raised if the compositor cannot read from the store
+            because it composites onto another grid or at another scale,
+            uses other options or images not in the store
+
+        """
+        if compositor.scale != 1:
+            raise ValueError('the store is not decimated')
+        if (tuple(compositor.grid_size) != self.grid_size or
+                tuple(compositor.grid_transform) != self.grid_transform):
+            raise ValueError('the composite grid differs')
+        if compositor.nband != self.data.shape[1] or \
+                np.dtype(compositor.dtype) != self.data.dtype:
+            raise ValueError('the number of bands or data type differs')
+        for name in STORE_OPTIONS:
+            # Compare as stored, where tuples become lists
+            value = json.loads(json.dumps(getattr(compositor, name)))
+            if value != self.options.get(name):
+                raise ValueError('option "{n}" differs'.format(n=name))
+
+        missing = [image for image in compositor.images
+                   if image not in self._positions]
+        if missing:
+            raise ValueError('{n} images are not in the store (e.g., '
+                             '{i})'.format(n=len(missing), i=missing[0]))
+        return np.array([self._positions[image]
+                         for image in compositor.images])
+
+    def read(self, xoff, yoff, xsize, ysize):
+        """ Read a chunk of all images in the store
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns to read
+          ysize (int): number of rows to read
+
+        Returns:
+          np.ndarray: chunk shaped (nimage, nband, ysize, xsize)
+
+        """
+        with profiling.stage('read'):
+            data = self.data[:, :, yoff:yoff + ysize, xoff:xoff + xsize]
+        profiling.count('bytes_read', data.nbytes)
+        return data
+
+    def read_clear(self, xoff, yoff, xsize, ysize):
+        """ Read clear observations of a chunk of all images in the store
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          xsize (int): number of columns to read
+          ysize (int): number of rows to read
+
+        Returns:
+          np.ndarray: clear observations shaped (nimage, ysize, xsize)
+
+        """
+        with profiling.stage('read_mask'):
+            return self._group['clear'][:, yoff:yoff + ysize,
+                                        xoff:xoff + xsize]
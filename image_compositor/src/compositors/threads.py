@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*
+""" threads.py
+
+Multithreaded execution of compositing algorithms
+
+Unlike the pool of processes in `parallel.py`, a pool of threads does not
+fork or spawn the running program, so it can be used from within QGIS.
+GDAL releases the GIL while reading and decoding blocks, as does NumPy in
+most kernels, so threads still composite chunks concurrently.
+
+GDAL datasets must not be used by more than one thread at once, so each
+thread composites with its own copy of the compositor, made the first time
+the thread processes a chunk. The copy opens its own datasets and reads
+each chunk of the image stack into the same scratch buffer (see
+`Compositor.reuse_buffers`). Chunks are dispatched most expensive first
+(see `scheduling.py`) and written by the calling thread as they complete,
+unless the writer allows parallel writes (e.g., `writers.TileWriter`).
+
+"""
+import copy
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
+
+import profiling
+import scheduling
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger('image_compositor')
+
+
+def _thread_copy(compositor):
+    """ Return a copy of a compositor for use by one thread
+
+    Args:
+      compositor (Compositor or JobSet): algorithm with validated images
+
+    Returns:
+      Compositor or JobSet: copy with its own datasets and scratch buffers
+
+    """
+    _copy = copy.deepcopy(compositor)
+    # A JobSet composites using each of its compositors
+    for c in getattr(_copy, 'compositors', [_copy]):
+        c.reuse_buffers = True
+    return _copy
+
+
+def process_chunks(compositor, writer, nthread, nslot=None):
+    """ Composite all chunks of an image using a pool of threads
+
+    Chunks are dispatched in the order given by `scheduling.schedule` and
+    written as they complete, not in the order dispatched. At most `nslot`
+    chunks are composited or waiting to be written at once, bounding
+    memory use.
+
+    Args:
+      compositor (Compositor or JobSet): algorithm with validated images
+      writer (GDALWriter or TileWriter): output writer
+      nthread (int): number of worker threads
+      nslot (int, optional): number of chunks in flight (default:
+        2 * nthread)
+
+    """
+    nslot = nslot or 2 * nthread
+    local = threading.local()
+
+    def composite(window):
+        if getattr(local, 'compositor', None) is None:
+            local.compositor = _thread_copy(compositor)
+        xoff, yoff, xsize, ysize = window
+        with profiling.stage('process_chunk'):
+            result = local.compositor.process_chunk(xoff, yoff, xsize, ysize)
+        profiling.count('chunks')
+        if writer.parallel:
+            writer.write(xoff, yoff, result)
+            return window, None
+        return window, result
+
+    windows = scheduling.schedule(compositor)
+    logger.debug('Compositing {n} chunks with {t} threads'.format(
+        n=len(windows), t=nthread))
+
+    pool = ThreadPool(nthread)
+    done = queue.Queue()
+    pending = {}
+
+    def dispatch(window):
+        pending[window] = pool.apply_async(composite, (window,),
+                                           callback=done.put)
+
+    try:
+        windows = iter(windows)
+        for _, window in zip(range(nslot), windows):
+            dispatch(window)
+
+        while pending:
+            window, result = scheduling.wait_next(done, pending)
+            del pending[window]
+            if not writer.parallel:
+                writer.write(window[0], window[1], result)
+
+            window = next(windows, None)
+            if window is not None:
+                dispatch(window)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*
+""" validation.py
+
+Incremental validation of images for compositing algorithms
+
+`ImageValidator` remembers the reference grid and, for every image it has
+checked, the image's attributes and whether it matches the reference grid.
+Checking a list of images only opens images not seen before. Verdicts also
+depend on the algorithm's requirements (see `Compositor.requirements`),
+such as the band numbers it reads; when those change, verdicts are
+re-evaluated from the remembered attributes without opening any images.
+
+If the algorithm warps images (see `Compositor.warp_input_info`), images with a
+different projection, pixel size or posting than the reference image are
+valid and a warped VRT placing each onto the reference grid is built once
+(see `warping.py`).
+
+
+"""
+import logging
+import threading
+
+import masks
+import warping
+
+logger = logging.getLogger('image_compositor')
+
+
+class ImageValidator(object):
+    """ Remembers image attributes and verdicts across validations
+
+    Attributes:
+      reference (tuple): attributes of the reference image, the first image
+        found valid (see `Compositor._get_image_attributes`), or None if no
+        image has been found valid
+      masks (dict): mask of each valid image (see `masks.find_mask`)
+      sources (dict): filename or warped VRT to read each valid image from
+
+    """
+
+    def __init__(self):
+        self.reference = None
+        self._reference_image = None
+        self.masks = {}
+        self.sources = {}
+        self._attributes = {}
+        self._warped = {}
+        self._differences = {}
+        self._verdicts = {}
+        self._requirements = None
+        self._lock = threading.RLock()
+
+    def __contains__(self, image):
+        return image in self._verdicts
+
+    def check(self, images, compositor):
+        """ Return whether each image is usable by a compositing algorithm
+
+        Args:
+          images (list): filenames of images
+          compositor (Compositor): compositing algorithm
+
+        Returns:
+          valid (list): True or False for each image
+
+        """
+        with self._lock:
+            requirements = compositor.requirements()
+            if requirements != self._requirements:
+                # The reference image may no longer be valid
+                self.reference = None
+                self._reference_image = None
+                self._differences.clear()
+                self._verdicts.clear()
+                self._requirements = requirements
+
+            # List the directory of each image once to find mask files
+            listings = {}
+            for image in images:
+                if image not in self._verdicts:
+                    self._verdicts[image] = self._evaluate(image, compositor,
+                                                           listings)
+
+            return [self._verdicts[image] for image in images]
+
+    def forget(self, images):
+        """ Forget everything known about images (e.g., once removed)
+
+        Forgetting the reference image forgets the reference grid, and so
+        every verdict and warped VRT, which depend on it.
+
+        """
+        with self._lock:
+            if self._reference_image in images:
+                self.reference = None
+                self._reference_image = None
+                for cache in (self._differences, self._verdicts,
+                              self._warped, self.masks, self.sources):
+                    cache.clear()
+            for image in images:
+                for cache in (self._attributes, self._differences,
+                              self._verdicts, self.masks, self.sources):
+                    cache.pop(image, None)
+                for key in [k for k in self._warped if k[0] == image]:
+                    del self._warped[key]
+
+    def _get_attributes(self, image, compositor):
+        """ Return cached attributes of an image, or None if unusable """
+        if image not in self._attributes:
+            try:
+                self._attributes[image] = \
+                    compositor._get_image_attributes(image)
+            except (ValueError, RuntimeError):
+                logger.warning('Cannot use image {i}'.format(i=image))
+                self._attributes[image] = None
+        return self._attributes[image]
+
+    def _grid_differences(self, attributes):
+        """ Return how image attributes differ from the reference grid """
+        proj, px_size, py_size, ul_x, ul_y, nband = self.reference
+        _proj, _px, _py, _ul_x, _ul_y, _nband = attributes
+        differences = []
+
+        if _proj != proj:
+            differences.append('projection')
+        if _px != px_size or _py != py_size:
+            differences.append('pixel size')
+        elif (ul_x - _ul_x) % px_size != 0 or (ul_y - _ul_y) % py_size != 0:
+            differences.append('posting')
+        if _nband != nband:
+            differences.append('number of bands')
+
+        return differences
+
+    def _warped_vrt(self, filename, compositor, resampling, ndv=None,
+                    fill=None):
+        """ Return cached warped VRT of a file onto the reference grid
+
+        See `warping.warped_vrt` for the arguments.
+
+        """
+        key = (filename, resampling, ndv, fill, compositor.warp_error,
+               self.reference)
+        if key not in self._warped:
+            proj, px_size, py_size, ul_x, ul_y, _ = self.reference
+            self._warped[key] = warping.warped_vrt(
+                filename, proj, (ul_x, px_size, 0, ul_y, 0, py_size),
+                resampling=resampling, ndv=ndv, fill=fill,
+                error_threshold=compositor.warp_error)
+        return self._warped[key]
+
+    def _evaluate(self, image, compositor, listings=None):
+        """ Return verdict for one image """
+        attributes = self._get_attributes(image, compositor)
+        if attributes is None:
+            return False
+
+        # Images are only compared to a reference that is itself valid, so
+        # the first image passing every check becomes the reference
+        adopt = self.reference is None
+        if adopt:
+            differences = []
+        else:
+            if image not in self._differences:
+                self._differences[image] = self._grid_differences(attributes)
+            differences = self._differences[image]
+
+        warp = compositor._warp and 'number of bands' not in differences
+        if differences and not warp:
+            for difference in differences:
+                logger.warning('Image {i} has different {d} than base '
+                               'image'.format(i=image, d=difference))
+            return False
+
+        nband = attributes[-1]
+        bands = compositor.required_bands()
+        if any(b < 1 or b > nband for b in bands):
+            logger.warning('Image {i} does not have required bands '
+                           '{b}'.format(i=image, b=bands))
+            return False
+
+        try:
+            mask = masks.find_mask(image, band=compositor._mask_band,
+                                   sidecar=compositor._mask_sidecar,
+                                   listings=listings)
+        except ValueError:
+            return False
+
+        source = image
+        if differences:
+            # Masks are categorical, so they are always warped by nearest,
+            # keeping their own NoDataValue and filling areas outside the
+            # image with a value that is not clear
+            try:
+                source = self._warped_vrt(image, compositor,
+                                          compositor._resampling,
+                                          ndv=compositor._ndv)
+                if mask is not None:
+                    mask = (self._warped_vrt(
+                        mask[0], compositor, 'near',
+                        fill=masks.not_clear_value(compositor._mask_clear)),
+                        mask[1])
+            except (ValueError, RuntimeError) as e:
+                logger.warning('Cannot warp image {i}: {e}'.format(i=image,
+                                                                   e=e))
+                return False
+
+        if adopt:
+            self.reference = attributes
+            self._reference_image = image
+            self._differences[image] = differences
+        self.masks[image] = mask
+        self.sources[image] = source
+        return True
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*
+""" warping.py
+
+Warped VRTs placing images with a different projection, pixel size or
+posting onto the composite grid
+
+Rather than warping every image to disk before compositing, a warped VRT
+is built for each image that is not on the composite grid. It covers the
+image's footprint, snapped outward to the grid so the image is placed by a
+whole pixel offset. Chunks are then read through the VRT, which warps only
+the requested window.
+
+The VRT stores the transformer between the grid and the image and the error
+threshold used to approximate it, so the transformer is built once when the
+VRT is opened (see `datasets.DatasetPool`) instead of for every window.
+VRTs are kept as XML text, which GDAL opens directly and which pickles to
+worker processes.
+
+"""
+from __future__ import division
+
+import logging
+import math
+import os
+
+from osgeo import gdal
+
+import remote
+
+gdal.AllRegister()
+gdal.UseExceptions()
+
+logger = logging.getLogger('image_compositor')
+
+#: Resampling methods available for warping
+RESAMPLING = ('near', 'bilinear', 'cubic', 'cubicspline', 'lanczos',
+              'average', 'mode')
+
+#: Maximum error, in pixels, of the approximated transformer
+ERROR_THRESHOLD = 0.125
+
+# Tolerance, in pixels, when snapping footprints to the grid
+_EPS = 1e-6
+
+
+def _warp(ds, proj, px_size, py_size, resampling, ndv, fill,
+          error_threshold, bounds=None):
+    """ Return an in-memory warped VRT of a dataset """
+    return gdal.Warp('', ds, format='VRT', dstSRS=proj,
+                     xRes=abs(px_size), yRes=abs(py_size),
+                     outputBounds=bounds, resampleAlg=resampling,
+                     srcNodata=ndv, dstNodata=ndv if fill is None else fill,
+                     errorThreshold=error_threshold, multithread=False)
+
+
+def snap_bounds(geo_transform, ncol, nrow, grid_transform):
+    """ Return bounds of a raster snapped outward onto a grid
+
+    Args:
+      geo_transform (tuple): geo-transform of raster
+      ncol (int): number of columns of raster
+      nrow (int): number of rows of raster
+      grid_transform (tuple): geo-transform of grid (north-up)
+
+    Returns:
+      tuple: bounds as (min x, min y, max x, max y)
+
+    """
+    ul_x, px_size, _, ul_y, _, py_size = grid_transform
+    min_x = geo_transform[0]
+    max_x = min_x + geo_transform[1] * ncol
+    max_y = geo_transform[3]
+    min_y = max_y + geo_transform[5] * nrow
+
+    col0 = math.floor((min_x - ul_x) / px_size + _EPS)
+    col1 = math.ceil((max_x - ul_x) / px_size - _EPS)
+    row0 = math.floor((max_y - ul_y) / py_size + _EPS)
+    row1 = math.ceil((min_y - ul_y) / py_size - _EPS)
+
+    return (ul_x + col0 * px_size, ul_y + row1 * py_size,
+            ul_x + col1 * px_size, ul_y + row0 * py_size)
+
+
+def warped_vrt(filename, proj, grid_transform, resampling='near', ndv=None,
+               error_threshold=ERROR_THRESHOLD, fill=None):
+    """ Return a VRT warping an image onto a grid
+
+    Args:
+      filename (str): filename of image
+      proj (str): projection of grid as WKT
+      grid_transform (tuple): geo-transform of grid (north-up)
+      resampling (str, optional): resampling method (see `RESAMPLING`)
+      ndv (int or float, optional): NoDataValue of image, also used where
+        the VRT is not covered by the image unless `fill` is given
+        (default: the NoDataValue of the image's bands, if any)
+      error_threshold (float, optional): maximum error, in pixels, of the
+        approximated transformer
+      fill (int or float, optional): value where the VRT is not covered by
+        the image, or where the image has no data (e.g., a mask value that
+        is not clear)
+
+    Returns:
+      str: VRT as XML, which may be opened by `gdal.Open`
+
+    Raises:
+      ValueError: raised if resampling method is unknown
+
+    """
+    if resampling not in RESAMPLING:
+        raise ValueError('Unknown resampling method "{r}" (choose from '
+                         '{m})'.format(r=resampling, m=', '.join(RESAMPLING)))
+    if not remote.is_remote(filename):
+        filename = os.path.abspath(filename)
+    ds = gdal.Open(remote.vsi_path(filename), gdal.GA_ReadOnly)
+    px_size, py_size = grid_transform[1], grid_transform[5]
+
+    # Footprint of the image on the grid, then warp to the snapped footprint
+    vrt = _warp(ds, proj, px_size, py_size, resampling, ndv, fill,
+                error_threshold)
+    bounds = snap_bounds(vrt.GetGeoTransform(),
+                         vrt.RasterXSize, vrt.RasterYSize, grid_transform)
+    vrt = _warp(ds, proj, px_size, py_size, resampling, ndv, fill,
+                error_threshold, bounds=bounds)
+    logger.debug('Warping {f} to {n}x{m} pixels of the composite grid using '
+                 '{r} resampling'.format(f=filename, n=vrt.RasterXSize,
+                                         m=vrt.RasterYSize, r=resampling))
+
+    return vrt.GetMetadata('xml:VRT')[0]
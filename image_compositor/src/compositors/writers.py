@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*
+""" writers.py
+
+Output writers for composite images
+
+`GDALWriter` writes all chunks into one raster, so chunks composited by
+several workers are written one at a time by the parent process. It also
+accumulates statistics and a histogram of each band from the chunks
+written (see `band_stats.py`) and stores them with the raster (e.g., in its
+".aux.xml"), so it displays with the right stretch without another pass.
+`TileWriter` instead writes each chunk to its own file, which workers do
+themselves, and mosaics the tiles with a VRT once all are written. Workers
+send back the statistics of each tile with its filename, so the VRT gets
+statistics and a histogram too. The VRT may then be translated to a single
+Cloud-Optimized GeoTIFF using `translate_cog`, which compresses blocks
+using several threads and copies the statistics of the VRT.
+`MultiWriter` splits chunks holding several outputs between their writers.
+
+"""
+import logging
+import os
+import threading
+
+from osgeo import gdal
+
+from band_stats import BandStatistics
+import profiling
+
+gdal.AllRegister()
+gdal.UseExceptions()
+
+logger = logging.getLogger('image_compositor')
+
+
+def _band_statistics(nband, gdal_dtype, ndv):
+    """ Return empty statistics of each band of an output """
+    integer = gdal_dtype not in (gdal.GDT_Float32, gdal.GDT_Float64)
+    return [BandStatistics(ndv=ndv, integer=integer) for _ in range(nband)]
+
+
+def _set_statistics(ds, stats):
+    """ Store the statistics and histogram of each band of a dataset
+
+    Args:
+      ds (gdal.Dataset): output dataset
+      stats (list): `BandStatistics` of each band
+
+    """
+    npixel = ds.RasterXSize * ds.RasterYSize
+    for b, _stats in enumerate(stats):
+        if not _stats.count:
+            continue
+        band = ds.GetRasterBand(b + 1)
+        band.SetStatistics(float(_stats.minimum), float(_stats.maximum),
+                           float(_stats.mean), float(_stats.std))
+        band.SetMetadataItem('STATISTICS_VALID_PERCENT', '{p:.6g}'.format(
+            p=100.0 * _stats.count / npixel))
+        lo, hi, counts = _stats.histogram()
+        band.SetDefaultHistogram(lo, hi, counts)
+
+
+class GDALWriter(object):
+    """ Writes composited chunks into a single GDAL raster
+
+    Args:
+      filename (str): output filename
+      ncol (int): number of columns in output
+      nrow (int): number of rows in output
+      nband (int): number of bands in output
+      gdal_dtype (int): GDAL data type of output
+      proj (str): projection as WKT
+      geo_transform (tuple): geo-transform of output
+      ndv (int or float): NoDataValue, or None if every value is valid
+      driver (str, optional): GDAL driver name
+      creation_options (list, optional): GDAL creation options
+      statistics (bool, optional): store statistics and a histogram of
+        each band, accumulated while writing
+
+    """
+
+    #: Whether workers may write chunks themselves
+    parallel = False
+
+    def __init__(self, filename, ncol, nrow, nband, gdal_dtype,
+                 proj, geo_transform, ndv,
+                 driver='GTiff', creation_options=None, statistics=True):
+        self.filename = filename
+        self.nband = nband
+        self.stats = None
+        if statistics:
+            self.stats = _band_statistics(nband, gdal_dtype, ndv)
+
+        _driver = gdal.GetDriverByName(driver)
+        self.ds = _driver.Create(filename, ncol, nrow, nband, gdal_dtype,
+                                 creation_options or [])
+        self.ds.SetProjection(proj)
+        self.ds.SetGeoTransform(geo_transform)
+        if ndv is not None:
+            for b in range(nband):
+                self.ds.GetRasterBand(b + 1).SetNoDataValue(ndv)
+
+    @profiling.profiled('write')
+    def write(self, xoff, yoff, data):
+        """ Write a chunk of composited data
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          data (np.ndarray): chunk shaped (nband, ysize, xsize)
+
+        """
+        for b in range(self.nband):
+            self.ds.GetRasterBand(b + 1).WriteArray(data[b], xoff, yoff)
+            if self.stats is not None:
+                self.stats[b].update(data[b])
+        profiling.count('bytes_written', data.nbytes)
+
+    def write_statistics(self):
+        """ Store the statistics and histogram of each band written """
+        _set_statistics(self.ds, self.stats or [])
+
+    def close(self):
+        """ Store statistics, then flush and close output dataset """
+        if self.ds is not None:
+            with profiling.stage('write'):
+                self.write_statistics()
+                self.ds.FlushCache()
+            self.ds = None
+
+
+class TileWriter(object):
+    """ Writes each composited chunk to its own file, mosaicked by a VRT
+
+    Tiles are written to a directory named after the VRT (e.g.,
+    "composite_tiles/" for "composite.vrt"). Writers may be pickled and
+    used by several processes at once, since each tile is its own file;
+    tiles written by other processes, and their statistics, are added
+    using `add_tile`. Writers may also be used by several threads at once.
+
+    Args:
+      filename (str): output VRT filename
+      ncol (int): number of columns in output
+      nrow (int): number of rows in output
+      nband (int): number of bands in output
+      gdal_dtype (int): GDAL data type of output
+      proj (str): projection as WKT
+      geo_transform (tuple): geo-transform of output
+      ndv (int or float): NoDataValue, or None if every value is valid
+      driver (str, optional): GDAL driver name of tiles
+      creation_options (list, optional): GDAL creation options of tiles
+      statistics (bool, optional): store statistics and a histogram of
+        each band of the VRT, accumulated from the tiles written
+
+    """
+
+    #: Whether workers may write chunks themselves
+    parallel = True
+
+    def __init__(self, filename, ncol, nrow, nband, gdal_dtype,
+                 proj, geo_transform, ndv,
+                 driver='GTiff', creation_options=None, statistics=True):
+        self.filename = filename
+        self.ncol, self.nrow, self.nband = ncol, nrow, nband
+        self.gdal_dtype = gdal_dtype
+        self.proj = proj
+        self.geo_transform = geo_transform
+        self.ndv = ndv
+        self.driver = driver
+        self.creation_options = creation_options or []
+        self.statistics = statistics
+        self.stats = (_band_statistics(nband, gdal_dtype, ndv)
+                      if statistics else None)
+        self.tiles = []
+        self._lock = threading.Lock()
+
+        self.directory = os.path.splitext(filename)[0] + '_tiles'
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def tile_filename(self, xoff, yoff):
+        """ Return filename of the tile of a chunk
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+
+        Returns:
+          str: filename of tile
+
+        """
+        ext = gdal.GetDriverByName(self.driver).GetMetadataItem(
+            'DMD_EXTENSION') or 'tif'
+        name = os.path.splitext(os.path.basename(self.filename))[0]
+        return os.path.join(self.directory, '{n}_{y}_{x}.{e}'.format(
+            n=name, y=yoff, x=xoff, e=ext))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @profiling.profiled('write')
+    def write(self, xoff, yoff, data):
+        """ Write a chunk of composited data to its own tile
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          data (np.ndarray): chunk shaped (nband, ysize, xsize)
+
+        Returns:
+          tuple: filename of tile and statistics of each of its bands, or
+            None if statistics are not stored (see `add_tile`)
+
+        """
+        nband, ysize, xsize = data.shape
+        gt = self.geo_transform
+        filename = self.tile_filename(xoff, yoff)
+
+        ds = gdal.GetDriverByName(self.driver).Create(
+            filename, xsize, ysize, nband, self.gdal_dtype,
+            self.creation_options)
+        ds.SetProjection(self.proj)
+        ds.SetGeoTransform((gt[0] + xoff * gt[1] + yoff * gt[2], gt[1], gt[2],
+                            gt[3] + xoff * gt[4] + yoff * gt[5], gt[4], gt[5]))
+        for b in range(nband):
+            band = ds.GetRasterBand(b + 1)
+            if self.ndv is not None:
+                band.SetNoDataValue(self.ndv)
+            band.WriteArray(data[b])
+        band = None
+        ds = None
+        profiling.count('bytes_written', data.nbytes)
+
+        stats = None
+        if self.statistics:
+            stats = _band_statistics(nband, self.gdal_dtype, self.ndv)
+            for b in range(nband):
+                stats[b].update(data[b])
+
+        tile = (filename, stats)
+        self.add_tile(tile)
+        return tile
+
+    def add_tile(self, tile):
+        """ Add a tile written by another process to the mosaic
+
+        Args:
+          tile (tuple): filename of tile and statistics of each of its
+            bands, or None, as returned by `write`
+
+        """
+        filename, stats = tile
+        with self._lock:
+            if filename in self.tiles:
+                return
+            self.tiles.append(filename)
+            for _stats, _tile_stats in zip(self.stats or [], stats or []):
+                _stats.merge(_tile_stats)
+
+    def close(self):
+        """ Build the VRT mosaic of all tiles written and store statistics """
+        if not self.tiles:
+            return
+        with profiling.stage('write'):
+            vrt = gdal.BuildVRT(self.filename, sorted(self.tiles),
+                                VRTNodata=self.ndv)
+            _set_statistics(vrt, self.stats or [])
+            vrt.FlushCache()
+            vrt = None
+        logger.debug('Wrote VRT of {n} tiles to {f}'.format(
+            n=len(self.tiles), f=self.filename))
+        self.tiles = []
+
+
+class MultiWriter(object):
+    """ Splits chunks stacked along the band axis between several writers
+
+    Used to write the outputs of several jobs (see `jobs.JobSet`), whose
+    composited chunks are stacked in the order of the writers.
+
+    Args:
+      writers (list): writer of each output
+
+    """
+
+    def __init__(self, writers):
+        self.writers = writers
+        self.nband = sum(w.nband for w in writers)
+
+    @property
+    def parallel(self):
+        """ bool: whether workers may write chunks themselves """
+        return all(w.parallel for w in self.writers)
+
+    def write(self, xoff, yoff, data):
+        """ Write the bands of a chunk belonging to each output
+
+        Args:
+          xoff (int): x offset
+          yoff (int): y offset
+          data (np.ndarray): chunk shaped (nband, ysize, xsize)
+
+        Returns:
+          list: value returned by each writer (e.g., tile, see
+            `TileWriter.write`)
+
+        """
+        written = []
+        start = 0
+        for writer in self.writers:
+            written.append(writer.write(xoff, yoff,
+                                        data[start:start + writer.nband]))
+            start += writer.nband
+        return written
+
+    def add_tile(self, tiles):
+        """ Add the tiles of a chunk written by another process """
+        for writer, tile in zip(self.writers, tiles):
+            writer.add_tile(tile)
+
+    def close(self):
+        """ Close all writers """
+        for writer in self.writers:
+            writer.close()
+
+
+def translate_cog(src, output, ncpu=None, creation_options=None):
+    """ Translate a raster, such as a VRT of tiles, to a single COG
+
+    Statistics and the default histogram of each band of the raster, if
+    any, are copied to the COG (e.g., into its ".aux.xml").
+
+    Args:
+      src (str): filename of raster to translate
+      output (str): output filename
+      ncpu (int, optional): number of threads compressing blocks (default:
+        all CPUs)
+      creation_options (list, optional): additional COG creation options
+
+    Raises:
+      ValueError: raised if GDAL does not have the COG driver (GDAL >= 3.1)
+
+    """
+    if gdal.GetDriverByName('COG') is None:
+        raise ValueError('Translating to a COG requires GDAL >= 3.1')
+
+    options = ['COMPRESS=DEFLATE',
+               'NUM_THREADS={n}'.format(n=ncpu or 'ALL_CPUS')]
+    with profiling.stage('translate'):
+        ds = gdal.Translate(output, src, format='COG',
+                            creationOptions=options + (creation_options or []))
+        _copy_statistics(gdal.Open(src), ds)
+        ds = None
+
+
+def _copy_statistics(src, dst):
+    """ Copy statistics and default histograms between bands of datasets
+
+    Args:
+      src (gdal.Dataset): dataset to copy from
+      dst (gdal.Dataset): dataset to copy to
+
+    """
+    for b in range(1, src.RasterCount + 1):
+        src_band, dst_band = src.GetRasterBand(b), dst.GetRasterBand(b)
+        for key, value in (src_band.GetMetadata() or {}).items():
+            if key.startswith('STATISTICS_'):
+                dst_band.SetMetadataItem(key, value)
+        histogram = src_band.GetDefaultHistogram(force=False)
+        if histogram is not None:
+            lo, hi, _, counts = histogram
+            dst_band.SetDefaultHistogram(lo, hi, counts)
@@ -19,15 +19,28 @@ class ZZCompositor(Compositor):
     _nir = 4
     _ndv = -9999
 
-    input_info = ['_blue', '_nir', '_ndv']
-    input_info_str = ['Blue Band Number',
-                      'NIR Band Number',
-                      'NoDataValue']
+    input_info = (['_blue', '_nir', '_ndv'] + Compositor.mask_input_info +
+                  Compositor.warp_input_info +
+                  Compositor.summary_input_info)
+    input_info_str = (['Blue Band Number',
+                       'NIR Band Number',
+                       'NoDataValue'] + Compositor.mask_input_info_str +
+                      Compositor.warp_input_info_str +
+                      Compositor.summary_input_info_str)
     description = 'Composite Algorithm by Zhu Zhe'
 
     def __repr__(self):
         return "Composite algorithm by Zhu Zhe"
 
+    def required_bands(self):
+        """ Return blue and NIR band numbers, and any mask band """
+        return ([self._blue, self._nir] +
+                super(ZZCompositor, self).required_bands())
+
+    def index_bands(self):
+        """ Return blue and NIR bands and score used to select observations """
+        return self._blue, self._nir, 'ratio'
+
     def process_chunk(self, xoff, yoff, xsize, ysize):
         """ Process a chunk of an image
 
@@ -37,5 +50,9 @@ class ZZCompositor(Compositor):
           xsize (int): number of columns to process
           ysize (int): number of rows to process
 
+        Returns:
+          composite (np.ndarray): composited chunk, followed by any summary
+            bands, shaped (out_nband, ysize, xsize)
+
         """
-        return
+        return self.select_best_chunk(xoff, yoff, xsize, ysize)
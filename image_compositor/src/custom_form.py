@@ -29,8 +29,12 @@ class CustomForm(QtGui.QWidget):
 
     Class is heavily inspired by "formlayout" module by Pierre Raybut
         See: https://code.google.com/p/formlayout/
+
+    Emits `changed` when the user finishes editing a field.
     """
 
+    changed = QtCore.pyqtSignal()
+
     def __init__(self, defaults, title=None, parent=None):
         """ Initializes a custom form
 
@@ -100,6 +104,10 @@ class CustomForm(QtGui.QWidget):
             if field is not None:
                 self.form_layout.addRow(name, field)
                 self.widgets.append(field)
+                if isinstance(field, QtGui.QCheckBox):
+                    field.stateChanged.connect(self.changed)
+                else:
+                    field.editingFinished.connect(self.changed)
 
         self.error_label = QtGui.QLabel('')
         self.form_layout.addRow(self.error_label)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+""" image_table.py
+
+Table model of the images added to the compositor
+
+Images are stored as an `ImageCollection` of paths, dates and validity
+rather than as one table item per cell, so the table view only formats the
+rows that are visible and adding or removing thousands of images is a
+handful of array operations. The collection may be given directly to
+compositing algorithms, which then use any dates edited in the table.
+
+"""
+from __future__ import division, print_function
+
+from datetime import datetime as dt
+import logging
+
+import numpy as np
+
+from PyQt4 import QtCore
+
+from compositors.collection import ImageCollection, UNKNOWN
+from compositors.dates import isnat
+
+logger = logging.getLogger('image_compositor')
+
+
+class ImageTableModel(QtCore.QAbstractTableModel):
+    """ Table of image names, dates and validity sorted by date
+
+    Attributes:
+      collection (ImageCollection): images in the order of the table rows
+
+    """
+
+    headers = ['Name', 'Date', 'Valid']
+
+    def __init__(self, parent=None):
+        QtCore.QAbstractTableModel.__init__(self, parent)
+        self.collection = ImageCollection()
+        self._names = np.array([], dtype=object)
+        self._index = set()
+        self._rows = {}
+
+    def __len__(self):
+        return len(self.collection)
+
+    @property
+    def paths(self):
+        """ np.ndarray: image filenames """
+        return self.collection.paths
+
+    @property
+    def dates(self):
+        """ np.ndarray: image dates as `datetime64[D]`, NaT if unknown """
+        return self.collection.dates
+
+    @property
+    def valid(self):
+        """ np.ndarray: 1 if image is valid, 0 if not, or `UNKNOWN` """
+        return self.collection.valid
+
+    def __contains__(self, image):
+        return image in self._index
+
+# Model API
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self.paths.size
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and \
+                orientation == QtCore.Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def flags(self, index):
+        flags = QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+        if index.column() == 1:
+            flags |= QtCore.Qt.ItemIsEditable
+        return flags
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, col = index.row(), index.column()
+
+        if role == QtCore.Qt.TextAlignmentRole:
+            return QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter
+        elif role == QtCore.Qt.ToolTipRole:
+            return self.paths[row]
+        elif role not in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
+            return None
+
+        if col == 0:
+            return self._names[row]
+        elif col == 1:
+            date = self.dates[row]
+            return 'None' if isnat(date) else \
+                date.astype(object).strftime('%x')
+        elif col == 2:
+            return {UNKNOWN: '', 0: 'No', 1: 'Yes'}[int(self.valid[row])]
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        """ Set date of an image from text formatted as YYYY-MM-DD """
+        if role != QtCore.Qt.EditRole or index.column() != 1:
+            return False
+
+        value = str(value)
+        for fmt in ('%Y-%m-%d', '%x'):
+            try:
+                date = dt.strptime(value, fmt).date()
+            except ValueError:
+                continue
+            self.dates[index.row()] = np.datetime64(date, 'D')
+            self.dataChanged.emit(index, index)
+            return True
+
+        logger.warning('Could not parse date from "{v}"'.format(v=value))
+        return False
+
+# Storage
+    def add_images(self, images):
+        """ Add images not already in the table, keeping rows sorted by date
+
+        Args:
+          images (list): filenames of images to add
+
+        Returns:
+          added (int): number of images added
+
+        """
+        new = []
+        for image in images:
+            if image in self._index:
+                logger.info('Already added {i}'.format(i=image))
+            else:
+                self._index.add(image)
+                new.append(image)
+        if not new:
+            return 0
+
+        self.beginResetModel()
+        self._set_collection(ImageCollection.concatenate(
+            [self.collection, ImageCollection(new)]).sorted())
+        self.endResetModel()
+
+        return len(new)
+
+    def remove_rows(self, rows):
+        """ Remove images by row number
+
+        Args:
+          rows (iterable): row numbers to remove
+
+        """
+        keep = np.ones(self.paths.size, dtype=bool)
+        keep[list(rows)] = False
+        if keep.all():
+            return
+
+        self.beginResetModel()
+        self._index.difference_update(self.paths[~keep])
+        self._set_collection(self.collection[keep])
+        self.endResetModel()
+
+    def set_valid(self, images, valid):
+        """ Set validity of images still in the table
+
+        Args:
+          images (list): filenames of images
+          valid (list): True or False for each image
+
+        """
+        rows = [self._rows.get(image) for image in images]
+        updated = [(row, v) for row, v in zip(rows, valid) if row is not None]
+        if not updated:
+            return
+
+        rows, valid = zip(*updated)
+        self.valid[list(rows)] = valid
+        self.dataChanged.emit(self.index(min(rows), 2),
+                              self.index(max(rows), 2))
+
+    def _set_collection(self, collection):
+        """ Replace the images of the table, which must be sorted """
+        self.collection = collection
+        self._names = collection.names
+        self._rows = dict((p, i) for i, p in enumerate(collection.paths))
@@ -101,11 +101,11 @@ class Ui_ImageCompositor(object):
         self.horizontalLayout.addWidget(self.rbut_dir)
         self.gridLayout_3.addWidget(self.groupbox_importer, 0, 0, 1, 2)
         self.gridLayout_2.addWidget(self.widget_io, 0, 0, 1, 2)
-        self.table_images = QtGui.QTableWidget(self.widget_left)
+        self.table_images = QtGui.QTableView(self.widget_left)
         self.table_images.setMinimumSize(QtCore.QSize(0, 250))
+        self.table_images.setSelectionMode(QtGui.QAbstractItemView.MultiSelection)
+        self.table_images.setSelectionBehavior(QtGui.QAbstractItemView.SelectRows)
         self.table_images.setObjectName(_fromUtf8("table_images"))
-        self.table_images.setColumnCount(0)
-        self.table_images.setRowCount(0)
         self.gridLayout_2.addWidget(self.table_images, 1, 0, 1, 1)
         self.widget_right = QtGui.QWidget(self.splitter)
         sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.MinimumExpanding, QtGui.QSizePolicy.Preferred)
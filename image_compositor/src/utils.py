@@ -6,7 +6,6 @@ Utilities for Qt widgets
 """
 from __future__ import division, print_function
 
-from datetime import datetime as dt
 import fnmatch
 import logging
 import os
@@ -14,6 +13,8 @@ import os
 from PyQt4 import QtCore
 from PyQt4 import QtGui
 
+from compositors.dates import parse_date
+
 logger = logging.getLogger('image_compositor')
 
 
@@ -40,8 +41,10 @@ def locate_files(location, pattern):
 def parse_date_from_filename(filename):
     """ Tries to extract date from a filename for common image filenames
 
-    Should work for:
-        - Landsat
+    Uses the filename parsers registered in `compositors.dates`, which
+    include:
+        - Landsat scene IDs and Collection 1 and 2 product IDs
+        - Sentinel-2 products and tiles
 
     Args:
       filename (str): filename to extract from
@@ -50,21 +53,7 @@ def parse_date_from_filename(filename):
       date_str (datetime): datetime object for file if parsed, else None
 
     """
-    filename = os.path.basename(filename)
-    date = None
-
-    # Landsat filename - substring from 9 - 16 (e.g., LE70220492000037EDC00)
-    date_str = filename[9:16]
-    try:
-        date = dt.strptime(date_str, '%Y%j')
-    except:
-        logger.debug('File {f} could not be parsed for date as Landsat'.format(
-            f=filename))
-
-    if not date:
-        logger.warning('Could not parse date for {f}'.format(f=filename))
-
-    return date
+    return parse_date(filename)
 
 
 ### Validators
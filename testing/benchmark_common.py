@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+""" Helpers shared by the benchmark scripts
+
+"""
+import os
+
+import numpy as np
+from osgeo import gdal
+
+gdal.UseExceptions()
+
+
+def make_image(filename, ncol, nrow=None, nband=6, row_off=0,
+               interleave='PIXEL', seed=0):
+    """ Write a random int16 image with smooth structure so it compresses
+
+    Args:
+      filename (str): filename of tiled, compressed GeoTIFF to write
+      ncol (int): number of columns
+      nrow (int, optional): number of rows (default: `ncol`)
+      nband (int, optional): number of bands
+      row_off (int, optional): rows down a grid of 30m pixels the image
+        starts
+      interleave (str, optional): "PIXEL" or "BAND" interleaving
+      seed (int, optional): seed of random values
+
+    """
+    if nrow is None:
+        nrow = ncol
+    rng = np.random.RandomState(seed)
+    ds = gdal.GetDriverByName('GTiff').Create(
+        filename, ncol, nrow, nband, gdal.GDT_Int16,
+        ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=2',
+         'INTERLEAVE={i}'.format(i=interleave)])
+    ds.SetGeoTransform((500000, 30, 0, 4000000 - 30 * row_off, 0, -30))
+    base = np.cumsum(rng.randint(-5, 6, size=(nrow, ncol)), axis=1) + 2000
+    for b in range(nband):
+        ds.GetRasterBand(b + 1).WriteArray(
+            (base + rng.randint(0, 500)).astype(np.int16))
+    ds = None
+
+
+def cpu_time():
+    """ Return user and system CPU time of this process """
+    times = os.times()
+    return times[0] + times[1]
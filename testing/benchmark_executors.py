@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Benchmark compositing with a pool of processes against a pool of threads
+
+A stack of synthetic tiled, compressed GeoTIFFs is composited by
+`NDVIComposite` using each executor (see `Compositor.executor`) and the
+same number of CPUs. Wall time and CPU time of the calling process are
+reported for each; CPU time of worker processes is not included, so only
+wall times compare the two executors.
+
+Usage:
+    python benchmark_executors.py [nimage] [size] [ncpu]
+
+"""
+from __future__ import division, print_function
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmark_common import cpu_time, make_image
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'image_compositor', 'src',
+                                'compositors'))
+from ndvi_composite import NDVIComposite  # noqa
+
+
+def main(nimage=24, size=2048, ncpu=None, repeat=3):
+    ncpu = ncpu or multiprocessing.cpu_count()
+    tmp = tempfile.mkdtemp()
+    try:
+        images = []
+        for i in range(nimage):
+            images.append(os.path.join(tmp, 'image{i}.tif'.format(i=i)))
+            make_image(images[-1], size, seed=i)
+        output = os.path.join(tmp, 'composite.tif')
+        print('{n} images of {s}x{s} pixels, {c} CPUs'.format(
+            n=nimage, s=size, c=ncpu))
+
+        for executor in ('process', 'thread'):
+            compositor = NDVIComposite()
+            compositor.executor = executor
+            compositor.validate_images(images)
+            wall, cpu = [], []
+            for _ in range(repeat):
+                t0, c0 = time.time(), cpu_time()
+                compositor.process_image(output, ncpu=ncpu)
+                wall.append(time.time() - t0)
+                cpu.append(cpu_time() - c0)
+            print('{e:>7}: {w:8.3f}s wall {c:8.3f}s CPU'.format(
+                e=executor, w=min(wall), c=min(cpu)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Benchmark pixel selection kernel backends on a synthetic image stack
+
+Usage:
+    python benchmark_kernels.py [nimage] [size]
+
+"""
+from __future__ import division, print_function
+
+import os
+import sys
+import timeit
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'image_compositor', 'src',
+                                'compositors'))
+import kernels  # noqa
+
+
+def make_stack(nimage, size, nband=6, ndv=-9999, seed=0):
+    """ Return random int16 stack with ~30% NoDataValue observations """
+    rng = np.random.RandomState(seed)
+    cube = rng.randint(0, 10000, size=(nimage, nband, size, size))
+    cube = cube.astype(np.int16)
+    cube[rng.rand(nimage, 1, size, size).repeat(nband, axis=1) < 0.3] = ndv
+    return cube
+
+
+def main(nimage=50, size=256, repeat=5):
+    cube = make_stack(nimage, size)
+    print('Stack: {n} images x {s}x{s} pixels ({mb:.1f} MB)'.format(
+        n=nimage, s=size, mb=cube.nbytes / 1e6))
+
+    results = {}
+    for score in kernels.SCORES:
+        for backend in kernels.BACKENDS:
+            func = lambda: kernels.select_best(cube, 2, 3, -9999,
+                                               score=score, backend=backend)
+            results[backend] = func()  # warm up / JIT compile
+            t = min(timeit.repeat(func, number=1, repeat=repeat))
+            print('{score:>6} {backend:>6}: {t:8.4f}s'.format(
+                score=score, backend=backend, t=t))
+        if len(results) > 1:
+            assert np.array_equal(results['numpy'], results['numba'])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
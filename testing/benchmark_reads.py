@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Benchmark read strategies on pixel- and band-interleaved GeoTIFFs
+
+Synthetic tiled, compressed GeoTIFFs are read chunk by chunk either all
+bands at once (`ds.ReadRaster`) or band by band (`band.ReadAsArray`).
+Wall time and CPU time, which is mostly spent decoding blocks, are reported
+for each combination. The GDAL block cache is kept small, as when
+compositing long stacks, so blocks evicted between bands are decoded again.
+
+Usage:
+    python benchmark_reads.py [size] [nband] [chunk]
+
+"""
+from __future__ import division, print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from osgeo import gdal
+
+from benchmark_common import cpu_time, make_image
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'image_compositor', 'src',
+                                'compositors'))
+import datasets  # noqa
+
+gdal.UseExceptions()
+
+
+def read_all(filename, strategy, chunk):
+    """ Read every chunk of an image using a read strategy """
+    ds = gdal.Open(filename)
+    size, nband = ds.RasterXSize, ds.RasterCount
+    bands = [ds.GetRasterBand(b + 1) for b in range(nband)]
+    for yoff in range(0, size, chunk):
+        for xoff in range(0, size, chunk):
+            nx, ny = min(chunk, size - xoff), min(chunk, size - yoff)
+            if strategy == datasets.READ_DATASET:
+                ds.ReadRaster(xoff, yoff, nx, ny)
+            else:
+                for band in bands:
+                    band.ReadAsArray(xoff, yoff, nx, ny)
+
+
+def main(size=4096, nband=6, chunk=256, repeat=3):
+    gdal.SetCacheMax(4 * 1024 * 1024)
+    tmp = tempfile.mkdtemp()
+    try:
+        print('{s}x{s} pixels, {n} bands, {c}x{c} chunks'.format(
+            s=size, n=nband, c=chunk))
+        for interleave in ('PIXEL', 'BAND'):
+            filename = os.path.join(tmp, interleave.lower() + '.tif')
+            make_image(filename, size, nband=nband, interleave=interleave)
+            ds = gdal.Open(filename)
+            chosen = datasets.read_strategy(ds, filename)
+            ds = None
+
+            for strategy in (datasets.READ_DATASET, datasets.READ_BAND):
+                wall, cpu = [], []
+                for _ in range(repeat):
+                    t0, c0 = time.time(), cpu_time()
+                    read_all(filename, strategy, chunk)
+                    wall.append(time.time() - t0)
+                    cpu.append(cpu_time() - c0)
+                print('{i:>5} {s:>7}: {w:8.3f}s wall {c:8.3f}s CPU{m}'.format(
+                    i=interleave.lower(), s=strategy, w=min(wall),
+                    c=min(cpu), m=' (chosen)' if strategy == chosen else ''))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:4]])
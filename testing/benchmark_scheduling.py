@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Benchmark chunk scheduling on a skewed mosaic
+
+A few synthetic scenes cover the whole grid, while most cover only its
+last rows, as where many overlapping paths meet. Dispatched row by row,
+the expensive chunks come last and leave workers idle; dispatched most
+expensive first (see `scheduling.py`), they do not. Wall time of
+`NDVIComposite` is reported for each chunk order.
+
+Usage:
+    python benchmark_scheduling.py [nimage] [size] [ncpu]
+
+"""
+from __future__ import division, print_function
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmark_common import make_image
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'image_compositor', 'src',
+                                'compositors'))
+from ndvi_composite import NDVIComposite  # noqa
+
+
+def main(nimage=48, size=2048, ncpu=None, repeat=3):
+    ncpu = ncpu or multiprocessing.cpu_count()
+    tmp = tempfile.mkdtemp()
+    try:
+        images = []
+        for i in range(nimage):
+            # First scenes, including the base image, cover the whole grid
+            row_off = 0 if i < 4 else size * 3 // 4
+            images.append(os.path.join(tmp, 'image{i}.tif'.format(i=i)))
+            make_image(images[-1], size, size - row_off, row_off=row_off,
+                       seed=i)
+        output = os.path.join(tmp, 'composite.tif')
+        print('{n} images of up to {s}x{s} pixels, {c} CPUs'.format(
+            n=nimage, s=size, c=ncpu))
+
+        for chunk_order in ('rows', 'cost'):
+            compositor = NDVIComposite()
+            compositor.chunk_order = chunk_order
+            compositor.validate_images(images)
+            wall = []
+            for _ in range(repeat):
+                t0 = time.time()
+                compositor.process_image(output, ncpu=ncpu)
+                wall.append(time.time() - t0)
+            print('{o:>5}: {w:8.3f}s wall'.format(o=chunk_order,
+                                                 w=min(wall)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:4]])
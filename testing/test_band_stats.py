@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+""" Tests of streaming band statistics and histograms
+
+Run with `python -m pytest testing`.
+
+"""
+from __future__ import division
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'image_compositor', 'src',
+                                'compositors'))
+import band_stats  # noqa
+
+NDV = -9999
+
+
+def _chunks(dtype, seed=0):
+    """ Return chunks whose ranges grow, with NoDataValue and NaN """
+    rng = np.random.RandomState(seed)
+    chunks = []
+    for i in range(6):
+        chunk = (rng.rand(20, 20) * 100 * 4 ** i - 50 * 2 ** i).astype(dtype)
+        chunk[rng.rand(*chunk.shape) < 0.2] = NDV
+        if np.issubdtype(dtype, np.floating):
+            chunk[0, :5] = np.nan
+        chunks.append(chunk)
+    return chunks
+
+
+def _valid(chunks):
+    """ Return valid values of chunks """
+    values = np.concatenate([c.ravel() for c in chunks]).astype(np.float64)
+    return values[np.isfinite(values) & (values != NDV)]
+
+
+def _check(stats, values):
+    assert stats.count == values.size
+    assert stats.minimum == values.min()
+    assert stats.maximum == values.max()
+    assert np.isclose(stats.mean, values.mean())
+    assert np.isclose(stats.std, values.std())
+
+
+@pytest.mark.parametrize('dtype', [np.int32, np.float32])
+def test_update_matches_numpy(dtype):
+    chunks = _chunks(dtype)
+    stats = band_stats.BandStatistics(NDV, integer=dtype == np.int32)
+    for chunk in chunks:
+        stats.update(chunk)
+
+    _check(stats, _valid(chunks))
+    assert stats._counts.sum() == stats.count
+
+
+@pytest.mark.parametrize('dtype', [np.int32, np.float32])
+def test_merge_matches_update(dtype):
+    chunks = _chunks(dtype)
+    integer = dtype == np.int32
+    merged = band_stats.BandStatistics(NDV, integer=integer)
+    for part in (chunks[3:], chunks[:3], []):
+        stats = band_stats.BandStatistics(NDV, integer=integer)
+        for chunk in part:
+            stats.update(chunk)
+        merged.merge(stats)
+
+    _check(merged, _valid(chunks))
+    assert merged._counts.sum() == merged.count
+
+
+def test_empty_statistics():
+    stats = band_stats.BandStatistics(NDV)
+    stats.update(np.full((4, 4), NDV, dtype=np.int16))
+
+    assert stats.count == 0
+    assert stats.std == 0
+    assert stats.histogram() is None
+
+
+def test_integer_histogram_is_exact():
+    rng = np.random.RandomState(0)
+    chunks = [rng.randint(-20, 30, (16, 16)) for _ in range(3)]
+    chunks.append(rng.randint(500, 600, (16, 16)))
+    stats = band_stats.BandStatistics(integer=True, nbins=64)
+    for chunk in chunks:
+        stats.update(chunk)
+
+    values = np.concatenate([c.ravel() for c in chunks])
+    lo, hi, counts = stats.histogram(nbuckets=1000)
+
+    # One bucket centred on each whole number, as GDAL computes them
+    assert (lo, hi) == (values.min() - 0.5, values.max() + 0.5)
+    assert len(counts) == values.max() - values.min() + 1
+    assert sum(counts) == values.size
+
+
+def test_float_histogram_within_a_fine_bin():
+    rng = np.random.RandomState(0)
+    values = rng.normal(size=10000)
+    stats = band_stats.BandStatistics()
+    for chunk in np.split(values, 10):
+        stats.update(chunk)
+
+    lo, hi, counts = stats.histogram(nbuckets=20)
+
+    assert (lo, hi) == (values.min(), values.max())
+    assert sum(counts) == values.size
+    # Fine bins straddling bucket edges may be counted in either bucket
+    edges = np.linspace(lo, hi, 21)
+    for count, start, end in zip(counts, edges[:-1], edges[1:]):
+        inner = ((values >= start + stats._width) &
+                 (values < end - stats._width)).sum()
+        outer = ((values >= start - stats._width) &
+                 (values <= end + stats._width)).sum()
+        assert inner <= count <= outer
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+""" Tests of selecting, sorting and pickling image collections
+
+Run with `python -m pytest testing`.
+
+"""
+import os
+import pickle
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'image_compositor', 'src',
+                                'compositors'))
+import collection  # noqa
+
+PATHS = ['b/LE70220492000040EDC00.tif',
+         'a/LE70220492000037EDC00.tif',
+         'scene.tif',
+         'a/LC80220492013100LGN00.tif',
+         'b/LE70220492000040EDC00.tif']
+
+
+def _collection():
+    """ Return a collection with some columns filled """
+    images = collection.ImageCollection(PATHS)
+    images.sizes[:] = np.arange(len(PATHS))[:, None]
+    images.nbands[:] = 6
+    images.valid[:] = [1, 0, collection.UNKNOWN, 1, 1]
+    return images
+
+
+@pytest.mark.parametrize('parsed', [False, True])
+def test_pickle_round_trip(parsed):
+    images = _collection()
+    if parsed:
+        images.sensors
+
+    copy = pickle.loads(pickle.dumps(images, pickle.HIGHEST_PROTOCOL))
+
+    assert copy.paths.dtype == object
+    assert list(copy.paths) == PATHS
+    np.testing.assert_array_equal(copy.sizes, images.sizes)
+    np.testing.assert_array_equal(copy.valid, images.valid)
+    np.testing.assert_array_equal(copy.dates, images.dates)
+    assert list(copy.sensors) == list(images.sensors)
+    assert copy.sensors[2] is None
+
+
+def test_pickle_empty():
+    copy = pickle.loads(pickle.dumps(collection.ImageCollection([])))
+
+    assert len(copy) == 0
+    assert len(copy.sensors) == 0
+
+
+def test_sorted_by_date_then_path_unknown_last():
+    images = _collection().sorted()
+
+    assert list(images.paths) == [PATHS[1], PATHS[0], PATHS[4], PATHS[3],
+                                  PATHS[2]]
+    # Other columns follow their images
+    np.testing.assert_array_equal(images.sizes[:, 0], [1, 0, 4, 3, 2])
+
+
+def test_between():
+    images = _collection()
+
+    assert list(images.between('2000-02-07', '2000-02-09').paths) == [
+        PATHS[0], PATHS[4]]
+    assert list(images.between(end='2000-02-06').paths) == [PATHS[1]]
+    assert list(images.between(start='2001-01-01').paths) == [PATHS[3]]
+    # Images without a date are never included
+    assert PATHS[2] not in images.between()
+
+
+def test_unique_keeps_first():
+    images = _collection().unique()
+
+    assert list(images.paths) == PATHS[:4]
+    np.testing.assert_array_equal(images.valid, [1, 0, collection.UNKNOWN,
+                                                 1])
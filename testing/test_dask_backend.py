@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+""" Tests of the Dask backend on local schedulers
+
+Run with `python -m pytest testing`. Tests compositing images are skipped
+unless GDAL and Dask are installed.
+
+"""
+from __future__ import division
+
+import os
+import subprocess
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+compositors = os.path.join(here, '..', 'image_compositor', 'src',
+                           'compositors')
+sys.path.insert(0, compositors)
+import dask_backend  # noqa
+
+
+def test_dask_imported_lazily():
+    code = 'import sys, dask_backend; print("dask" in sys.modules)'
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd=compositors)
+    assert output.strip() == b'False'
+
+
+class _Compositor(object):
+    """ Stand-in for a compositor, copied by each worker thread """
+    reuse_buffers = False
+
+
+def test_worker_compositor_per_thread():
+    compositor = _Compositor()
+    copies = []
+
+    def work():
+        first = dask_backend._worker_compositor(compositor, 'run')
+        assert dask_backend._worker_compositor(compositor, 'run') is first
+        copies.append(first)
+
+    workers = [threading.Thread(target=work) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert len(set(id(c) for c in copies)) == 4
+    assert compositor not in copies
+    assert all(c.reuse_buffers for c in copies)
+
+
+class _Stack(object):
+    """ Stand-in for a compositor reading chunks into a reused buffer """
+    reuse_buffers = False
+    images = ['a', 'b', 'c']
+    nband = 2
+    dtype = np.int16
+    size = 40
+
+    def __init__(self):
+        self.data = np.arange(3 * 2 * 40 * 40, dtype=self.dtype).reshape(
+            3, 2, 40, 40)
+
+    def iter_chunks(self):
+        for yoff in range(0, self.size, 16):
+            for xoff in range(0, self.size, 16):
+                yield (xoff, yoff, min(16, self.size - xoff),
+                       min(16, self.size - yoff))
+
+    def read_chunk(self, xoff, yoff, xsize, ysize):
+        shape = (len(self.images), self.nband, ysize, xsize)
+        if self.reuse_buffers:
+            if getattr(self, '_buffer', None) is None:
+                self._buffer = np.empty(self.data.size, dtype=self.dtype)
+            cube = self._buffer[:int(np.prod(shape))].reshape(shape)
+        else:
+            cube = np.empty(shape, dtype=self.dtype)
+        cube[:] = self.data[:, :, yoff:yoff + ysize, xoff:xoff + xsize]
+        return cube
+
+
+@pytest.mark.parametrize('scheduler', ['synchronous', 'threads'])
+def test_stack_array_matches_read_chunk(scheduler):
+    pytest.importorskip('dask')
+    compositor = _Stack()
+
+    stack = dask_backend.stack_array(compositor).compute(scheduler=scheduler)
+
+    assert stack.shape == compositor.data.shape
+    for xoff, yoff, xsize, ysize in compositor.iter_chunks():
+        np.testing.assert_array_equal(
+            stack[:, :, yoff:yoff + ysize, xoff:xoff + xsize],
+            compositor.read_chunk(xoff, yoff, xsize, ysize))
+
+
+def _make_images(directory, nimage=5, size=48):
+    """ Write overlapping 6 band images with some NoDataValue pixels """
+    from osgeo import gdal
+    rng = np.random.RandomState(0)
+    images = []
+    for i in range(nimage):
+        filename = os.path.join(str(directory), 'image{i}.tif'.format(i=i))
+        ds = gdal.GetDriverByName('GTiff').Create(
+            filename, size, size, 6, gdal.GDT_Int16,
+            ['TILED=YES', 'BLOCKXSIZE=16', 'BLOCKYSIZE=16'])
+        ds.SetGeoTransform((500000, 30, 0, 4000000, 0, -30))
+        data = rng.randint(0, 5000, size=(6, size, size)).astype(np.int16)
+        data[:, rng.rand(size, size) < 0.2] = -9999
+        for b in range(6):
+            ds.GetRasterBand(b + 1).WriteArray(data[b])
+        ds = None
+        images.append(filename)
+    return images
+
+
+def _read(filename):
+    from osgeo import gdal
+    return gdal.Open(filename).ReadAsArray()
+
+
+@pytest.mark.parametrize('scheduler', ['synchronous', 'threads',
+                                       'processes'])
+def test_process_image_matches_serial(tmpdir, scheduler):
+    pytest.importorskip('osgeo')
+    pytest.importorskip('dask')
+    from ndvi_composite import NDVIComposite
+
+    images = _make_images(tmpdir)
+    compositor = NDVIComposite()
+    compositor.chunk_size = (16, 16)
+    compositor.validate_images(images)
+
+    expected = str(tmpdir.join('serial.tif'))
+    compositor.process_image(expected)
+    output = str(tmpdir.join('dask.tif'))
+    dask_backend.process_image(compositor, output, scheduler=scheduler,
+                               batch_size=3)
+
+    np.testing.assert_array_equal(_read(output), _read(expected))
+    np.testing.assert_array_equal(
+        dask_backend.composite_array(compositor).compute(
+            scheduler=scheduler),
+        _read(expected))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+""" Tests of the filename parser registry and its memoization
+
+Run with `python -m pytest testing`.
+
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'image_compositor', 'src',
+                                'compositors'))
+import dates  # noqa
+
+
+@pytest.fixture
+def registry():
+    """ Restore the default parsers after a test changes them """
+    saved = list(dates._parsers.items())
+    yield dates
+    dates._parsers.clear()
+    dates._parsers.update(saved)
+    dates.catalog.clear()
+
+
+def test_default_parsers():
+    landsat = 'LE70220492000037EDC00_stack.gtif'
+    product = 'LC08_L1TP_022049_20200101_20200113_01_T1_stack.tif'
+    sentinel = 'S2A_MSIL2A_20170105T013442_N0204_R031_T53NMJ.tif'
+
+    parsed, sensors = dates.parse_filenames([landsat, product, sentinel])
+
+    np.testing.assert_array_equal(
+        parsed, np.array(['2000-02-06', '2020-01-01', '2017-01-05'],
+                         dtype='datetime64[D]'))
+    assert list(sensors) == ['LE7', 'LC08', 'S2A']
+
+
+def test_unparsed_filename_is_nat():
+    # 2001 has no day 366
+    parsed, sensors = dates.parse_filenames(['scene.tif', 'LE70220492001'
+                                             '366EDC00.tif'])
+
+    assert dates.isnat(parsed).all()
+    assert list(sensors) == [None, None]
+    assert dates.parse_date('scene.tif') is None
+
+
+def test_register_parser_order(registry):
+    registry.register_parser('custom', r'img_(?P<date>\d{8})', '%Y%m%d',
+                             sensor='custom')
+    assert registry.parsers()[-1].name == 'custom'
+
+    registry.register_parser('first', r'(?P<date>\d{4}-\d{2}-\d{2})',
+                             '%Y-%m-%d', sensor='first', first=True)
+    names = [parser.name for parser in registry.parsers()]
+    assert names[0] == 'first'
+    assert names[-1] == 'custom'
+
+    assert registry.catalog.get('img_20010203.tif') == (
+        np.datetime64('2001-02-03', 'D'), 'custom')
+    assert registry.catalog.get('img_20010203_2001-02-04.tif') == (
+        np.datetime64('2001-02-04', 'D'), 'first')
+
+    registry.unregister_parser('first')
+    assert 'first' not in [parser.name for parser in registry.parsers()]
+
+
+def test_register_parser_requires_date_group(registry):
+    with pytest.raises(ValueError):
+        registry.register_parser('bad', r'img_\d{8}', '%Y%m%d')
+
+
+def test_catalog_memoizes_by_basename(registry):
+    registry.catalog.clear()
+    registry.parse_filenames([os.path.join('a', 'LE70220492000037EDC00.tif'),
+                              'LE70220492000038EDC00.tif'])
+    assert len(registry.catalog) == 2
+    assert os.path.join('b', 'LE70220492000037EDC00.tif') in registry.catalog
+
+    # Remembered results are returned without parsing again
+    registry.catalog._scenes['LE70220492000037EDC00.tif'] = (
+        np.datetime64('1999-01-01', 'D'), 'cached')
+    parsed, sensors = registry.parse_filenames(['LE70220492000037EDC00.tif'])
+    assert parsed[0] == np.datetime64('1999-01-01', 'D')
+    assert sensors[0] == 'cached'
+
+
+def test_registry_change_clears_catalog(registry):
+    registry.parse_filenames(['img_20010203.tif'])
+    assert 'img_20010203.tif' in registry.catalog
+    assert registry.catalog.get('img_20010203.tif')[1] is None
+
+    registry.register_parser('custom', r'img_(?P<date>\d{8})', '%Y%m%d',
+                             sensor='custom')
+    assert len(registry.catalog) == 0
+    assert registry.catalog.get('img_20010203.tif')[1] == 'custom'
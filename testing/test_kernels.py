@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+""" Tests of the compositing kernels against NumPy references
+
+Run with `python -m pytest testing`.
+
+"""
+from __future__ import division
+
+import os
+import sys
+import warnings
+
+import numpy as np
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'image_compositor', 'src',
+                                'compositors'))
+import kernels  # noqa
+
+NDV = -9999
+
+
+def _stack(dtype, nimage=30, shape=(3, 12, 12), seed=0):
+    """ Return a random stack with NoDataValue observations and pixels """
+    rng = np.random.RandomState(seed)
+    cube = (rng.rand(nimage, *shape) * 10000).astype(dtype)
+    cube[rng.rand(*cube.shape) < 0.4] = NDV
+    cube[:, :, 0, 0] = NDV
+    cube[:-1, :, 0, 1] = NDV
+    return cube
+
+
+def _nanpercentile(cube, q):
+    """ Return `np.nanpercentile` over time, NaN where nothing is valid """
+    values = np.where(cube == NDV, np.nan, cube.astype(np.float64))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanpercentile(values, q, axis=0)
+
+
+def _bracket(cube, q):
+    """ Return the observations ranked either side of each quantile """
+    values = np.sort(np.where(cube == NDV, np.nan, cube.astype(np.float64)),
+                     axis=0)
+    n = (cube != NDV).sum(axis=0)
+    pos = (n - 1).clip(min=0) * (q / 100.0)
+    lower = np.take_along_axis(values, np.floor(pos).astype(int)[None], 0)
+    upper = np.take_along_axis(values, np.ceil(pos).astype(int)[None], 0)
+    return lower[0], upper[0]
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.float32])
+@pytest.mark.parametrize('q', [0, 25, 50, 90, 100])
+def test_quantile_matches_nanpercentile(dtype, q):
+    cube = _stack(dtype)
+    expected = _nanpercentile(cube, q)
+    if np.issubdtype(dtype, np.integer):
+        expected = np.round(expected)
+    expected[np.isnan(expected)] = NDV
+
+    composite = kernels.quantile(cube, q, NDV)
+
+    assert composite.dtype == dtype
+    np.testing.assert_allclose(composite, expected.astype(dtype), rtol=1e-6)
+
+
+@pytest.mark.parametrize('q', [0, 25, 50, 90, 100])
+def test_quantile_sketch_matches_nanpercentile(q):
+    cube = _stack(np.int16)
+    nband, nrow, ncol = cube.shape[1:]
+    composite = np.empty(cube.shape[1:])
+    for b in range(nband):
+        sketch = kernels.QuantileSketch((nrow, ncol), 0, 10000, nbins=256,
+                                        ndv=NDV)
+        for observation in cube[:, b]:
+            sketch.update(observation)
+        composite[b] = sketch.quantile(q)
+
+    # Within one bin of the observations either side of the quantile
+    expected = _nanpercentile(cube, q)
+    lower, upper = _bracket(cube, q)
+    width = 10000 / 256
+    valid = ~np.isnan(expected)
+    assert np.all(composite[~valid] == NDV)
+    assert np.all(lower[valid] <= expected[valid])
+    assert np.all(expected[valid] <= upper[valid])
+    assert np.all(composite[valid] >= lower[valid] - width)
+    assert np.all(composite[valid] <= upper[valid] + width)
+
+
+def _select_stack(dtype, seed=0):
+    """ Return a stack with NoDataValue, tied, zero and NaN observations """
+    rng = np.random.RandomState(seed)
+    cube = rng.randint(-50, 50, size=(8, 3, 10, 13)).astype(dtype)
+    cube[rng.rand(*cube.shape) < 0.2] = NDV
+    cube[:, :, 0, 0] = NDV
+    cube[:2, 1:, 1, 1] = 0
+    if np.issubdtype(dtype, np.floating):
+        cube[rng.rand(*cube.shape) < 0.2] = np.nan
+        cube[0, :, 2, 2] = np.nan
+    return cube
+
+
+@pytest.mark.skipif(not kernels.HAS_NUMBA, reason='Numba is not installed')
+@pytest.mark.parametrize('dtype', [np.int16, np.float32])
+@pytest.mark.parametrize('score', sorted(kernels.SCORES))
+@pytest.mark.parametrize('masked', [False, True])
+def test_select_best_backends_agree(dtype, score, masked):
+    cube = _select_stack(dtype)
+    clear = None
+    if masked:
+        rng = np.random.RandomState(1)
+        clear = np.packbits(rng.rand(8, 10, 13) < 0.7, axis=-1)
+
+    results = [kernels.select_best(cube, 1, 2, NDV, score=score,
+                                   backend=backend, clear=clear)
+               for backend in ('numpy', 'numba')]
+
+    np.testing.assert_array_equal(results[0], results[1])
+    scores = kernels.band_score(results[0][1], results[0][2], NDV, score)
+    assert not np.isnan(scores[results[0][1] != NDV]).any()
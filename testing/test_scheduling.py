@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+""" Tests of the cost-aware ordering of chunks
+
+Run with `python -m pytest testing`.
+
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'image_compositor', 'src',
+                                'compositors'))
+import scheduling  # noqa
+
+
+class _Compositor(object):
+    """ Stand-in for a compositor with validated images on a 64x64 grid """
+
+    def __init__(self, offsets, sizes, chunk_order='cost'):
+        self.images = ['image{i}'.format(i=i) for i in range(len(offsets))]
+        self.offsets = offsets
+        self.sizes = sizes
+        self.scale = 1
+        self.chunk_order = chunk_order
+
+    def iter_chunks(self):
+        for yoff in range(0, 64, 16):
+            for xoff in range(0, 64, 16):
+                yield xoff, yoff, 16, 16
+
+
+@pytest.mark.parametrize('n', [1, 2, 4, 16])
+def test_hilbert_index_visits_neighbours(n):
+    y, x = np.mgrid[:n, :n]
+    d = scheduling.hilbert_index(x.ravel(), y.ravel(), n)
+
+    # Each cell is visited once, and each step moves to a neighbouring cell
+    np.testing.assert_array_equal(np.sort(d), np.arange(n * n))
+    order = np.argsort(d)
+    steps = (np.abs(np.diff(x.ravel()[order])) +
+             np.abs(np.diff(y.ravel()[order])))
+    assert np.all(steps == 1)
+
+
+def test_chunk_costs_count_observations():
+    compositor = _Compositor([(0, 0), (8, 8)], [(64, 64), (16, 16)])
+    windows = [(0, 0, 16, 16), (16, 16, 16, 16), (48, 48, 16, 16)]
+
+    costs = scheduling.chunk_costs(compositor, windows)
+
+    np.testing.assert_array_equal(costs, [256 + 64, 256 + 64, 256])
+
+
+def test_schedule_most_expensive_first():
+    # A second image covers only the bottom right quarter of the grid
+    compositor = _Compositor([(0, 0), (32, 32)], [(64, 64), (32, 32)])
+    windows = list(compositor.iter_chunks())
+
+    scheduled = scheduling.schedule(compositor)
+
+    assert sorted(scheduled) == sorted(windows)
+    assert all(w[0] >= 32 and w[1] >= 32 for w in scheduled[:4])
+    costs = scheduling.chunk_costs(compositor, scheduled)
+    assert np.all(np.diff(costs) <= 0)
+    # Chunks of equal cost are ordered along the curve
+    cols, rows = np.array(scheduled[4:])[:, :2].T // 16
+    assert np.all(np.diff(scheduling.hilbert_index(cols, rows, 4)) > 0)
+
+
+def test_schedule_rows_keeps_order():
+    compositor = _Compositor([(32, 32)], [(32, 32)], chunk_order='rows')
+
+    assert scheduling.schedule(compositor) == list(compositor.iter_chunks())